@@ -4,6 +4,35 @@ import DualNBack
 import PySide.QtCore as QtCore
 import PySide.QtGui as QtGui
 import sys
+import contextlib
+import copy
+import glob
+import io
+import json
+import random
+import sqlite3
+import os
+import queue
+import tempfile
+import threading
+import time
+import types
+import wave
+import AssetRegistry
+import AudioEngine
+import NBackUserDatabase
+import EventLog
+import GenerateBlocks
+import MakeImages
+import StimPool
+import BlockScoring
+import TrialTiming
+from array import array
+
+# The original scanning version of the chain builder lives on in the
+# MakeBuffer prototype and serves as the reference implementation.
+sys.path.append('MakeBuffer')
+import linkup
 
 class DummyApp(object):
     '''A minimal dummy object that has all and only needed attributes and
@@ -15,6 +44,27 @@ class DummyApp(object):
         self.session_settings.set_settings_base_dict({})
 
 
+class DummyStimApp(object):
+    '''Just what a StimList reads from the application, with the screens
+    composited so no images are needed.'''
+
+    def __init__(self: 'DummyStimApp') -> None:
+
+        self.session_settings = DualNBack.SettingsObject()
+        self.session_settings.set_settings_base_dict(
+            {'current_n': 2, 'session_length_before_n': 20,
+             'number_of_targets': 8})
+        self.match_in_aural = 2
+        self.match_in_visual = 2
+        self.match_in_both = 1
+        self.composite_screens = True
+        self.image_set = self
+
+    def get_target_rects(self: 'DummyStimApp') -> list:
+
+        return []
+
+
 class Test_stims(unittest.TestCase):
 
     def _helper_test_buffers(self: 'Test_stims',
@@ -47,7 +97,7 @@ class Test_stims(unittest.TestCase):
 
             increment_both = 0
 
-        all_target_counts = stims_test.get_buffers()
+        all_target_counts = dict(stims_test.targets)
 
         for modality in counts:
 
@@ -77,6 +127,1449 @@ class Test_stims(unittest.TestCase):
 
             assert self._helper_test_buffers(stims_test)
 
+class Test_settings_batching(unittest.TestCase):
+
+    def setUp(self: 'Test_settings_batching') -> None:
+
+        self.settings = DualNBack.SettingsObject()
+        self.settings.set_settings_base_dict(
+            {'current_n': 1, 'number_of_targets': 8,
+             'background_colour': (0, 0, 0)})
+        self.signals = []
+        self.settings.settings_keys_changed.connect(self.signals.append)
+
+    def test_apply_many(self: 'Test_settings_batching') -> None:
+
+        self.settings.apply_many({'current_n': 2, 'number_of_targets': 8,
+                                  'background_colour': (1, 2, 3)})
+
+        # One signal, and number_of_targets didn't actually change.
+        self.assertEqual(self.signals,
+                         [frozenset(['current_n', 'background_colour'])])
+
+    def test_apply_many_is_atomic(self: 'Test_settings_batching') -> None:
+
+        self.assertRaises(ValueError, self.settings.apply_many,
+                          {'current_n': 2, 'background_colour': (1, 2)})
+        self.assertEqual(self.settings.get_n(), 1)
+        self.assertEqual(self.signals, [])
+
+    def test_apply_many_unknown_key(self: 'Test_settings_batching') -> None:
+
+        self.assertRaises(KeyError, self.settings.apply_many,
+                          {'current_n': 2, 'no_such_setting': 1})
+        self.assertEqual(self.settings.get_n(), 1)
+        self.assertNotIn('no_such_setting',
+                         self.settings.get_settings_base_dict())
+        self.assertEqual(self.signals, [])
+
+    def test_base_dict_edited_in_place(self: 'Test_settings_batching') -> None:
+
+        # As the settings window does, one holder changed and passed again.
+        holder = self.settings.get_settings_base_dict()
+        holder['current_n'] = 2
+        self.settings.set_settings_base_dict(holder)
+        holder['current_n'] = 3
+        self.settings.set_settings_base_dict(holder)
+
+        self.assertEqual(self.signals, [frozenset(['current_n']),
+                                        frozenset(['current_n'])])
+        self.assertEqual(self.settings.get_n(), 3)
+
+    def test_batch(self: 'Test_settings_batching') -> None:
+
+        with self.settings.batch():
+
+            self.settings.set_n(3)
+            self.settings.set_bg_colour((5, 5, 5))
+            self.assertEqual(self.signals, [])
+
+        self.assertEqual(self.signals,
+                         [frozenset(['current_n', 'background_colour'])])
+
+        with self.assertRaises(TypeError):
+
+            with self.settings.batch():
+
+                self.settings.set_n(4)
+                self.settings.set_number_targets('many')
+
+        self.assertEqual(self.settings.get_n(), 3)
+        self.assertEqual(len(self.signals), 1)
+
+class Test_link_up_chains(unittest.TestCase):
+
+    def test_matches_reference(self: 'Test_link_up_chains') -> None:
+
+        for i in range(2000):
+
+            block_n = random.randint(1, 6)
+            block_length = random.randint(1, 100)
+            target_indexes = random.sample(
+                range(block_n, (block_length + block_n)),
+                random.randint(0, block_length))
+            pairs = [[(index - block_n), index] for index in target_indexes]
+            random.shuffle(pairs)
+
+            self.assertEqual(
+                MakeStimBuffer.link_up_chains(copy.deepcopy(pairs)),
+                linkup.link_up(copy.deepcopy(pairs)))
+
+    def test_input_untouched(self: 'Test_link_up_chains') -> None:
+
+        pairs = [[3, 4], [1, 2], [2, 3]]
+        MakeStimBuffer.link_up_chains(pairs)
+
+        self.assertEqual(pairs, [[3, 4], [1, 2], [2, 3]])
+
+class Test_stim_sequence(unittest.TestCase):
+
+    def _make_sequence(self: 'Test_stim_sequence',
+                       **keywords) -> 'StimSequence':
+
+        return MakeStimBuffer.StimSequence(
+            2, 30, {'aural': 4, 'visual': 4, 'both': 2},
+            {'aural': 8, 'visual': 8}, **keywords)
+
+    def test_seed_replays(self: 'Test_stim_sequence') -> None:
+
+        first = self._make_sequence()
+        first.generate()
+        second = self._make_sequence()
+        second.generate(seed=first.seed)
+
+        self.assertEqual(first.buffers, second.buffers)
+        self.assertEqual(first.placement, second.placement)
+
+    def test_injected_rng(self: 'Test_stim_sequence') -> None:
+
+        first = self._make_sequence(rng=random.Random(5))
+        first.generate()
+        second = self._make_sequence()
+        second.generate(rng=random.Random(5))
+
+        self.assertIsNone(first.seed)
+        self.assertEqual(first.buffers, second.buffers)
+
+    def test_exact_counts(self: 'Test_stim_sequence') -> None:
+
+        for i in range(500):
+
+            block_n = random.randint(1, 6)
+            targets = {'aural': random.randint(0, 5),
+                       'visual': random.randint(0, 5),
+                       'both': random.randint(0, 3)}
+            sequence = MakeStimBuffer.StimSequence(
+                block_n, random.randint(sum(targets.values()), 60), targets,
+                {'aural': random.randint(2, 8),
+                 'visual': random.randint(2, 8)}, exact_counts=True)
+            sequence.generate()
+
+            self.assertEqual(sequence.count_matches(),
+                             {'visual': (targets['visual'] + targets['both']),
+                              'aural': (targets['aural'] + targets['both']),
+                              'both': targets['both']})
+
+class Test_compact_buffers(unittest.TestCase):
+
+    def setUp(self: 'Test_compact_buffers') -> None:
+
+        self.targets = {'aural': 4, 'visual': 5, 'both': 3}
+        self.sequence = MakeStimBuffer.StimSequence(
+            3, 40, self.targets, {'aural': 6, 'visual': 8})
+        self.sequence.generate(seed=9)
+
+    def test_flags(self: 'Test_compact_buffers') -> None:
+
+        placement = self.sequence.placement
+
+        self.assertEqual(MakeStimBuffer.TARGET_FLAGS['both'],
+                         (MakeStimBuffer.VISUAL_TARGET |
+                          MakeStimBuffer.AURAL_TARGET))
+        self.assertEqual(placement.typecode, 'B')
+        self.assertEqual(len(placement), 43)
+        self.assertEqual(placement[:3].tolist(), [0, 0, 0])
+
+        for modality in self.targets:
+
+            self.assertEqual(
+                placement.count(MakeStimBuffer.TARGET_FLAGS[modality]),
+                self.targets[modality])
+
+        self.assertEqual(placement.count(0), (43 - sum(self.targets.values())))
+
+        for modality in self.sequence.buffers:
+
+            working_buffer = self.sequence.buffers[modality]
+
+            self.assertEqual(working_buffer.typecode, 'b')
+            self.assertEqual(len(working_buffer), 43)
+            self.assertNotIn(-1, working_buffer)
+
+            for i in range(3, 43):
+
+                if (placement[i] & MakeStimBuffer.TARGET_FLAGS[modality]):
+
+                    self.assertEqual(working_buffer[i], working_buffer[i - 3])
+
+    def test_view(self: 'Test_compact_buffers') -> None:
+
+        images = ['image' + str(i) for i in range(8)]
+        sounds = ['sound' + str(i) for i in range(6)]
+        visual = self.sequence.buffers['visual']
+        aural = self.sequence.buffers['aural']
+        view = MakeStimBuffer.StimBufferView(visual, aural, images, sounds)
+        # What get_buffers used to build, a list per trial.
+        old_buffer = [[images[visual[i]], sounds[aural[i]]]
+                      for i in range(len(visual))]
+
+        self.assertEqual(len(view), 43)
+        self.assertEqual([list(trial) for trial in view], old_buffer)
+        self.assertEqual(view[-1], tuple(old_buffer[-1]))
+
+        for i in range(len(view)):
+
+            self.assertEqual(view[i], tuple(old_buffer[i]))
+            self.assertEqual(view.image(i), old_buffer[i][0])
+            self.assertEqual(view.sound(i), old_buffer[i][1])
+
+        with self.assertRaises(IndexError):
+
+            view[43]
+
+        # Shares the arrays' memory rather than copying them.
+        visual[0] = (visual[0] + 1) % 8
+
+        self.assertEqual(view.image(0), images[visual[0]])
+        self.assertEqual(repr(view),
+                         'visual: ' + str(visual.tolist()) +
+                         '\naural: ' + str(aural.tolist()))
+
+class Test_non_match_fill(unittest.TestCase):
+
+    def _make_sequence(self: 'Test_non_match_fill', n: int, length: int,
+                       total_stims: int) -> 'StimSequence':
+        '''Return a sequence with empty buffers, about a quarter of each
+        already set as the cues and targets would be.'''
+
+        sequence = MakeStimBuffer.StimSequence(
+            n, length, {'aural': 0, 'visual': 0, 'both': 0},
+            {'aural': total_stims, 'visual': total_stims})
+        sequence.make_index_list()
+        rng = random.Random(3)
+
+        for modality in sequence.buffers:
+
+            working_buffer = sequence.buffers[modality]
+
+            for i in rng.sample(range(len(working_buffer)),
+                                len(working_buffer) // 4):
+
+                working_buffer[i] = rng.randrange(total_stims)
+
+        return sequence
+
+    def _check_fill(self: 'Test_non_match_fill', filler: str) -> None:
+
+        for n, length, total_stims in [(1, 40, 3), (3, 100, 4),
+                                       (8, 600, 8)]:
+
+            sequence = self._make_sequence(n, length, total_stims)
+            preset = copy.deepcopy(sequence.buffers)
+
+            for modality in sequence.buffers:
+
+                getattr(sequence, filler)(modality, random.Random(7))
+                working_buffer = sequence.buffers[modality]
+
+                for i in range(len(working_buffer)):
+
+                    if preset[modality][i] != -1:
+
+                        self.assertEqual(working_buffer[i],
+                                         preset[modality][i])
+                        continue
+
+                    self.assertIn(working_buffer[i], range(total_stims))
+
+                    for j in [(i - n), (i + n)]:
+
+                        if 0 <= j < len(working_buffer):
+
+                            self.assertNotEqual(working_buffer[i],
+                                                working_buffer[j])
+
+    def _check_uniform(self: 'Test_non_match_fill', filler: str) -> None:
+
+        sequence = MakeStimBuffer.StimSequence(
+            8, 4000, {'aural': 0, 'visual': 0, 'both': 0},
+            {'aural': 8, 'visual': 8})
+        sequence.make_index_list()
+        getattr(sequence, filler)('visual', random.Random(11))
+        counts = [sequence.buffers['visual'].count(stim)
+                  for stim in range(8)]
+        mean = sum(counts) / 8
+
+        for count in counts:
+
+            self.assertLess(abs(count - mean), (mean * 0.2))
+
+    def _check_impossible(self: 'Test_non_match_fill', filler: str) -> None:
+
+        sequence = MakeStimBuffer.StimSequence(
+            1, 10, {'aural': 0, 'visual': 0, 'both': 0},
+            {'aural': 1, 'visual': 1})
+        sequence.make_index_list()
+        sequence.buffers['visual'][0] = 0
+
+        with self.assertRaises(ValueError):
+
+            getattr(sequence, filler)('visual', random.Random(1))
+
+    def test_serial(self: 'Test_non_match_fill') -> None:
+
+        self._check_fill('_fill_non_matches_serial')
+        self._check_uniform('_fill_non_matches_serial')
+        self._check_impossible('_fill_non_matches_serial')
+
+    @unittest.skipIf(MakeStimBuffer.numpy is None, 'numpy not installed')
+    def test_batched(self: 'Test_non_match_fill') -> None:
+
+        self._check_fill('_fill_non_matches_batched')
+        self._check_uniform('_fill_non_matches_batched')
+        self._check_impossible('_fill_non_matches_batched')
+
+    def test_impossible_specs(self: 'Test_non_match_fill') -> None:
+
+        targets = {'aural': 4, 'visual': 4, 'both': 2}
+
+        for length, how_many_stims in [(30, 1), (5, 8), (30, 200)]:
+
+            for exact_counts in [False, True]:
+
+                sequence = MakeStimBuffer.StimSequence(
+                    2, length, targets,
+                    {'aural': how_many_stims, 'visual': how_many_stims},
+                    exact_counts=exact_counts)
+
+                with self.assertRaises(ValueError):
+
+                    sequence.generate()
+
+class Test_generate_blocks(unittest.TestCase):
+
+    def setUp(self: 'Test_generate_blocks') -> None:
+
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.arguments = ['--count', '5', '--n', '2', '--length', '20',
+                          '--workers', '1', '--chunk-size', '2',
+                          '--seed', '4']
+
+    def tearDown(self: 'Test_generate_blocks') -> None:
+
+        self.tmp_dir.cleanup()
+
+    def _run(self: 'Test_generate_blocks', name: str,
+             *arguments) -> str:
+        '''Run the command line on an output file in the temporary
+        directory and return its path.'''
+
+        path = os.path.join(self.tmp_dir.name, name)
+
+        with contextlib.redirect_stderr(io.StringIO()):
+
+            GenerateBlocks.main([path] + self.arguments + list(arguments))
+
+        return path
+
+    def _count_matches(self: 'Test_generate_blocks', visual: array,
+                       aural: array) -> dict:
+
+        sequence = MakeStimBuffer.StimSequence(2, 20, {}, {})
+        sequence.buffers = {'visual': visual, 'aural': aural}
+
+        return sequence.count_matches()
+
+    def test_round_trip(self: 'Test_generate_blocks') -> None:
+
+        blocks = list(GenerateBlocks.read_blocks(self._run('blocks.dnb')))
+
+        self.assertEqual(len(blocks), 5)
+
+        for visual, aural, placement in blocks:
+
+            self.assertEqual(len(visual), 22)
+            self.assertEqual(
+                placement.count(MakeStimBuffer.TARGET_FLAGS['both']), 2)
+            # Exact counts are the default.
+            self.assertEqual(self._count_matches(visual, aural),
+                             {'visual': 6, 'aural': 6, 'both': 2})
+
+        self.assertEqual(
+            list(GenerateBlocks.read_blocks(self._run('again.dnb'))), blocks)
+
+        loose = list(GenerateBlocks.read_blocks(
+            self._run('loose.dnb', '--no-exact')))
+
+        self.assertEqual(len(loose), 5)
+
+        for visual, aural, placement in loose:
+
+            counts = self._count_matches(visual, aural)
+
+            self.assertGreaterEqual(counts['visual'], 6)
+            self.assertGreaterEqual(counts['aural'], 6)
+
+    @unittest.skipIf(GenerateBlocks.numpy is None, 'numpy not installed')
+    def test_npz_round_trip(self: 'Test_generate_blocks') -> None:
+
+        blocks = list(GenerateBlocks.read_blocks(self._run('blocks.dnb')))
+
+        with GenerateBlocks.numpy.load(self._run('blocks.npz')) as archive:
+
+            self.assertEqual(int(archive['n']), 2)
+            self.assertEqual(archive['visual'].shape, (5, 22))
+
+            for i, (visual, aural, placement) in enumerate(blocks):
+
+                self.assertEqual(archive['visual'][i].tolist(),
+                                 visual.tolist())
+                self.assertEqual(archive['aural'][i].tolist(),
+                                 aural.tolist())
+                self.assertEqual(archive['placement'][i].tolist(),
+                                 placement.tolist())
+
+class Test_stim_pool(unittest.TestCase):
+
+    def setUp(self: 'Test_stim_pool') -> None:
+
+        self.built = []
+        self.pool = StimPool.StimBufferPool(self._build, depth=2)
+
+    def _build(self: 'Test_stim_pool', spec: tuple) -> tuple:
+
+        if spec == 'too many targets':
+
+            raise ValueError('empty range for randrange()')
+
+        self.built.append(spec)
+
+        return (spec, len(self.built))
+
+    def _wait(self: 'Test_stim_pool') -> None:
+        '''Wait for the worker, if any, to finish filling.'''
+
+        worker = self.pool.worker
+
+        if worker is not None:
+
+            worker.join(5)
+
+    def test_prefetch_then_pop(self: 'Test_stim_pool') -> None:
+
+        self.pool.prefetch('spec')
+        self._wait()
+
+        self.assertEqual(len(self.pool), 2)
+        self.assertEqual(self.pool.pop('spec'), ('spec', 1))
+        self.assertEqual((self.pool.hits, self.pool.misses), (1, 0))
+
+    def test_spec_change_drops_pooled(self: 'Test_stim_pool') -> None:
+
+        self.pool.prefetch('old')
+        self._wait()
+        self.pool.prefetch('new')
+        self._wait()
+
+        self.assertEqual([sequence[0] for sequence in self.pool.ready],
+                         ['new', 'new'])
+
+        # Nothing pooled for the old spec any more, so built now.
+        self.assertEqual(self.pool.pop('old'), ('old', 5))
+        self.assertEqual(self.pool.misses, 1)
+
+    def test_clear_drops_build_in_flight(self: 'Test_stim_pool') -> None:
+
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow_build(spec: tuple) -> tuple:
+
+            started.set()
+            release.wait(5)
+
+            return spec
+
+        self.pool.builder = slow_build
+        self.pool.prefetch('spec')
+        started.wait(5)
+        self.pool.clear()
+        release.set()
+        self._wait()
+
+        self.assertEqual(len(self.pool), 0)
+        self.assertIsNone(self.pool.worker)
+
+    def test_builder_error(self: 'Test_stim_pool') -> None:
+
+        self.pool.prefetch('too many targets')
+        self._wait()
+
+        self.assertIsNone(self.pool.worker)
+        self.assertIsInstance(self.pool.error, ValueError)
+        # The caller gets the error when it goes to build.
+        self.assertRaises(ValueError, self.pool.pop, 'too many targets')
+
+        self.pool.clear()
+        self.pool.prefetch('spec')
+        self._wait()
+
+        self.assertIsNone(self.pool.error)
+        self.assertEqual(len(self.pool), 2)
+
+class Test_stim_list_settings(unittest.TestCase):
+
+    def setUp(self: 'Test_stim_list_settings') -> None:
+
+        self.working_folder = os.getcwd()
+        self.folder = tempfile.TemporaryDirectory()
+        os.chdir(self.folder.name)
+        os.mkdir('sounds')
+        os.mkdir('images')
+
+        for i in range(3):
+
+            open(os.path.join('sounds', ('sound' + str(i) + '.wav')),
+                 'wb').close()
+
+        self.app = DummyStimApp()
+        self.stim_list = MakeStimBuffer.StimList(self.app)
+
+    def tearDown(self: 'Test_stim_list_settings') -> None:
+
+        self.stim_list.pool.clear()
+        os.chdir(self.working_folder)
+        self.folder.cleanup()
+
+    def test_unsupported_number_targets(self: 'Test_stim_list_settings'
+                                        ) -> None:
+
+        # No square grid has 10 targets, the stims stay as made for 8.
+        self.app.session_settings.set_number_targets(10)
+        self.stim_list.make_buffer(seed=1)
+
+        self.assertEqual(self.stim_list.how_many_stims,
+                         {'aural': 3, 'visual': 8})
+        self.assertLess(max(self.stim_list.buffers['visual']), 8)
+
+        self.app.session_settings.set_number_targets(16)
+        self.stim_list.make_buffer(seed=1)
+
+        self.assertEqual(self.stim_list.how_many_stims,
+                         {'aural': 3, 'visual': 16})
+
+class Test_block_scoring(unittest.TestCase):
+
+    def test_codes(self: 'Test_block_scoring') -> None:
+
+        symbols = {'visual': array('b', [1, 2, 1, 2, 3]),
+                   'aural': array('b', [0, 0, 0, 0, 0])}
+        pressed = {'visual': bytearray([1, 0, 1, 0, 1]),
+                   'aural': bytearray([0, 0, 1, 0, 0])}
+        scoring = BlockScoring.score_block(symbols, pressed, 2)
+
+        self.assertEqual(list(scoring['visual']), [3, 1, 0, 2, 3])
+        self.assertEqual(list(scoring['aural']), [1, 1, 0, 2, 2])
+        self.assertEqual(BlockScoring.summarize(scoring)['aural'],
+                         {'true positive': 1, 'true negative': 2,
+                          'false negative': 2, 'false positive': 0})
+
+    def test_incremental_matches_batch(self: 'Test_block_scoring') -> None:
+
+        for i in range(200):
+
+            block_n = random.randint(0, 4)
+            block_length = random.randint(1, 40)
+            symbols = dict([[modality, array('b', [random.randrange(3) for j
+                                                   in range(block_length)])]
+                            for modality in BlockScoring.MODALITIES])
+            pressed = dict([[modality, bytearray([random.randrange(2) for j
+                                                  in range(block_length)])]
+                            for modality in BlockScoring.MODALITIES])
+            scorer = BlockScoring.IncrementalScorer(symbols, block_n)
+
+            for j in range(random.randint(0, block_length)):
+
+                scorer.score_next(pressed)
+
+            scorer.finish(pressed)
+
+            self.assertEqual(
+                scorer.get_summary(),
+                BlockScoring.summarize(BlockScoring.score_block(
+                    symbols, pressed, block_n)))
+
+class Test_deadline_schedule(unittest.TestCase):
+
+    def test_lateness_does_not_add_up(self: 'Test_deadline_schedule'
+                                      ) -> None:
+
+        schedule = TrialTiming.DeadlineSchedule(50, 500, 2500)
+        schedule.start(0)
+        events = []
+
+        # Every event is taken 3 ms late, the next deadline must not move.
+        while schedule.peek() is not None:
+
+            events.append(schedule.take((schedule.peek()[2] + 3000000)))
+
+        # Sound, onset and offset of each trial, then the end.
+        self.assertEqual(len(events), 151)
+        self.assertEqual(events[-1], ('end', 50, (50 * 3000000000)))
+        self.assertEqual(set(schedule.onset_errors), {3000000})
+        self.assertEqual(schedule.get_error_stats()['max onset error ms'], 3)
+
+    def test_av_compensation(self: 'Test_deadline_schedule') -> None:
+
+        # Sound heard 30 ms late, so triggered 30 ms before the image.
+        schedule = TrialTiming.DeadlineSchedule(2, 500, 2500, 30000000)
+        schedule.start(0)
+        events = []
+
+        while schedule.peek() is not None:
+
+            events.append(schedule.take(schedule.peek()[2]))
+
+        self.assertEqual(events[:3], [('sound', 0, 0), ('onset', 0, 30000000),
+                                      ('offset', 0, 530000000)])
+        self.assertEqual(events[3], ('sound', 1, 3000000000))
+        self.assertEqual(events[-1], ('end', 2, 6000000000))
+
+        # Sound early instead, it now waits on the image.
+        schedule = TrialTiming.DeadlineSchedule(2, 500, 2500, -10000000)
+        schedule.start(0)
+        self.assertEqual(schedule.take(0), ('onset', 0, 0))
+        self.assertEqual(schedule.take(0), ('sound', 0, 10000000))
+
+    def test_compensation_stays_in_slot(self: 'Test_deadline_schedule'
+                                        ) -> None:
+
+        slot_ns = 3000000000
+
+        for compensation in [(slot_ns - 500000001), (slot_ns - 500000000),
+                             (slot_ns - 1), (slot_ns * 2), (1 - slot_ns),
+                             (-slot_ns * 2)]:
+
+            schedule = TrialTiming.DeadlineSchedule(3, 500, 2500,
+                                                    compensation)
+            schedule.start(0)
+            deadlines = []
+
+            while schedule.peek() is not None:
+
+                kind, index, deadline = schedule.take(schedule.peek()[2])
+                deadlines.append(deadline)
+
+                if kind != 'end':
+
+                    self.assertGreaterEqual(deadline, (index * slot_ns))
+                    self.assertLess(deadline, ((index + 1) * slot_ns))
+
+            self.assertEqual(deadlines, sorted(deadlines))
+            self.assertEqual(deadlines[-1], (3 * slot_ns))
+            # Image shown for the full stim time either way.
+            self.assertEqual((schedule.delays['offset'] -
+                              schedule.delays['onset']), 500000000)
+
+class Test_av_sync_log(unittest.TestCase):
+
+    def test_offsets_and_learning(self: 'Test_av_sync_log') -> None:
+
+        av_sync = TrialTiming.AVSyncLog(4)
+
+        for index, lag in enumerate([20, 25, 21, 90]):
+
+            shown_ns = (index + 1) * 1000000000
+            av_sync.record_visual(index, shown_ns)
+            # A second paint of the same image does not count.
+            av_sync.record_visual(index, (shown_ns + 5000000))
+            av_sync.record_audio(index, shown_ns, (lag * 1000000))
+
+        av_sync.visual_times[3] = 0
+
+        self.assertEqual(list(av_sync.get_offsets()),
+                         [20000000, 25000000, 21000000])
+        self.assertEqual(av_sync.get_stats()['median offset ms'], 21)
+        self.assertEqual(av_sync.learn_compensation(5000000), 26000000)
+
+class Test_keypress_log(unittest.TestCase):
+
+    def test_latencies(self: 'Test_keypress_log') -> None:
+
+        keypress_log = TrialTiming.KeypressLog(2, presses_per_trial=2)
+        keypress_log.record(0, 0, 400, 100)
+        keypress_log.record(0, 0, 500, 100)
+        keypress_log.record(0, 1, 350, 100)
+        keypress_log.record(1, 0, 1200, 1000)
+        keypress_log.record(1, 1, 1300, 1000)
+
+        self.assertEqual(keypress_log.get_latencies('visual'), [300, 200])
+        self.assertEqual(keypress_log.get_latencies('visual', False),
+                         [300, 400, 200])
+        self.assertEqual(keypress_log.dropped, 1)
+
+class Test_asset_registry(unittest.TestCase):
+
+    def test_decode_once_and_invalidate(self: 'Test_asset_registry') -> None:
+
+        registry = AssetRegistry.AssetRegistry()
+        decoded = []
+
+        with tempfile.TemporaryDirectory() as folder:
+
+            path = os.path.join(folder, 'screen0.png')
+
+            with open(path, 'wb') as asset_file:
+
+                asset_file.write(b'not really a png')
+
+            first = registry.get(path, decoded.append)
+            second = registry.get(path, decoded.append)
+            registry.invalidate(folder)
+            registry.get(path, decoded.append)
+
+        self.assertIs(first, second)
+        self.assertEqual(len(decoded), 2)
+        self.assertEqual(registry.get_stats()['hits'], 1)
+        self.assertEqual(registry.get_stats()['misses'], 2)
+
+    def test_memory_ceiling(self: 'Test_asset_registry') -> None:
+
+        registry = AssetRegistry.AssetRegistry(memory_ceiling=100)
+
+        with tempfile.TemporaryDirectory() as folder:
+
+            for i in range(5):
+
+                path = os.path.join(folder, ('sound' + str(i) + '.wav'))
+                open(path, 'wb').close()
+                registry.get(path, str, lambda asset: 40)
+
+        self.assertEqual(registry.get_stats()['assets held'], 2)
+        self.assertEqual(registry.get_stats()['memory used'], 80)
+
+class Test_audio_engine(unittest.TestCase):
+
+    def setUp(self: 'Test_audio_engine') -> None:
+
+        self.folder = tempfile.TemporaryDirectory()
+        self.sound_folder = os.path.join(self.folder.name, 'sounds')
+        os.mkdir(self.sound_folder)
+        os.mkdir(os.path.join(self.folder.name, 'images'))
+
+        # Two short stereo sounds, constant level so easy to spot.
+        for i, level in enumerate([1000, 30000]):
+
+            wav_file = wave.open(os.path.join(self.sound_folder,
+                                              ('sound' + str(i) + '.wav')),
+                                 'wb')
+            wav_file.setnchannels(AudioEngine.CHANNELS)
+            wav_file.setsampwidth(AudioEngine.SAMPLE_WIDTH)
+            wav_file.setframerate(AudioEngine.SAMPLE_RATE)
+            wav_file.writeframes(array('h', [level] * 200).tobytes())
+            wav_file.close()
+
+        self.bank = AudioEngine.PcmBank(self.sound_folder)
+        # Clock stands still, so nothing is ever played.
+        self.backend = AudioEngine.NullAudioBackend(buffer_frames=441,
+                                                    clock=lambda: 0)
+        self.engine = AudioEngine.AudioEngine(self.bank, self.backend)
+
+    def tearDown(self: 'Test_audio_engine') -> None:
+
+        self.folder.cleanup()
+
+    def test_stim_list_first(self: 'Test_audio_engine') -> None:
+
+        # The application makes its QSound objects before the engine, from
+        # the same files, through the same registry.
+        working_folder = os.getcwd()
+        os.chdir(self.folder.name)
+
+        try:
+
+            stim_list = MakeStimBuffer.StimList(DummyStimApp())
+            bank = AudioEngine.PcmBank('sounds/')
+
+        finally:
+
+            os.chdir(working_folder)
+
+        self.assertEqual(len(stim_list.all_sound_targets), 2)
+        self.assertIsInstance(bank[0], array)
+
+        engine = AudioEngine.AudioEngine(bank, self.backend)
+        engine.start()
+        engine.trigger(1, start_frame=441)
+
+        self.assertEqual(array('h', engine.render(1))[0], 30000)
+
+    def test_trigger_at_offset(self: 'Test_audio_engine') -> None:
+
+        self.engine.start()
+        # Buffer already filled, so the earliest it can go is frame 441.
+        latency = self.engine.trigger(0, start_frame=10)
+        self.assertEqual(latency, (441 * 1000000000) // 44100)
+
+        mixed = array('h', self.engine.render(200))
+        self.assertEqual(mixed[:200], array('h', [1000] * 200))
+        self.assertEqual(mixed[200:], array('h', [0] * 200))
+
+    def test_mix_clips(self: 'Test_audio_engine') -> None:
+
+        self.engine.start()
+        self.engine.trigger(0)
+        self.engine.trigger(1)
+        self.engine.trigger(1, start_frame=(self.engine.frames_written + 50))
+
+        mixed = array('h', self.engine.render(100))
+        self.assertEqual(mixed[0], 31000)
+        self.assertEqual(mixed[100], 32767)
+        # Sounds are 100 frames long, only the late one is left playing.
+        self.assertEqual(len(self.engine.voices), 1)
+        self.engine.render(100)
+        self.assertEqual(len(self.engine.voices), 0)
+
+    def test_file_sink(self: 'Test_audio_engine') -> None:
+
+        path = os.path.join(self.folder.name, 'out.wav')
+        engine = AudioEngine.AudioEngine(
+            self.bank, AudioEngine.FileSinkBackend(path, buffer_frames=441,
+                                                   clock=lambda: 0))
+        engine.start()
+        engine.trigger(1)
+        engine.stop()
+
+        with wave.open(path, 'rb') as wav_file:
+
+            self.assertEqual(wav_file.getnframes(), 441)
+
+class DummyImageApp(object):
+    '''Just the settings and screen size the image renderer reads.'''
+
+    def __init__(self: 'DummyImageApp') -> None:
+
+        self.session_settings = self
+        self.screen_dimensions = (300, 150)
+
+    def get_bg_colour(self: 'DummyImageApp') -> tuple:
+
+        return (0, 0, 0)
+
+    def get_fx_colour(self: 'DummyImageApp') -> tuple:
+
+        return (255, 255, 255)
+
+    def get_tg_colour(self: 'DummyImageApp') -> tuple:
+
+        return (0, 0, 255)
+
+    def get_number_targets(self: 'DummyImageApp') -> int:
+
+        return 8
+
+
+class Test_grid_layout(unittest.TestCase):
+
+    def test_grid_sizes(self: 'Test_grid_layout') -> None:
+
+        self.assertEqual(MakeImages.get_grid_size(8), 3)
+        self.assertEqual(MakeImages.get_grid_size(16), 4)
+        self.assertEqual(MakeImages.get_grid_size(24), 5)
+
+        for bad_count in [0, 9, 10, 15]:
+
+            self.assertRaises(ValueError, MakeImages.get_grid_size,
+                              bad_count)
+
+    def test_locations(self: 'Test_grid_layout') -> None:
+
+        self.assertEqual(MakeImages.get_target_locations(8),
+                         [0, 1, 2, 3, 5, 6, 7, 8])
+        self.assertEqual(MakeImages.get_neutral_location(16), 16)
+        self.assertEqual(MakeImages.get_target_locations(16),
+                         list(range(16)))
+        self.assertEqual(MakeImages.get_neutral_location(24), 12)
+
+    def test_layout_table(self: 'Test_grid_layout') -> None:
+
+        app = DummyImageApp()
+        app.get_number_targets = lambda: 16
+        image_set = MakeImages.ImageSet(app)
+        rects = image_set.get_target_rects()
+
+        self.assertEqual(len(rects), 16)
+        self.assertIsNone(image_set.layout_table[16])
+        # Same size squares, one cell apart along a row and down a column.
+        self.assertEqual(len(set([rect[2:] for rect in rects])), 1)
+        self.assertEqual(rects[1][0] - rects[0][0], 74)
+        self.assertEqual(rects[4][1] - rects[0][1], 37)
+
+    def test_cache_key(self: 'Test_grid_layout') -> None:
+
+        red_app = DummyImageApp()
+        red_app.get_tg_colour = lambda: (255, 0, 0)
+        blue = MakeImages.ImageSet(DummyImageApp())
+        red = MakeImages.ImageSet(red_app)
+
+        self.assertNotEqual(blue.get_cache_key(), red.get_cache_key())
+        # The neutral screen has no target on it to colour.
+        self.assertEqual(blue.get_cache_key(base_only=True),
+                         red.get_cache_key(base_only=True))
+
+@unittest.skipIf(MakeImages.numpy is None, 'numpy not installed')
+class Test_render_images(unittest.TestCase):
+
+    def test_render_set(self: 'Test_render_images') -> None:
+
+        image_set = MakeImages.ImageSet(DummyImageApp())
+        rendered = image_set.render_set_of_images()
+
+        self.assertEqual(len(rendered), 9)
+        self.assertEqual(rendered[0].shape, (150, 300, 3))
+        # Centre of the cross, then the first target square and the same
+        # spot left blank on the neutral screen.
+        self.assertEqual(list(rendered[4][75, 150]), [255, 255, 255])
+        self.assertEqual(list(rendered[0][20, 30]), [0, 0, 255])
+        self.assertEqual(list(rendered[4][20, 30]), [0, 0, 0])
+
+    def test_parallel_matches_serial(self: 'Test_render_images') -> None:
+
+        image_set = MakeImages.ImageSet(DummyImageApp())
+        serial = image_set.render_set_of_images()
+        threshold = MakeImages.PARALLEL_MIN_PIXELS
+
+        try:
+
+            MakeImages.PARALLEL_MIN_PIXELS = 0
+            parallel = image_set.render_set_of_images(workers=4)
+
+        finally:
+
+            MakeImages.PARALLEL_MIN_PIXELS = threshold
+
+        for location in range(9):
+
+            self.assertTrue((serial[location] == parallel[location]).all())
+
+        self.assertEqual(sorted(image_set.timings), list(range(9)))
+
+    def test_bigger_grid(self: 'Test_render_images') -> None:
+
+        app = DummyImageApp()
+        app.get_number_targets = lambda: 24
+        image_set = MakeImages.ImageSet(app)
+        rendered = image_set.render_set_of_images()
+        x, y, width, height = image_set.get_target_rects()[-1]
+
+        self.assertEqual(len(rendered), 25)
+        self.assertTrue((rendered[24][y:(y + height), x:(x + width)] ==
+                         [0, 0, 255]).all())
+        self.assertFalse((rendered[12] == [0, 0, 255]).all(axis=2).any())
+
+    def test_target_rects_match_render(self: 'Test_render_images') -> None:
+
+        image_set = MakeImages.ImageSet(DummyImageApp())
+        rendered = image_set.render_set_of_images()
+        rects = image_set.get_target_rects()
+
+        # Neutral location skipped, so rect 4 is location 5.
+        self.assertEqual(len(rects), 8)
+
+        for rect, location in [[rects[0], 0], [rects[4], 5]]:
+
+            x, y, width, height = rect
+            square = rendered[location][y:(y + height), x:(x + width)]
+            self.assertTrue((square == [0, 0, 255]).all())
+            self.assertEqual(list(rendered[location][y, (x + width)]),
+                             [0, 0, 0])
+
+@unittest.skipIf(MakeImages.numpy is None, 'numpy not installed')
+class Test_render_cache(unittest.TestCase):
+
+    def test_reuse_and_trim(self: 'Test_render_cache') -> None:
+
+        with tempfile.TemporaryDirectory() as folder:
+
+            # Room for two 300 x 150 frames but not three.
+            cache = MakeImages.RenderCache(folder, size_budget=300000)
+            app = DummyImageApp()
+            first = MakeImages.ImageSet(app).render_set_of_images(True, cache)
+            again = MakeImages.ImageSet(app).render_set_of_images(True, cache)
+
+            self.assertEqual(cache.get_stats(), {'hits': 1, 'misses': 1})
+            self.assertTrue((first[4] == again[4]).all())
+
+            # The neutral screen is the same whatever the target colour.
+            app.get_tg_colour = lambda: (255, 0, 0)
+            MakeImages.ImageSet(app).render_set_of_images(True, cache)
+
+            self.assertEqual(cache.get_stats(), {'hits': 2, 'misses': 1})
+
+            # Different colours, different key.
+            first_key = MakeImages.ImageSet(app).get_cache_key(True)
+
+            # Sleeps keep file times apart on coarse clock file systems.
+            for level in [10, 20]:
+
+                time.sleep(0.05)
+                app.get_bg_colour = lambda: (level, level, level)
+                MakeImages.ImageSet(app).render_set_of_images(True, cache)
+
+            self.assertEqual(cache.get_stats()['misses'], 3)
+            self.assertEqual(len(os.listdir(folder)), 2)
+            # Oldest went first.
+            self.assertIsNone(cache.load(first_key, 4))
+
+class Test_event_log(unittest.TestCase):
+
+    def test_subscribe_and_write(self: 'Test_event_log') -> None:
+
+        with tempfile.TemporaryDirectory() as folder:
+
+            path = os.path.join(folder, 'events.jsonl')
+            event_log = EventLog.EventLog(path)
+            seen = []
+            event_log.subscribe(seen.append)
+            event_log.log('message', text='hello')
+            event_log.log('block results', symbols=array('b', [3, 1, 4]),
+                          pressed=bytearray(b'\x00\x01'))
+            event_log.close()
+
+            with open(path) as log_file:
+
+                events = [json.loads(line) for line in log_file]
+
+        self.assertEqual([event['kind'] for event in seen],
+                         ['message', 'block results'])
+        self.assertEqual(events[0]['text'], 'hello')
+        self.assertEqual(events[1]['symbols'], [3, 1, 4])
+        self.assertEqual(events[1]['pressed'], [0, 1])
+
+    def test_read_lines_from_end(self: 'Test_event_log') -> None:
+
+        with tempfile.TemporaryDirectory() as folder:
+
+            path = os.path.join(folder, 'lines.txt')
+
+            with open(path, 'w') as text_file:
+
+                for index in range(1000):
+
+                    text_file.write(str(index) + '\n')
+
+            old_block = EventLog.READ_BLOCK
+            EventLog.READ_BLOCK = 7
+
+            try:
+
+                self.assertEqual(EventLog.read_lines_from_end(path, 0, 3),
+                                 ['997', '998', '999'])
+                self.assertEqual(EventLog.read_lines_from_end(path, 10, 2),
+                                 ['988', '989'])
+                self.assertEqual(EventLog.read_lines_from_end(path, 998, 5),
+                                 ['0', '1'])
+                self.assertEqual(EventLog.read_lines_from_end(path, 1000, 5),
+                                 [])
+
+            finally:
+
+                EventLog.READ_BLOCK = old_block
+
+            self.assertEqual(EventLog.read_lines_from_end(
+                os.path.join(folder, 'missing.txt'), 0, 5), [])
+
+    def test_read_before_and_after(self: 'Test_event_log') -> None:
+
+        with tempfile.TemporaryDirectory() as folder:
+
+            path = os.path.join(folder, 'events.jsonl')
+            earlier_session = EventLog.EventLog(path)
+            earlier_session.log('message', text='earlier')
+            earlier_session.close()
+
+            event_log = EventLog.EventLog(path)
+
+            for index in range(10):
+
+                event_log.log('message', text=str(index))
+
+            while event_log.events_written < 10:
+
+                time.sleep(0.01)
+
+            self.assertEqual([event['text'] for event in
+                              event_log.read_before(3, 2)], ['1', '2'])
+            self.assertEqual([event['text'] for event in
+                              event_log.read_before(1, 5)],
+                             ['earlier', '0'])
+            self.assertEqual([event['text'] for event in
+                              event_log.read_after(6, 2)], ['7', '8'])
+            self.assertEqual([event['text'] for event in
+                              event_log.read_after(7, 5)], ['8', '9'])
+            self.assertEqual(event_log.read_after(9, 5), [])
+            event_log.close()
+
+    def test_rotation_and_read_range(self: 'Test_event_log') -> None:
+
+        with tempfile.TemporaryDirectory() as folder:
+
+            path = os.path.join(folder, 'events.jsonl')
+            event_log = EventLog.EventLog(path, segment_bytes=400)
+            logged = []
+
+            for index in range(40):
+
+                event_log.user = ['ann', 'bob'][((index // 5) % 2)]
+                logged.append(event_log.log('message', text=str(index)))
+                # Segments are named by their first time, keep them apart.
+                time.sleep(0.002)
+
+            event_log.close()
+
+            segments = glob.glob(os.path.join(folder, 'events-*'))
+
+            self.assertGreater(len(segments), 1)
+            self.assertTrue(all([segment.endswith('.jsonl.gz')
+                                 for segment in segments]))
+
+            ann_texts = [event['text'] for event in logged
+                         if event['user'] == 'ann']
+
+            self.assertEqual([event['text'] for event in
+                              EventLog.read_range(path, '0', '9',
+                                                  user='ann')], ann_texts)
+
+            in_range = EventLog.read_range(path, logged[12]['time'],
+                                           logged[27]['time'])
+
+            self.assertEqual([event['text'] for event in in_range],
+                             [str(index) for index in range(12, 27)])
+
+    def test_summarize_event(self: 'Test_event_log') -> None:
+
+        event = {'time': '12:00', 'kind': 'block results', 'seq': 4,
+                 'presented': [1, 2], 'note': ('x' * 500)}
+        summary = EventLog.summarize_event(event)
+
+        self.assertTrue(summary.startswith('12:00: block results '
+                                           'presented=[1, 2], note='))
+        self.assertEqual(len(summary), EventLog.SUMMARY_WIDTH)
+        self.assertEqual(EventLog.summarize_event({'time': '12:00',
+                                                   'kind': 'message',
+                                                   'text': 'a\nb'}),
+                         '12:00: a b')
+
+class Test_log_window(unittest.TestCase):
+
+    def test_close_then_log(self: 'Test_log_window') -> None:
+
+        app = QtGui.QApplication.instance() or QtGui.QApplication(sys.argv)
+
+        with tempfile.TemporaryDirectory() as folder:
+
+            path = os.path.join(folder, 'events.jsonl')
+            event_log = EventLog.EventLog(path)
+            window = DualNBack.LogWindow(event_log)
+            # Closing the window only hides it, the log carries on.
+            window.closeEvent(QtGui.QCloseEvent())
+            event_log.log('message', text='after close')
+            window.closeEvent(QtGui.QCloseEvent())
+
+            self.assertTrue(event_log.writer.is_alive())
+            self.assertEqual(window.event_model.rows[-1][1]['text'],
+                             'after close')
+
+            window.end_session()
+            window.end_session()
+            event_log.unsubscribe(window.event_model.add_event)
+            event_log.close()
+
+            with open(path) as log_file:
+
+                texts = [json.loads(line).get('text') for line in log_file]
+
+        self.assertEqual(texts, ['--------begin session--------',
+                                 'after close',
+                                 '---------end session---------'])
+        self.assertEqual(event_log.subscribers, [])
+
+    def test_page_newer_with_writer_behind(self: 'Test_log_window'
+                                           ) -> None:
+
+        with tempfile.TemporaryDirectory() as folder:
+
+            event_log = EventLog.EventLog(os.path.join(folder,
+                                                       'events.jsonl'))
+            model = DualNBack.EventListModel(event_log, history_size=10,
+                                             page_size=5)
+
+            for index in range(30):
+
+                event_log.log('message', text=str(index))
+
+            while event_log.events_written < 30:
+
+                time.sleep(0.01)
+
+            model.page_older()
+            # The writer waits on its queue, new events go to another one.
+            write_queue = event_log.write_queue
+            event_log.write_queue = queue.Queue()
+
+            try:
+
+                for index in range(30, 33):
+
+                    event_log.log('message', text=str(index))
+
+                self.assertEqual(model.page_newer(), 5)
+                self.assertFalse(model.following)
+                self.assertEqual(model.page_newer(), 3)
+                self.assertTrue(model.following)
+
+                event_log.log('message', text='33')
+
+            finally:
+
+                held_queue = event_log.write_queue
+                event_log.write_queue = write_queue
+
+                while not held_queue.empty():
+
+                    write_queue.put(held_queue.get())
+
+                event_log.close()
+
+        self.assertEqual([row[0] for row in model.rows], list(range(24, 34)))
+        self.assertEqual([row[1]['text'] for row in model.rows],
+                         [str(seq) for seq in range(24, 34)])
+
+class Test_user_database(unittest.TestCase):
+
+    def setUp(self: 'Test_user_database') -> None:
+
+        self.folder = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.folder.name, 'users.db')
+
+    def tearDown(self: 'Test_user_database') -> None:
+
+        self.folder.cleanup()
+
+    def _block_results(self: 'Test_user_database') -> tuple:
+        '''Return results and a keypress log as TaskWindow leaves them.'''
+
+        symbols = {'visual': array('b', [1, 2, 1, 3]),
+                   'aural': array('b', [4, 4, 5, 4])}
+        pressed = {'visual': bytearray(b'\x00\x00\x01\x00'),
+                   'aural': bytearray(b'\x00\x01\x00\x00')}
+        keypress_log = TrialTiming.KeypressLog(4)
+        keypress_log.record(2, 0, 2500, 2000)
+        keypress_log.record(2, 0, 2700, 2000)
+        keypress_log.record(1, 1, 1300, 1000)
+        scoring = BlockScoring.score_block(symbols, pressed, 2)
+        results = {'presented': types.SimpleNamespace(
+                       visual_symbols=symbols['visual'],
+                       aural_symbols=symbols['aural']),
+                   'recorded': pressed,
+                   'scoring': scoring,
+                   'score summary': BlockScoring.summarize(scoring),
+                   'reaction times': dict(
+                       [[modality, BlockScoring.reaction_time_stats(
+                           keypress_log.get_latencies(modality))]
+                        for modality in BlockScoring.MODALITIES]),
+                   'onset errors': array('q', [10, 20, 30, 40]),
+                   'timing': {'mean onset error ms': 0.000025}}
+
+        return results, keypress_log
+
+    def test_save_and_read_block(self: 'Test_user_database') -> None:
+
+        database = NBackUserDatabase.NBackUserDatabase(self.path)
+
+        self.assertRaises(NBackUserDatabase.NoSuchUserError,
+                          database.get_user, 'ann')
+
+        user_id = database.add_user('ann')
+
+        self.assertEqual(database.get_user('ann')['user_id'], user_id)
+
+        session_id = database.start_session(user_id)
+        results, keypress_log = self._block_results()
+        database.add_block(
+            session_id, NBackUserDatabase.get_block_record(results, 1, 2,
+                                                           500, 2500),
+            NBackUserDatabase.get_trial_rows(results, keypress_log))
+        database.end_session(session_id)
+
+        # Queued writes are committed before reading.
+        history = database.get_block_history(user_id)
+        block_id = history[0]['block_id']
+
+        self.assertEqual(len(history), 1)
+        self.assertEqual(history[0]['visual_true_positive'], 1)
+        self.assertEqual(history[0]['aural_false_positive'], 1)
+        self.assertEqual(database.get_block_history(user_id, until='2000'),
+                         [])
+
+        trials = database.get_trials(block_id)
+
+        self.assertEqual([trial['visual_symbol'] for trial in trials],
+                         [1, 2, 1, 3])
+        self.assertEqual([trial['visual_latency_ns'] for trial in trials],
+                         [None, None, 500, None])
+        self.assertEqual([trial['aural_latency_ns'] for trial in trials],
+                         [None, 300, None, None])
+        self.assertEqual([trial['onset_error_ns'] for trial in trials],
+                         [10, 20, 30, 40])
+        database.close()
+
+    def test_block_is_one_transaction(self: 'Test_user_database') -> None:
+
+        database = NBackUserDatabase.NBackUserDatabase(self.path)
+        session_id = database.start_session(database.add_user('ann'))
+        results, keypress_log = self._block_results()
+        trials = NBackUserDatabase.get_trial_rows(results, keypress_log)
+
+        # A repeated trial breaks the primary key part way through.
+        database.add_block(session_id,
+                           NBackUserDatabase.get_block_record(results, 1, 2,
+                                                              500, 2500),
+                           (trials + trials[:1]))
+        database.add_block(session_id,
+                           NBackUserDatabase.get_block_record(results, 2, 2,
+                                                              500, 2500),
+                           trials)
+
+        self.assertRaises(sqlite3.IntegrityError, database.commit)
+
+        # Only the broken block is left out of the batch.
+        history = database.get_block_history(
+            database.get_user('ann')['user_id'])
+
+        self.assertEqual([block['block_number'] for block in history], [2])
+        self.assertEqual(len(database.get_trials(history[0]['block_id'])),
+                         4)
+        database.close()
+
+    def test_batched_commits(self: 'Test_user_database') -> None:
+
+        database = NBackUserDatabase.NBackUserDatabase(self.path,
+                                                       batch_rows=12,
+                                                       batch_seconds=3600)
+        session_id = database.start_session(database.add_user('ann'))
+        results, keypress_log = self._block_results()
+        block = NBackUserDatabase.get_block_record(results, 1, 2, 500, 2500)
+        trials = NBackUserDatabase.get_trial_rows(results, keypress_log)
+        other_kiosk = sqlite3.connect(self.path)
+        count_blocks = 'select count(*) from blocks'
+
+        self.assertEqual(database.db_connection.execute(
+            'pragma journal_mode').fetchone()[0], 'wal')
+
+        # Five rows a block, so committed with the third.
+        database.add_block(session_id, block, trials)
+        database.add_block(session_id, block, trials)
+
+        self.assertEqual(other_kiosk.execute(count_blocks).fetchone()[0], 0)
+
+        commits = database.get_commit_stats()['count']
+        database.add_block(session_id, block, trials)
+
+        self.assertEqual(other_kiosk.execute(count_blocks).fetchone()[0], 3)
+        self.assertEqual(database.get_commit_stats()['count'],
+                         (commits + 1))
+        other_kiosk.close()
+        database.close()
+
+    def test_locked_batch_kept(self: 'Test_user_database') -> None:
+
+        old_timeout = NBackUserDatabase.BUSY_TIMEOUT_MS
+        NBackUserDatabase.BUSY_TIMEOUT_MS = 50
+
+        try:
+
+            database = NBackUserDatabase.NBackUserDatabase(
+                self.path, batch_seconds=3600)
+
+        finally:
+
+            NBackUserDatabase.BUSY_TIMEOUT_MS = old_timeout
+
+        user_id = database.add_user('ann')
+        session_id = database.start_session(user_id)
+        results, keypress_log = self._block_results()
+        database.add_block(session_id,
+                           NBackUserDatabase.get_block_record(results, 1, 2,
+                                                              500, 2500),
+                           NBackUserDatabase.get_trial_rows(results,
+                                                            keypress_log))
+        database.end_session(session_id)
+
+        # Another kiosk holds the write lock past the busy timeout.
+        other_kiosk = sqlite3.connect(self.path, isolation_level=None)
+        other_kiosk.execute('begin immediate')
+
+        self.assertRaises(sqlite3.OperationalError, database.commit)
+        self.assertEqual(len(database.connections.pending), 2)
+
+        other_kiosk.execute('rollback')
+        other_kiosk.close()
+        database.commit()
+
+        self.assertEqual(len(database.connections.pending), 0)
+        self.assertEqual(len(database.get_block_history(user_id)), 1)
+        self.assertIsNotNone(database.db_connection.execute(
+            'select ended from sessions').fetchone()[0])
+        database.close()
+
+    def test_latency_histogram(self: 'Test_user_database') -> None:
+
+        histogram = NBackUserDatabase.LatencyHistogram(bucket_count=4)
+
+        for latency_ns in [500, 1500, 3000, 3500, 50000]:
+
+            histogram.record(latency_ns)
+
+        stats = histogram.get_stats()
+
+        self.assertEqual(stats['count'], 5)
+        self.assertEqual(stats['max ms'], 0.05)
+        self.assertEqual(stats['buckets'], {'under 1 us': 1, 'under 2 us': 1,
+                                            'under 4 us': 2, 'longer': 1})
+
+    def test_legacy_table_kept(self: 'Test_user_database') -> None:
+
+        legacy = sqlite3.connect(self.path)
+        legacy.execute('create table users (user_number integer primary key '
+                       'autoincrement, user_name text, unique_id text, '
+                       'user_trivia blob, last_session_stats blob, '
+                       'full_history blob)')
+        legacy.execute('insert into users (user_name) values (\'old\')')
+        legacy.commit()
+        legacy.close()
+
+        database = NBackUserDatabase.NBackUserDatabase(self.path)
+
+        self.assertEqual(database.db_connection.execute(
+            'select user_name from legacy_users').fetchall()[0][0], 'old')
+        self.assertRaises(NBackUserDatabase.NoSuchUserError,
+                          database.get_user, 'old')
+        database.close()
+
+        # Opening again leaves it be.
+        NBackUserDatabase.NBackUserDatabase(self.path).close()
+
 if __name__ == '__main__':
 
     unittest.main(exit=False)
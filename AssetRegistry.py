@@ -0,0 +1,124 @@
+'''Process wide registry of decoded image and sound assets.'''
+
+import collections
+import os
+import os.path
+import threading
+
+
+class AssetRegistry(object):
+    '''Decodes each asset file once and hands out the same object to every
+    caller after that.  Entries are keyed by file path and loader, so the
+    same file decoded two ways (say a QSound and raw PCM samples) is held as
+    two assets, and checked against the file modification time, so a
+    changed file is decoded again.
+
+    Once the estimated size of all held assets passes memory_ceiling (in
+    bytes) the least recently used assets are let go.  Anyone still holding
+    one keeps a working object, the registry just decodes it again if it is
+    asked for later.'''
+
+    def __init__(self: 'AssetRegistry',
+                 memory_ceiling: int=(256 * 1024 * 1024)) -> None:
+
+        self.memory_ceiling = memory_ceiling
+        self.memory_used = 0
+        self.hits = 0
+        self.misses = 0
+        # (path, loader): [modification time, asset, estimated size in
+        # bytes]
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self: 'AssetRegistry', path: str, loader: 'callable',
+            size_of: 'callable'=None) -> object:
+        '''Return the asset at path, calling loader(path) to decode it only
+        if it is not already held.  size_of(asset) estimates the memory the
+        decoded asset uses, the file size is used if not given.'''
+
+        key = (os.path.normpath(path), loader)
+        modified = os.stat(key[0]).st_mtime_ns
+
+        with self.lock:
+
+            entry = self.entries.get(key)
+
+            if ((entry is not None) and (entry[0] == modified)):
+
+                self.hits = self.hits + 1
+                self.entries.move_to_end(key)
+                return entry[1]
+
+            self.misses = self.misses + 1
+
+        asset = loader(path)
+
+        if size_of is None:
+
+            size = os.path.getsize(key[0])
+
+        else:
+
+            size = size_of(asset)
+
+        with self.lock:
+
+            self._forget(key)
+            self.entries[key] = [modified, asset, size]
+            self.memory_used = self.memory_used + size
+            self._trim()
+
+        return asset
+
+    def invalidate(self: 'AssetRegistry', directory: str=None) -> None:
+        '''Forget every asset under directory, or every asset at all if no
+        directory given.  Call after regenerating asset files.'''
+
+        with self.lock:
+
+            if directory is None:
+
+                self.entries.clear()
+                self.memory_used = 0
+                return
+
+            prefix = os.path.normpath(directory) + os.sep
+
+            for key in list(self.entries):
+
+                if key[0].startswith(prefix):
+
+                    self._forget(key)
+
+    def get_stats(self: 'AssetRegistry') -> dict:
+        '''Return hit and miss counts along with present memory use.'''
+
+        with self.lock:
+
+            return {'hits': self.hits, 'misses': self.misses,
+                    'assets held': len(self.entries),
+                    'memory used': self.memory_used,
+                    'memory ceiling': self.memory_ceiling}
+
+    def _forget(self: 'AssetRegistry', key: tuple) -> None:
+        '''Drop one entry if held, caller must hold the lock.'''
+
+        entry = self.entries.pop(key, None)
+
+        if entry is not None:
+
+            self.memory_used = self.memory_used - entry[2]
+
+    def _trim(self: 'AssetRegistry') -> None:
+        '''Let go of least recently used assets until under the memory
+        ceiling, caller must hold the lock.  The newest asset is always
+        kept.'''
+
+        while ((self.memory_used > self.memory_ceiling) and
+               (len(self.entries) > 1)):
+
+            self._forget(next(iter(self.entries)))
+
+
+# The one registry for the whole process.
+registry = AssetRegistry()
@@ -0,0 +1,419 @@
+'''Preloaded, low latency audio for the task window.
+
+Every sound is decoded to PCM once and kept in memory.  During a block one
+output stream stays open, and each trial's sound is mixed into that stream
+from memory at a given sample offset, rather than starting a fresh QSound
+that has to open the file and the device each time.
+
+All sounds are converted to 16 bit stereo at 44.1 kHz.  Plain PCM wav files
+in that format need nothing extra.  Anything else, like the mp3 data in most
+of sounds/, needs the optional miniaudio package to decode.'''
+
+import os
+import os.path
+import struct
+import sys
+import time
+import wave
+from array import array
+import AssetRegistry
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import miniaudio
+except ImportError:
+    miniaudio = None
+
+SAMPLE_RATE = 44100
+CHANNELS = 2
+SAMPLE_WIDTH = 2  # bytes, signed 16 bit samples
+FRAME_BYTES = CHANNELS * SAMPLE_WIDTH
+
+WAVE_FORMAT_PCM = 1
+WAVE_FORMAT_MPEGLAYER3 = 85
+
+
+def _read_wav_chunks(path: str) -> tuple:
+    '''Return (format tag, channels, sample rate, bits per sample, data
+    chunk bytes) of a RIFF wav file, whatever its encoding.'''
+
+    with open(path, 'rb') as wav_file:
+
+        contents = wav_file.read()
+
+    if ((contents[:4] != b'RIFF') or (contents[8:12] != b'WAVE')):
+
+        raise ValueError(path + ' is not a wav file.')
+
+    chunk_start = 12
+    wav_format = None
+    data = None
+
+    while chunk_start + 8 <= len(contents):
+
+        chunk_id = contents[chunk_start:(chunk_start + 4)]
+        chunk_size = struct.unpack(
+            '<I', contents[(chunk_start + 4):(chunk_start + 8)])[0]
+        chunk_body = contents[(chunk_start + 8):
+                              (chunk_start + 8 + chunk_size)]
+
+        if chunk_id == b'fmt ':
+
+            tag, channels, rate, byte_rate, align, bits = struct.unpack(
+                '<HHIIHH', chunk_body[:16])
+            wav_format = (tag, channels, rate, bits)
+
+        elif chunk_id == b'data':
+
+            data = chunk_body
+
+        # Chunks are padded out to an even length.
+        chunk_start = chunk_start + 8 + chunk_size + (chunk_size % 2)
+
+    if ((wav_format is None) or (data is None)):
+
+        raise ValueError(path + ' is missing its format or data.')
+
+    return wav_format + (data,)
+
+
+def decode_wav(path: str) -> array:
+    '''Return the sound in path as interleaved 16 bit stereo samples at
+    SAMPLE_RATE.  Raises ValueError if it cannot be decoded here.'''
+
+    tag, channels, rate, bits, data = _read_wav_chunks(path)
+
+    if ((tag == WAVE_FORMAT_PCM) and (channels == CHANNELS) and
+        (rate == SAMPLE_RATE) and (bits == (SAMPLE_WIDTH * 8))):
+
+        samples = array('h', data[:(len(data) - (len(data) % FRAME_BYTES))])
+
+        # Wav data is little endian.
+        if sys.byteorder == 'big':
+
+            samples.byteswap()
+
+        return samples
+
+    if miniaudio is None:
+
+        raise ValueError(path + ' needs miniaudio to be decoded.')
+
+    if tag == WAVE_FORMAT_MPEGLAYER3:
+
+        # Wav wrapped mp3, hand the decoder the mp3 frames themselves.
+        encoded = data
+
+    elif tag == WAVE_FORMAT_PCM:
+
+        with open(path, 'rb') as wav_file:
+
+            encoded = wav_file.read()
+
+    else:
+
+        raise ValueError(path + ' is in an unsupported wav encoding.')
+
+    decoded = miniaudio.decode(
+        encoded, output_format=miniaudio.SampleFormat.SIGNED16,
+        nchannels=CHANNELS, sample_rate=SAMPLE_RATE)
+
+    return array('h', decoded.samples)
+
+
+class PcmBank(object):
+    '''Every sound in a folder, decoded once.  Sounds are indexed in sorted
+    file name order, the same order the stimulus buffer numbers them in.
+    Decoded sounds are shared through the asset registry.'''
+
+    def __init__(self: 'PcmBank', folder: str='sounds/') -> None:
+
+        self.paths = [os.path.join(folder, file_name) for file_name in
+                      sorted(os.listdir(folder))]
+        self.sounds = [AssetRegistry.registry.get(
+                           path, decode_wav,
+                           lambda samples: len(samples) * SAMPLE_WIDTH)
+                       for path in self.paths]
+
+    def __len__(self: 'PcmBank') -> int:
+
+        return len(self.sounds)
+
+    def __getitem__(self: 'PcmBank', index: int) -> array:
+
+        return self.sounds[index]
+
+
+class AudioEngine(object):
+    '''Mixes PcmBank sounds into one continuously open output stream.
+
+    The backend is asked how many frames it wants and is written that many
+    frames of the mix by pump.  Positions in the stream are counted in frames
+    from when it was started.'''
+
+    def __init__(self: 'AudioEngine', bank: PcmBank,
+                 backend: object) -> None:
+
+        self.bank = bank
+        self.backend = backend
+        # [first frame, samples] for every sound still to finish playing.
+        self.voices = []
+        self.frames_written = 0
+        self.running = False
+
+    def start(self: 'AudioEngine') -> None:
+        '''Open the output stream, it stays open until stop.'''
+
+        self.voices = []
+        self.frames_written = 0
+        self.backend.open(SAMPLE_RATE, CHANNELS, SAMPLE_WIDTH, self.pump)
+        self.running = True
+        self.pump()
+
+    def stop(self: 'AudioEngine') -> None:
+
+        if self.running:
+
+            self.backend.close()
+
+        self.running = False
+        self.voices = []
+
+    def trigger(self: 'AudioEngine', sound_index: int,
+                start_frame: int=None) -> int:
+        '''Start a sound at start_frame of the stream, or as soon as it can
+        be if not given or already past.  Returns the expected time until it
+        is heard, in nanoseconds, from the backend's count of played frames.
+        '''
+
+        if ((start_frame is None) or (start_frame < self.frames_written)):
+
+            start_frame = self.frames_written
+
+        self.voices.append([start_frame, self.bank[sound_index]])
+        # Get it into the device buffer right away.
+        self.pump()
+
+        return (((start_frame - self.backend.get_frames_played()) *
+                 1000000000) // SAMPLE_RATE)
+
+    def pump(self: 'AudioEngine') -> None:
+        '''Give the backend as much of the mix as it wants.'''
+
+        if not self.running:
+
+            return
+
+        frames = self.backend.get_frames_wanted()
+
+        if frames > 0:
+
+            self.backend.write(self.render(frames))
+
+    def render(self: 'AudioEngine', frames: int) -> bytes:
+        '''Mix the next frames of the stream and move the stream on.'''
+
+        first_frame = self.frames_written
+        end_frame = first_frame + frames
+        mixed = array('h', bytes(frames * FRAME_BYTES))
+        silent = True
+
+        for voice_start, samples in self.voices:
+
+            voice_end = voice_start + (len(samples) // CHANNELS)
+            overlap_start = max(voice_start, first_frame)
+            overlap_end = min(voice_end, end_frame)
+
+            if overlap_start >= overlap_end:
+
+                continue
+
+            out_part = slice(((overlap_start - first_frame) * CHANNELS),
+                             ((overlap_end - first_frame) * CHANNELS))
+            in_part = slice(((overlap_start - voice_start) * CHANNELS),
+                            ((overlap_end - voice_start) * CHANNELS))
+
+            # Usual case is one sound at a time, that's just a copy.
+            if silent:
+
+                mixed[out_part] = samples[in_part]
+                silent = False
+
+            else:
+
+                _mix_into(mixed, out_part, samples, in_part)
+
+        self.voices = [voice for voice in self.voices
+                       if (voice[0] + (len(voice[1]) // CHANNELS)) > end_frame]
+        self.frames_written = end_frame
+
+        return mixed.tobytes()
+
+
+def _mix_into(mixed: array, out_part: slice, samples: array,
+              in_part: slice) -> None:
+    '''Add samples[in_part] onto mixed[out_part], clipping to 16 bits.'''
+
+    if numpy is not None:
+
+        out_view = numpy.frombuffer(mixed, dtype=numpy.int16)[out_part]
+        total = (out_view.astype(numpy.int32) +
+                 numpy.frombuffer(samples, dtype=numpy.int16)[in_part])
+        out_view[:] = numpy.clip(total, -32768, 32767)
+        return
+
+    out_index = out_part.start
+
+    for sample in samples[in_part]:
+
+        total = mixed[out_index] + sample
+        mixed[out_index] = max(-32768, min(32767, total))
+        out_index = out_index + 1
+
+
+class NullAudioBackend(object):
+    '''Throws the audio away but takes it at real time speed, keeping
+    buffer_frames queued, so the engine can be run and timed headless.
+    clock gives nanoseconds and can be swapped out for testing.'''
+
+    def __init__(self: 'NullAudioBackend', buffer_frames: int=882,
+                 clock: 'callable'=time.perf_counter_ns) -> None:
+
+        self.buffer_frames = buffer_frames
+        self.clock = clock
+        self.sample_rate = SAMPLE_RATE
+        self.frame_bytes = FRAME_BYTES
+        self.start_ns = None
+        self.frames_written = 0
+
+    def open(self: 'NullAudioBackend', sample_rate: int, channels: int,
+             sample_width: int, pump: 'callable') -> None:
+
+        # Nothing drives pump here, whoever runs the engine calls it.
+        self.sample_rate = sample_rate
+        self.frame_bytes = channels * sample_width
+        self.start_ns = self.clock()
+        self.frames_written = 0
+
+    def get_frames_played(self: 'NullAudioBackend') -> int:
+
+        elapsed_frames = (((self.clock() - self.start_ns) *
+                           self.sample_rate) // 1000000000)
+
+        return min(elapsed_frames, self.frames_written)
+
+    def get_frames_wanted(self: 'NullAudioBackend') -> int:
+
+        return max(0, (self.get_frames_played() + self.buffer_frames -
+                       self.frames_written))
+
+    def write(self: 'NullAudioBackend', data: bytes) -> None:
+
+        self.frames_written = (self.frames_written +
+                               (len(data) // self.frame_bytes))
+
+    def close(self: 'NullAudioBackend') -> None:
+
+        pass
+
+
+class FileSinkBackend(NullAudioBackend):
+    '''As NullAudioBackend, but everything played is saved to a wav file.'''
+
+    def __init__(self: 'FileSinkBackend', path: str,
+                 buffer_frames: int=882,
+                 clock: 'callable'=time.perf_counter_ns) -> None:
+
+        super(FileSinkBackend, self).__init__(buffer_frames, clock)
+
+        self.path = path
+        self.wav_file = None
+
+    def open(self: 'FileSinkBackend', sample_rate: int, channels: int,
+             sample_width: int, pump: 'callable') -> None:
+
+        super(FileSinkBackend, self).open(sample_rate, channels,
+                                          sample_width, pump)
+
+        self.wav_file = wave.open(self.path, 'wb')
+        self.wav_file.setnchannels(channels)
+        self.wav_file.setsampwidth(sample_width)
+        self.wav_file.setframerate(sample_rate)
+
+    def write(self: 'FileSinkBackend', data: bytes) -> None:
+
+        super(FileSinkBackend, self).write(data)
+
+        self.wav_file.writeframes(data)
+
+    def close(self: 'FileSinkBackend') -> None:
+
+        self.wav_file.close()
+
+
+class QtAudioBackend(object):
+    '''Plays through a QAudioOutput in push mode, topped up by a timer every
+    pump_ms.  The device buffer is kept at about buffer_ms, which is most
+    of the output latency.'''
+
+    def __init__(self: 'QtAudioBackend', buffer_ms: int=20,
+                 pump_ms: int=5) -> None:
+
+        # Imported here so the rest of the module runs without Qt.  Raises
+        # ImportError now, rather than mid block, if there is no multimedia.
+        import PySide.QtCore as QtCore
+        import PySide.QtMultimedia as QtMultimedia
+
+        self.QtCore = QtCore
+        self.QtMultimedia = QtMultimedia
+        self.buffer_ms = buffer_ms
+        self.pump_ms = pump_ms
+        self.sample_rate = SAMPLE_RATE
+        self.frame_bytes = FRAME_BYTES
+        self.output = None
+        self.device = None
+        self.timer = None
+
+    def open(self: 'QtAudioBackend', sample_rate: int, channels: int,
+             sample_width: int, pump: 'callable') -> None:
+
+        self.sample_rate = sample_rate
+        self.frame_bytes = channels * sample_width
+
+        audio_format = self.QtMultimedia.QAudioFormat()
+        audio_format.setSampleRate(sample_rate)
+        audio_format.setChannelCount(channels)
+        audio_format.setSampleSize((sample_width * 8))
+        audio_format.setCodec('audio/pcm')
+        audio_format.setByteOrder(self.QtMultimedia.QAudioFormat.LittleEndian)
+        audio_format.setSampleType(self.QtMultimedia.QAudioFormat.SignedInt)
+
+        self.output = self.QtMultimedia.QAudioOutput(audio_format)
+        self.output.setBufferSize(((sample_rate * self.buffer_ms) // 1000) *
+                                  self.frame_bytes)
+        self.device = self.output.start()
+
+        self.timer = self.QtCore.QTimer()
+        self.timer.timeout.connect(pump)
+        self.timer.start(self.pump_ms)
+
+    def get_frames_played(self: 'QtAudioBackend') -> int:
+
+        return ((self.output.processedUSecs() * self.sample_rate) // 1000000)
+
+    def get_frames_wanted(self: 'QtAudioBackend') -> int:
+
+        return (self.output.bytesFree() // self.frame_bytes)
+
+    def write(self: 'QtAudioBackend', data: bytes) -> None:
+
+        self.device.write(data)
+
+    def close(self: 'QtAudioBackend') -> None:
+
+        self.timer.stop()
+        self.output.stop()
@@ -0,0 +1,206 @@
+'''Scoring of task blocks from symbol and keypress arrays.'''
+
+import collections
+import statistics
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Scores given to each trial in each modality.  The codes double as indices
+# into SCORE_NAMES, so keep the two in step.
+TRUE_POSITIVE = 0
+TRUE_NEGATIVE = 1
+FALSE_NEGATIVE = 2
+FALSE_POSITIVE = 3
+SCORE_NAMES = ['true positive', 'true negative', 'false negative',
+               'false positive']
+MODALITIES = ['visual', 'aural']
+
+
+def score_block(symbols: dict, pressed: dict, n: int) -> dict:
+    '''Return the score code of every trial for each modality.
+
+    symbols and pressed are dictionaries keyed by modality.  symbols holds the
+    stim shown at each trial (any integer sequence, e.g. array('b')) and
+    pressed holds a true value for each trial the key for that modality was
+    pressed (e.g. a bytearray).  A trial is a match if its stim is the same
+    as the one n trials before, the first n trials never match.'''
+
+    if numpy is None:
+
+        return dict([[modality, _score_modality(symbols[modality],
+                                                pressed[modality], n)]
+                     for modality in MODALITIES])
+
+    # Both modalities stacked, so scored together in one pass.
+    all_symbols = numpy.array([numpy.asarray(symbols[modality])
+                               for modality in MODALITIES])
+    all_pressed = numpy.array([numpy.frombuffer(pressed[modality],
+                                                dtype=numpy.uint8)
+                               for modality in MODALITIES]).astype(bool)
+    block_length = all_symbols.shape[1]
+    match = numpy.zeros(all_symbols.shape, dtype=bool)
+
+    if n < block_length:
+
+        match[:, n:] = (all_symbols[:, n:] ==
+                        all_symbols[:, :(block_length - n)])
+
+    # Works out to TRUE_POSITIVE when matched and pressed, TRUE_NEGATIVE when
+    # neither, FALSE_NEGATIVE when only matched, FALSE_POSITIVE when only
+    # pressed.
+    codes = ((2 * (match ^ all_pressed)) + ~match).astype(numpy.int8)
+
+    return dict([[modality, codes[index]]
+                 for index, modality in enumerate(MODALITIES)])
+
+
+def _score_modality(symbols: 'sequence', pressed: 'sequence',
+                    n: int) -> array:
+    '''Plain Python score_block for one modality, used without numpy.'''
+
+    codes = array('b', [TRUE_NEGATIVE]) * len(symbols)
+
+    for index in range(len(symbols)):
+
+        match = (index >= n) and (symbols[index] == symbols[(index - n)])
+        codes[index] = score_trial(match, bool(pressed[index]))
+
+    return codes
+
+
+def score_trial(match: bool, pressed: bool) -> int:
+    '''Return the score code of one trial in one modality.'''
+
+    if match:
+
+        if pressed:
+
+            return TRUE_POSITIVE
+
+        return FALSE_NEGATIVE
+
+    if pressed:
+
+        return FALSE_POSITIVE
+
+    return TRUE_NEGATIVE
+
+
+def summarize(scoring: dict) -> dict:
+    '''Return, for each modality, how many trials got each score, keyed by
+    the names in SCORE_NAMES.'''
+
+    score_sum_dict = {}
+
+    for modality in MODALITIES:
+
+        if numpy is None:
+
+            counts = [scoring[modality].count(code)
+                      for code in range(len(SCORE_NAMES))]
+
+        else:
+
+            counts = numpy.bincount(numpy.asarray(scoring[modality]),
+                                    minlength=len(SCORE_NAMES)).tolist()
+
+        score_sum_dict[modality] = dict(zip(SCORE_NAMES, counts))
+
+    return score_sum_dict
+
+
+def reaction_time_stats(latencies: list) -> dict:
+    '''Return a summary, in milliseconds, of the distribution of the given
+    latencies in nanoseconds.'''
+
+    if len(latencies) == 0:
+
+        return {'presses': 0}
+
+    in_ms = sorted([latency / 1000000 for latency in latencies])
+
+    return {'presses': len(in_ms),
+            'mean ms': statistics.mean(in_ms),
+            'median ms': statistics.median(in_ms),
+            'sd ms': (statistics.stdev(in_ms) if len(in_ms) > 1 else 0.0),
+            'fastest ms': in_ms[0],
+            'slowest ms': in_ms[-1],
+            '10th percentile ms': in_ms[((len(in_ms) - 1) // 10)],
+            '90th percentile ms': in_ms[(((len(in_ms) - 1) * 9) // 10)]}
+
+
+class IncrementalScorer(object):
+    '''Scores a block one trial at a time, as the response window of each
+    trial closes, keeping running counts and a rolling accuracy so nothing
+    has to be rescanned at block end.'''
+
+    def __init__(self: 'IncrementalScorer', symbols: dict, n: int,
+                 window: int=20) -> None:
+        '''symbols as for score_block, window is how many of the latest
+        trials the rolling accuracy covers.'''
+
+        self.symbols = symbols
+        self.n = n
+        self.block_length = len(symbols['visual'])
+        self.trials_scored = 0
+        self.codes = dict([[modality,
+                            array('b', [TRUE_NEGATIVE]) * self.block_length]
+                           for modality in MODALITIES])
+        self.counts = dict([[modality, ([0] * len(SCORE_NAMES))]
+                            for modality in MODALITIES])
+        # Number of modalities answered right for each recent trial.
+        self.recent = collections.deque(maxlen=window)
+
+    def score_next(self: 'IncrementalScorer', pressed: dict) -> None:
+        '''Score the next unscored trial.  pressed as for score_block, only
+        the entry for this trial is read.'''
+
+        index = self.trials_scored
+
+        if index >= self.block_length:
+
+            return
+
+        correct = 0
+
+        for modality in MODALITIES:
+
+            modality_symbols = self.symbols[modality]
+            match = ((index >= self.n) and
+                     (modality_symbols[index] ==
+                      modality_symbols[(index - self.n)]))
+            code = score_trial(match, bool(pressed[modality][index]))
+            self.codes[modality][index] = code
+            self.counts[modality][code] = self.counts[modality][code] + 1
+            correct = correct + (code <= TRUE_NEGATIVE)
+
+        self.recent.append(correct)
+        self.trials_scored = index + 1
+
+    def finish(self: 'IncrementalScorer', pressed: dict) -> None:
+        '''Score whatever trials are left, at block end.'''
+
+        while self.trials_scored < self.block_length:
+
+            self.score_next(pressed)
+
+    def get_summary(self: 'IncrementalScorer') -> dict:
+        '''Return the counts so far in the same layout as summarize.'''
+
+        return dict([[modality, dict(zip(SCORE_NAMES,
+                                         self.counts[modality]))]
+                     for modality in MODALITIES])
+
+    def get_rolling_accuracy(self: 'IncrementalScorer') -> float:
+        '''Return the fraction of right answers, both modalities, over the
+        latest trials.  None before any trial is scored.'''
+
+        if len(self.recent) == 0:
+
+            return None
+
+        return (sum(self.recent) / (len(MODALITIES) * len(self.recent)))
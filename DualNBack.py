@@ -3,18 +3,21 @@
 #import os
 #import os.path
 import sys
-import datetime
+import collections
+import contextlib
 import PySide.QtCore as QtCore
 import PySide.QtGui as QtGui
 import random
 import MakeImages
-#import sqlite3
+import sqlite3
 import pickle
 import TaskWindow as TW
 import NBackUserDatabase
 import UserLogin
 import DNBWizard as DNBW
 import MakeStimBuffer
+import AudioEngine
+import EventLog
 
 class PythonVersionError(Exception):
     '''Raise if environment version of Python is less than 3.4.'''
@@ -34,6 +37,10 @@ class SettingsObject(QtCore.QObject):
 
     # Signal is emited on change in setting, agnostic as to nature of change.
     settings_changed_signal = QtCore.Signal()
+    # Emitted right after settings_changed_signal with a frozenset of the
+    # keys that changed, so listeners can skip changes that don't concern
+    # them.
+    settings_keys_changed = QtCore.Signal(object)
 
     def __init__(self: 'SettingsObject') -> None:
         '''Initializes instance, adding generic methods of a Qt Object,
@@ -44,15 +51,103 @@ class SettingsObject(QtCore.QObject):
         # Object is simply a container and signal emitter, so simple dictionary
         # is all that is needed upon initialization.
         self.session_settings = {}
+        # Inside batch() changes are only noted here, one signal at the end.
+        self.batch_depth = 0
+        self.pending_keys = set()
 
     def set_settings_base_dict(self, setting_dict) -> None:
         '''Replace existing settings dictionary as a whole with new provided
         dictionary then emit a "settings_changed_signal" signal.  Dictionary
         must be a fully valid settings dictionary as no attempt to check
-        contents is made.'''
+        contents is made.  A copy is kept, so the caller may go on to change
+        and pass in the same dictionary again.'''
+
+        old_settings = self.session_settings
+        self.session_settings = dict(setting_dict)
+
+        self._settings_changed(
+            [key for key in set(old_settings) | set(setting_dict)
+             if old_settings.get(key) != setting_dict.get(key)])
+
+    def apply_many(self: 'SettingsObject', changes: dict) -> None:
+        '''Change several settings at once, keyed as in the settings
+        dictionary.  Every value is checked first, and if any is bad nothing
+        at all is changed and the error is raised, as for the single set
+        methods, or KeyError for a key that is not a setting.  Then all are
+        applied and one signal sent, only if something actually changed.'''
+
+        for description in changes:
+
+            if description not in self.session_settings:
+
+                raise KeyError(description)
+
+        checked = dict([[description, self._check_setting(value)]
+                        for description, value in changes.items()])
+
+        changed_keys = [description for description in checked
+                        if self.session_settings.get(description) !=
+                        checked[description]]
+        self.session_settings.update(checked)
+        self._settings_changed(changed_keys)
+
+    @contextlib.contextmanager
+    def batch(self: 'SettingsObject') -> 'iterator':
+        '''Context manager that holds back signals from the set methods
+        called inside it and sends one for all of them at the end.  If an
+        error escapes the block, every setting goes back to how it was and
+        no signal is sent.  Batches may be nested, only the outermost one
+        signals.'''
+
+        if self.batch_depth == 0:
+
+            saved_settings = dict(self.session_settings)
+            self.pending_keys = set()
+
+        self.batch_depth = self.batch_depth + 1
+
+        try:
+
+            yield self
+
+        except:
+
+            self.batch_depth = self.batch_depth - 1
+
+            if self.batch_depth == 0:
+
+                self.session_settings.clear()
+                self.session_settings.update(saved_settings)
+                self.pending_keys = set()
+
+            raise
+
+        self.batch_depth = self.batch_depth - 1
+
+        if self.batch_depth == 0:
+
+            changed_keys = self.pending_keys
+            self.pending_keys = set()
+            self._settings_changed(changed_keys)
+
+    def _settings_changed(self: 'SettingsObject',
+                          changed_keys: 'iterable') -> None:
+        '''Signal that changed_keys changed, or hold off until the end of the
+        present batch.  Nothing is sent if no key changed.'''
+
+        if self.batch_depth > 0:
+
+            self.pending_keys.update(changed_keys)
+            return
+
+        changed_keys = frozenset(changed_keys)
+
+        if len(changed_keys) == 0:
+
+            return
 
-        self.session_settings = setting_dict
         self.settings_changed_signal.emit()
+        self.settings_keys_changed.emit(changed_keys)
 
     def set_n(self: 'SettingsObject', new_n: int) -> None:
         '''Set present n for stimulus block creation and then emit a
@@ -139,6 +234,16 @@ class SettingsObject(QtCore.QObject):
         dictionary.  Description is the dictionary key and value is the new
         value to set.'''
 
+        value = self._check_setting(value)
+        changed = self.session_settings.get(description) != value
+
+        self.session_settings[description] = value
+        self._settings_changed(([description] if changed else []))
+
+    def _check_setting(self: 'SettingsObject', value: int) -> int:
+        '''Return value as it should be stored, raising ValueError for a bad
+        colour tuple or TypeError for anything else not an integer.'''
+
         if type(value) == tuple:
 
             if len(value) != 3:
@@ -168,8 +273,7 @@ class SettingsObject(QtCore.QObject):
             except:
                 raise TypeError
 
-        self.session_settings[description] = value
-        self.settings_changed_signal.emit()
+        return value
 
     # The get methods that follow are copy/pastey, but all are trivial and a
     # helper method does not in fact increase readability at this point.
@@ -178,7 +282,7 @@ class SettingsObject(QtCore.QObject):
     def get_settings_base_dict(self: 'SettingsObject') -> int:
         '''Get and return a copy of the entire base settings dictionary.'''
 
-        return self.session_settings
+        return dict(self.session_settings)
 
     def get_number_targets(self: 'SettingsObject') -> int:
         '''Return the present number of targets to be used in calculating the
@@ -258,20 +362,183 @@ class SettingsObject(QtCore.QObject):
     #    return int(self.session_settings['visual_key'])
 
 
+class EventListModel(QtCore.QAbstractListModel):
+    '''The events of an EventLog as list rows, oldest first, each shown as
+    one line with the full event as its tooltip.  Text is only made for the
+    rows a view asks for.
+
+    At most history_size events are held.  New events push the oldest out.
+    page_older brings earlier ones back in from the log file, pushing out
+    the newest, and until page_newer has brought those back in turn new
+    events are set aside rather than added.  Once page_newer reaches the
+    end of the file it adds those set aside that are not written yet.'''
+
+    def __init__(self: 'EventListModel', event_log: EventLog.EventLog,
+                 history_size: int=5000, page_size: int=200,
+                 parent: QtCore.QObject=None) -> None:
+
+        super(EventListModel, self).__init__(parent)
+
+        self.event_log = event_log
+        self.history_size = max(history_size, page_size)
+        self.page_size = page_size
+        # (seq, event) pairs, see EventLog for seq.
+        self.rows = collections.deque()
+        self.following = True
+        # (seq, event) pairs logged while not following, newest last.
+        self.set_aside = collections.deque(maxlen=self.history_size)
+
+        self.event_log.subscribe(self.add_event)
+
+    def rowCount(self: 'EventListModel',
+                 parent: QtCore.QModelIndex=QtCore.QModelIndex()) -> int:
+
+        if parent.isValid():
+
+            return 0
+
+        return len(self.rows)
+
+    def data(self: 'EventListModel', index: QtCore.QModelIndex,
+             role: int=QtCore.Qt.DisplayRole) -> str:
+
+        if not index.isValid():
+
+            return None
+
+        if role == QtCore.Qt.DisplayRole:
+
+            return EventLog.summarize_event(self.rows[index.row()][1])
+
+        if role == QtCore.Qt.ToolTipRole:
+
+            return EventLog.format_event(self.rows[index.row()][1])
+
+        return None
+
+    def add_event(self: 'EventListModel', event: dict) -> None:
+        '''Event log subscriber, adds each event as the last row.'''
+
+        if not self.following:
+
+            self.set_aside.append([event['seq'], event])
+            return
+
+        self._append([[event['seq'], event]])
+
+    def page_older(self: 'EventListModel') -> int:
+        '''Bring in a page of events from before the first row, and return
+        how many.'''
+
+        if len(self.rows) == 0:
+
+            return 0
+
+        first_seq = self.rows[0][0]
+        events = self.event_log.read_before(first_seq, self.page_size)
+
+        if len(events) == 0:
+
+            return 0
+
+        self.beginInsertRows(QtCore.QModelIndex(), 0, (len(events) - 1))
+        self.rows.extendleft([[(first_seq - offset), event]
+                              for offset, event in
+                              enumerate(reversed(events), 1)])
+        self.endInsertRows()
+
+        surplus = len(self.rows) - self.history_size
+
+        if surplus > 0:
+
+            self.beginRemoveRows(QtCore.QModelIndex(),
+                                 (len(self.rows) - surplus),
+                                 (len(self.rows) - 1))
+
+            for _ in range(surplus):
+
+                self.rows.pop()
+
+            self.endRemoveRows()
+            self.following = False
+
+        return len(events)
+
+    def page_newer(self: 'EventListModel') -> int:
+        '''Bring back in a page of the events pushed out by page_older, and
+        return how many.'''
+
+        if self.following:
+
+            return 0
+
+        last_seq = self.rows[-1][0]
+        events = self.event_log.read_after(last_seq, self.page_size)
+        new_rows = [[(last_seq + offset), event]
+                    for offset, event in enumerate(events, 1)]
+
+        # Short of a page, so the file is read to its end and any events
+        # after it are still waiting to be written.
+        if len(events) < self.page_size:
+
+            last_seq = last_seq + len(events)
+            new_rows.extend([row for row in self.set_aside
+                             if row[0] > last_seq])
+            self.set_aside.clear()
+            self.following = True
+
+        self._append(new_rows)
+
+        return len(new_rows)
+
+    def _append(self: 'EventListModel', new_rows: list) -> None:
+        '''Add rows at the end, pushing out the oldest past the limit.'''
+
+        if len(new_rows) == 0:
+
+            return
+
+        surplus = len(self.rows) + len(new_rows) - self.history_size
+
+        if surplus > 0:
+
+            self.beginRemoveRows(QtCore.QModelIndex(), 0, (surplus - 1))
+
+            for _ in range(surplus):
+
+                self.rows.popleft()
+
+            self.endRemoveRows()
+
+        self.beginInsertRows(QtCore.QModelIndex(), len(self.rows),
+                             (len(self.rows) + len(new_rows) - 1))
+        self.rows.extend(new_rows)
+        self.endInsertRows()
+
+
 class LogWindow(QtGui.QWidget):
-    '''Makes the wacky log deally.'''
+    '''Makes the wacky log deally.  Shows the events of an EventLog as they
+    are logged, the event log itself takes care of saving them.  Only the
+    latest history_size events are kept in memory, scrolling to the top
+    pages earlier ones in from the log file.'''
 
     log_saved = QtCore.Signal()
 
-    def __init__(self: 'LogWindow') -> None:
+    def __init__(self: 'LogWindow', event_log: EventLog.EventLog,
+                 history_size: int=5000) -> None:
 
         super(LogWindow, self).__init__()
 
-        self.log_string = ('--------begin session--------' + '\n' +
-                           str(datetime.datetime.today()) + ':\n')
+        self.event_log = event_log
+        self.event_model = EventListModel(event_log, history_size,
+                                          parent=self)
+        # Keep showing the latest event while scrolled to the bottom.
+        self.at_bottom = True
 
         self.__config_log_window()
 
+        self.log_event('--------begin session--------')
+
     def __config_log_window(self: 'LogWindow') -> None:
         '''All the fiddly stuff.'''
 
@@ -279,40 +546,76 @@ class LogWindow(QtGui.QWidget):
 
         self.g_l = QtGui.QGridLayout(self)
 
-        self.text_display = QtGui.QTextEdit(self.log_string)
-        self.text_display.setWordWrapMode(QtGui.QTextOption.WordWrap)
-        self.text_display.setReadOnly(True)
+        self.list_view = QtGui.QListView()
+        self.list_view.setModel(self.event_model)
+        # One line per row, so the view never measures rows out of sight.
+        self.list_view.setUniformItemSizes(True)
+        self.list_view.setVerticalScrollMode(
+            QtGui.QAbstractItemView.ScrollPerItem)
+        self.list_view.verticalScrollBar().valueChanged.connect(
+            self._scrolled)
+        self.event_model.rowsInserted.connect(self._rows_inserted)
 
-        self.g_l.addWidget(self.text_display, 1, 1)
+        self.g_l.addWidget(self.list_view, 1, 1)
 
         self.lower()
         self.show()
 
     def log_event(self: 'LogWindow', event_log: str) -> None:
-        '''Add to log file and update log window.'''
+        '''Log a plain text message.'''
 
-        string_to_insert = ('\n' + str(datetime.datetime.today()) + ':\n' +
-                            event_log + '\n')
-        self.log_string = (self.log_string + string_to_insert)
+        self.event_log.log('message', text=event_log)
 
-        self.text_display.append(string_to_insert)
-        self.update()
-        
-    def closeEvent(self: 'LogWindow', event):
-        '''Reimplemented close event handler.  Save log on application
-        close.'''
+    def _scrolled(self: 'LogWindow', value: int) -> None:
+        '''Page events in at either end of the list.'''
 
-        self.log_event('---------end session---------\n')
+        scroll_bar = self.list_view.verticalScrollBar()
 
-        save_file = open('resources/dualnback.log', 'a')
-        save_file.writelines(self.log_string)
-        save_file.close()
+        if value == scroll_bar.minimum():
+
+            paged = self.event_model.page_older()
+
+            if paged > 0:
+
+                # Stay on the row that was at the top.
+                scroll_bar.setValue(value + paged)
+
+        elif value == scroll_bar.maximum():
+
+            self.event_model.page_newer()
+
+        self.at_bottom = (scroll_bar.value() == scroll_bar.maximum() and
+                          self.event_model.following)
+
+    def _rows_inserted(self: 'LogWindow', parent: QtCore.QModelIndex,
+                       first: int, last: int) -> None:
+
+        if self.at_bottom:
+
+            self.list_view.scrollToBottom()
+
+    def end_session(self: 'LogWindow') -> None:
+        '''Finish writing the log on application close.  Safe to call more
+        than once.'''
+
+        if not self.event_log.writer.is_alive():
+
+            return
+
+        self.log_event('---------end session---------')
+
+        self.event_log.unsubscribe(self.event_model.add_event)
+        self.event_log.close()
 
         # Is there an actual reason to emit this signal?  How about for a loop
         # in main app to wait until detected to finish closing?  (so far seems
         # not needed)
         self.log_saved.emit()
 
+    def closeEvent(self: 'LogWindow', event):
+        '''Reimplemented close event handler.  The window is only hidden, so
+        it can be shown again, the log goes on until end_session.'''
+
         # Any other clean up?  Don't forget to add it below.
         event.accept()
 
@@ -332,7 +635,9 @@ class DualNBackMainWindow(QtGui.QMainWindow):
 
 
         # First,open log and then make sure the minimum python version is used.
-        self.log_widget = LogWindow()
+        # Every event goes to the event log, the window just shows them.
+        self.event_log = EventLog.EventLog()
+        self.log_widget = LogWindow(self.event_log)
         self.check_py_ver()
 
         # Do I ever use this?
@@ -344,7 +649,14 @@ class DualNBackMainWindow(QtGui.QMainWindow):
         self.central_widget = QtGui.QWidget(self)
         self.db_connection = UserLogin.UserSession()
         self.user_logged_in = False
-        #self.user_name = ''
+        self.user_name = ''
+        # Sessions table row of the logged in user, once a block is saved.
+        self.db_session_id = None
+        # Blocks are queued by the database, this sees they are committed
+        # even while idle.
+        self.db_commit_timer = QtCore.QTimer(self)
+        self.db_commit_timer.timeout.connect(self._commit_user_database)
+        self.db_commit_timer.start(NBackUserDatabase.BATCH_SECONDS * 1000)
         self.results = None
         self.user_history = {'name': '', 'psswrd': '', 'svunpw': False}
 
@@ -381,11 +693,27 @@ class DualNBackMainWindow(QtGui.QMainWindow):
         
         # Some more helper function organization, see these functions for 
         # details but nothing too exciting.
+        self.image_set = None
+        # Composited or not, and the cache key of what was drawn for that.
+        self.image_set_key = None
+        self.screen_images = None
+        # One neutral frame with targets painted on at trial time, rather
+        # than a full screen image for every target.
+        self.composite_screens = True
+        # Screens already rendered, on disk, by settings.
+        self.render_cache = MakeImages.RenderCache()
         self.set_images()
+        # Connected before the stimulus buffer connects, so the buffer always
+        # picks up images made for the new settings.
+        self.session_settings.settings_changed_signal.connect(self.set_images)
         self.idle_messages = self.__load_idle_mssgs()
         self.idle_messages_index = 0
 
         self.stimulus_buffer = None    # Initialized fully with main window.
+        self.audio_engine = None    # Also with main window, if it can be.
+        # How late sounds are heard after images, learned while calibrating.
+        self.av_compensation_ns = 0
+        self.calibrating_av_sync = False
         self.training = False
         self.blocks_run_so_far = 0
 
@@ -405,11 +733,6 @@ class DualNBackMainWindow(QtGui.QMainWindow):
         self.bad_idea = None  # This getting used is not a good idea, but who
         # am I to stop you.  See self._sooper_sekrit_settings() for info.
 
-        self.neutral_screen = QtGui.QPixmap(
-            ('images\screen' +
-             str((self.session_settings.session_settings[
-                 'number_of_targets'] // 2)) + '.png'))
-
         # Helper function to lay out the main application window.
         self.__central_window()
 
@@ -491,6 +814,7 @@ class DualNBackMainWindow(QtGui.QMainWindow):
         if not ((py_ver[0] >= 3) and (py_ver[1] >= 4)):
 
             self.log_widget.log_event('Python version test failed.')
+            self.log_widget.end_session()
             self.log_widget.close()
             raise PythonVersionError(py_ver)
 
@@ -573,6 +897,19 @@ class DualNBackMainWindow(QtGui.QMainWindow):
 
             self.logout_user()
 
+        self._end_db_session()
+        self.db_commit_timer.stop()
+
+        try:
+
+            self.db_connection.db_connection.close()
+
+        except sqlite3.Error as error:
+
+            self.log_widget.log_event('User database writes lost at close: '
+                                      + str(error))
+
+        self.log_widget.end_session()
         self.log_widget.close()
         # I think accept flag is already true.
         #event.accept()
@@ -592,7 +929,9 @@ class DualNBackMainWindow(QtGui.QMainWindow):
                                              [['setting_window_action',
                                                'Settings &dialog'],
                                               ['soper_sekrit_window_action',
-                                               'Sooper Se&krit Settings!']]],
+                                               'Sooper Se&krit Settings!'],
+                                              ['av_calibration_action',
+                                               '&Calibrate sound timing']]],
                           '_windows_menu': ['&Windows', [['log_window_action',
                                                          'Show &log window']]],
                           '_about_and_help_menu': ['&About and Help',
@@ -623,7 +962,9 @@ class DualNBackMainWindow(QtGui.QMainWindow):
                            [self._settings_menu, [[self.setting_window_action,
                                                   self.__settings_window],
                             [self.soper_sekrit_window_action,
-                             self._sooper_sekrit_settings]]],
+                             self._sooper_sekrit_settings],
+                            [self.av_calibration_action,
+                             self._toggle_av_calibration]]],
                              [self._windows_menu, [[self.log_window_action,
                                                    self.toggle_log_window]]],
                              [self._about_and_help_menu,
@@ -666,6 +1007,13 @@ class DualNBackMainWindow(QtGui.QMainWindow):
                     checkable_menu[0].triggered.disconnect(checkable_menu[1])
                     checkable_menu[0].toggled.connect(checkable_menu[1])
 
+        # Off to begin with, unlike the checked menus above.
+        self.av_calibration_action.setCheckable(True)
+        self.av_calibration_action.triggered.disconnect(
+            self._toggle_av_calibration)
+        self.av_calibration_action.toggled.connect(
+            self._toggle_av_calibration)
+
         # Status bar
         self.setStatusBar(self.status_bar)
         self.status_bar.label = QtGui.QLabel('Dual n-back task ready.',
@@ -766,9 +1114,31 @@ class DualNBackMainWindow(QtGui.QMainWindow):
 
         #self.stimulus_buffer = MakeStimBuffer.StimList(stim_buffer_dict)
         self.stimulus_buffer = MakeStimBuffer.StimList(self)
+        self._make_audio_engine()
 
         self.central_widget.movie.start()
 
+    def _make_audio_engine(self: 'DualNBackMainWindow') -> None:
+        '''Preload every sound for the low latency audio engine.  Without Qt
+        multimedia or a decoder for the sounds, task windows fall back on
+        playing each sound with QSound.'''
+
+        try:
+
+            self.audio_engine = AudioEngine.AudioEngine(
+                AudioEngine.PcmBank('sounds/'), AudioEngine.QtAudioBackend())
+
+        except (ImportError, ValueError) as error:
+
+            self.audio_engine = None
+            self.log_widget.log_event('Audio engine unavailable, using '
+                                      'QSound: ' + str(error))
+            return
+
+        self.log_widget.log_event('Audio engine ready, ' +
+                                  str(len(self.audio_engine.bank)) +
+                                  ' sounds preloaded.')
+
     def __session_window(self: 'DualNBackMainWindow') -> None:
         '''Open a fullscreen session window and run a session with current
         settings.'''
@@ -800,6 +1170,8 @@ class DualNBackMainWindow(QtGui.QMainWindow):
         self.session_thread.session_window.log_worthy.connect(
             self._session_log)
         self.session_thread.session_window.task_done.connect(self._end_block)
+        self.session_thread.session_window.trial_scored.connect(
+            self._show_live_score)
         self.session_thread.session_window._start_block()
 
 
@@ -829,8 +1201,36 @@ class DualNBackMainWindow(QtGui.QMainWindow):
     def _session_log(self: 'DualNBackMainWindow') -> None:
         '''Logging helper function when interacting with task window.'''
 
-        self.log_widget.log_event(
-            self.session_thread.session_window.log_report)
+        report = dict(self.session_thread.session_window.log_report)
+        self.event_log.log(report.pop('kind'), **report)
+
+    def _show_live_score(self: 'DualNBackMainWindow') -> None:
+        '''Show running performance of the present block in the status bar,
+        for whoever is watching over the session.'''
+
+        scorer = self.session_thread.session_window.scorer
+        accuracy = scorer.get_rolling_accuracy()
+
+        if accuracy is None:
+
+            return
+
+        self.status_bar.label.setText(
+            'Trial ' + str(scorer.trials_scored) + ' of ' +
+            str(scorer.block_length) + ', recent accuracy ' +
+            str(round((accuracy * 100))) + '%.')
+
+    def _toggle_av_calibration(self: 'DualNBackMainWindow',
+                               checked: bool) -> None:
+        '''While on, every block run also learns how far sounds lag images,
+        and later blocks trigger sounds that much early.'''
+
+        self.calibrating_av_sync = checked
+        self.log_widget.log_event('Sound timing calibration ' +
+                                  ('on' if checked else 'off') +
+                                  ', compensation ' +
+                                  str(self.av_compensation_ns / 1000000) +
+                                  ' ms.')
 
     def _end_block(self: 'DualNBackMainWindow') -> None:
         '''End of task block administration function.  Responsibilities
@@ -846,6 +1246,17 @@ class DualNBackMainWindow(QtGui.QMainWindow):
         self.blocks_run_so_far = self.blocks_run_so_far + 1
 
         block_results = self.session_thread.session_window.results
+
+        if self.calibrating_av_sync:
+
+            self.av_compensation_ns = self.session_thread.session_window.\
+                av_sync.learn_compensation(self.av_compensation_ns)
+            self.log_widget.log_event('Sound timing compensation now ' +
+                                      str(self.av_compensation_ns / 1000000) +
+                                      ' ms.')
+
+        self._save_block(block_results)
+
         self.session_thread.session_window.close()
 
         self.log_widget.log_event(str(self.blocks_run_so_far) +
@@ -860,16 +1271,90 @@ class DualNBackMainWindow(QtGui.QMainWindow):
                 str('User ' + self.user_history['name'] +
                     ' has finished all session blocks.\n'))
 
-            # SOME FINAL DATABASE WRITING HERE!
-
             self.logout_user()
 
         self._change_n(block_results['score summary'])
 
-        # OK, NEW BUFFER HERE I GUESS
+        # Next block's buffer is built in the background while idle, the task
+        # window pops it from the pool when opened.
+        self.stimulus_buffer.prefetch()
 
-        self.stimulus_buffer._refresh_attributes()
-        self.stimulus_buffer.make_buffer()
+    def _save_block(self: 'DualNBackMainWindow',
+                    block_results: dict) -> None:
+        '''Queue the block just run, with its trials, in the user database.
+        The session is started with the first block.'''
+
+        if self.user_name == '':
+
+            return
+
+        database = self.db_connection.db_connection
+        session_window = self.session_thread.session_window
+
+        try:
+
+            if self.db_session_id is None:
+
+                try:
+
+                    user_id = database.get_user(self.user_name)['user_id']
+
+                except NBackUserDatabase.NoSuchUserError:
+
+                    user_id = database.add_user(self.user_name)
+
+                self.db_session_id = database.start_session(user_id)
+
+            database.add_block(
+                self.db_session_id,
+                NBackUserDatabase.get_block_record(
+                    block_results, session_window.block_number,
+                    session_window.block_n,
+                    self.session_settings.get_stim_exposure_time(),
+                    self.session_settings.get_interstim_time()),
+                NBackUserDatabase.get_trial_rows(
+                    block_results, session_window.keypress_log))
+
+        except sqlite3.Error as error:
+
+            self.log_widget.log_event('Block not saved to the user '
+                                      'database: ' + str(error))
+
+    def _commit_user_database(self: 'DualNBackMainWindow') -> None:
+        '''Commit blocks queued in the user database, if they are due.'''
+
+        try:
+
+            self.db_connection.db_connection.commit_if_due()
+
+        except sqlite3.Error as error:
+
+            # Anything not committed stays queued for the next try.
+            self.log_widget.log_event('User database commit failed, will '
+                                      'retry: ' + str(error))
+
+    def _end_db_session(self: 'DualNBackMainWindow') -> None:
+        '''End the user's database session, if one was started, commit
+        everything queued and log how long commits have taken.'''
+
+        if self.db_session_id is None:
+
+            return
+
+        database = self.db_connection.db_connection
+
+        try:
+
+            database.end_session(self.db_session_id)
+            database.commit()
+
+        except sqlite3.Error as error:
+
+            self.log_widget.log_event('User database commit failed, will '
+                                      'retry: ' + str(error))
+
+        self.db_session_id = None
+        self.event_log.log('database commits', **database.get_commit_stats())
 
     def _change_n(self: 'DualNBackMainWindow', score_data: dict) -> None:
         '''If needed, change n.'''
@@ -1862,8 +2347,9 @@ class DualNBackMainWindow(QtGui.QMainWindow):
 
         self._log_in_out_update()
 
-        #self.user_name = usr_nm
+        self.user_name = usr_nm
 
+        self.event_log.user = usr_nm
         self.log_widget.log_event(str('User ' + self.user_history['name'] +
                                       ' has logged in.'))
 
@@ -1900,6 +2386,8 @@ class DualNBackMainWindow(QtGui.QMainWindow):
 
         self.log_widget.log_event(str('User ' + self.user_history['name'] +
                                       ' has logged out.'))
+        self.event_log.user = None
+        self._end_db_session()
         
         self.user_history['name'] = ''
         self.user_history['psswrd'] = ''
@@ -1926,13 +2414,60 @@ class DualNBackMainWindow(QtGui.QMainWindow):
 # Stimulus stuff
 
     def set_images(self: 'DualNBackMainWindow') -> None:
-        '''Create the image set for this entire session.'''
+        '''Create the image set for the present settings.  Does nothing if
+        nothing drawn has changed, and reuses frames rendered for earlier
+        settings from the render cache.  Composited, only the neutral screen
+        is drawn, so a new target colour needs nothing done here.  Once
+        there are screens, a number of targets no grid can be made for is
+        logged and the screens kept.'''
 
         # Really best to check documentation in this module if questions.
-        image_object = MakeImages.ImageSet(self)
+        try:
+
+            image_set = MakeImages.ImageSet(self)
+
+        except ValueError as error:
+
+            if self.image_set_key is None:
+
+                raise
+
+            self.log_widget.log_event('Screens kept as they were, ' +
+                                      str(error))
+            return
+
+        image_set_key = (self.composite_screens,
+                         image_set.get_cache_key(self.composite_screens))
+
+        if image_set_key == self.image_set_key:
+
+            return
+
+        # Kept, since the in memory images borrow its arrays.
+        self.image_set = image_set
+        self.image_set_key = image_set_key
+
+        # In composited mode only the neutral screen is made, the task window
+        # paints each target square over it.
+        self.image_set.create_set_of_images(base_only=self.composite_screens,
+                                            cache=self.render_cache)
+        self.log_widget.log_event(
+            'Screens made, milliseconds by target location: ' +
+            str(self.image_set.timings) + '.')
+        # QImages by target location, None if they were only saved to disk.
+        self.screen_images = self.image_set.get_qimages()
+
+        neutral_index = self.image_set.neutral_location
+
+        if self.screen_images is not None:
+
+            self.neutral_screen = QtGui.QPixmap.fromImage(
+                self.screen_images[neutral_index])
+
+        else:
 
-        image_object.create_set_of_images()
-        del(image_object)
+            self.neutral_screen = QtGui.QPixmap(
+                ('images/screen' + str(neutral_index) + '.png'))
 
     def run_session(self: 'DualNBackMainWindow') -> None:
         '''Engine to run a test.'''
@@ -0,0 +1,517 @@
+'''Append only, structured event log for the application.
+
+Every event is a flat dictionary with at least its kind and the time it was
+logged.  Events go one per line as JSON to the log file, written by a
+background thread as they come, so a crash loses at most the last few.
+Anything else that wants the events, such as the log window, subscribes.
+
+The log file is rotated once it grows past a size or age.  Closed segments
+are gzipped beside it, named after the time of their first event.  A
+sidecar index holds one JSON line of (segment, byte offset, time, user,
+kind) wherever the user or kind of event changes, and every INDEX_STRIDE
+bytes within a run of the same, so read_range finds a user's events for a
+time range by reading only the runs that could hold them.'''
+
+import datetime
+import glob
+import gzip
+import json
+import os
+import queue
+import shutil
+import threading
+from array import array
+
+# How much of the log file is read at a time when reading it backwards.
+READ_BLOCK = 65536
+# Longest one line summary of an event, longer ones are cut short.
+SUMMARY_WIDTH = 200
+# Log file size and age past which it is rotated.
+SEGMENT_BYTES = 16 * 1024 * 1024
+SEGMENT_AGE = datetime.timedelta(days=1)
+# Longest run of log file without an index entry.
+INDEX_STRIDE = 65536
+
+
+def _to_json(value: object) -> object:
+    '''json.dumps default, for the values events may hold besides plain
+    lists, dictionaries, numbers and strings.'''
+
+    # Symbol and keypress buffers, numpy arrays.
+    if isinstance(value, (array, memoryview, bytearray, bytes)):
+
+        return list(value)
+
+    if hasattr(value, 'tolist'):
+
+        return value.tolist()
+
+    if isinstance(value, (set, frozenset)):
+
+        return sorted(value)
+
+    return repr(value)
+
+
+def format_event(event: dict) -> str:
+    '''Return an event as readable text, for display.'''
+
+    lines = [event['time'] + ': ' + event['kind']]
+
+    for key in event:
+
+        if key not in ('time', 'kind'):
+
+            lines.append('    ' + key + ': ' +
+                         json.dumps(event[key], default=_to_json))
+
+    return '\n'.join(lines)
+
+
+def summarize_event(event: dict) -> str:
+    '''Return an event as one line of text, for lists of events.'''
+
+    if event['kind'] == 'message':
+
+        summary = event['time'] + ': ' + str(event.get('text'))
+
+    else:
+
+        summary = (event['time'] + ': ' + event['kind'] + ' ' +
+                   ', '.join([key + '=' + json.dumps(event[key],
+                                                     default=_to_json)
+                              for key in event
+                              if key not in ('time', 'kind', 'seq',
+                                             'user')]))
+
+    summary = summary.replace('\n', ' ')
+
+    if len(summary) > SUMMARY_WIDTH:
+
+        summary = summary[:(SUMMARY_WIDTH - 3)] + '...'
+
+    return summary
+
+
+def parse_event(line: str) -> dict:
+    '''Return the event on a line of a log file.  A line cut short by a
+    crash comes back as an 'unreadable' event rather than an error.'''
+
+    try:
+
+        return json.loads(line)
+
+    except ValueError:
+
+        return {'time': '', 'kind': 'unreadable', 'line': line}
+
+
+def read_lines_from_end(path: str, skip: int, count: int) -> list:
+    '''Return up to count lines of a text file, oldest first, the last of
+    them being skip lines before the end of the file.  Only as much of the
+    end of the file as needed is read, so this stays quick however long the
+    file grows.'''
+
+    if count <= 0 or skip < 0:
+
+        return []
+
+    try:
+
+        text_file = open(path, 'rb')
+
+    except FileNotFoundError:
+
+        return []
+
+    with text_file:
+
+        text_file.seek(0, os.SEEK_END)
+        position = text_file.tell()
+        tail = b''
+
+        # One more newline than lines wanted, so the first is whole.
+        while position > 0 and tail.count(b'\n') <= (skip + count):
+
+            step = min(READ_BLOCK, position)
+            position = position - step
+            text_file.seek(position)
+            tail = text_file.read(step) + tail
+
+    lines = tail.split(b'\n')
+
+    if lines[-1] == b'':
+
+        lines.pop()
+
+    if position > 0:
+
+        lines.pop(0)
+
+    end = len(lines) - skip
+
+    return [line.decode('utf-8', 'replace')
+            for line in lines[max(0, (end - count)):max(0, end)]]
+
+
+def get_index_path(path: str) -> str:
+    '''Return where the index of the log file at path goes.'''
+
+    return os.path.splitext(path)[0] + '.index.jsonl'
+
+
+def get_segment_path(path: str, first_time: str,
+                     compressed: bool=True) -> str:
+    '''Return where the log file at path goes once rotated, given the time
+    of its first event.'''
+
+    root, extension = os.path.splitext(path)
+    stamp = ''.join([character for character in first_time
+                     if character.isdigit() or character == 'T'])
+
+    return (root + '-' + stamp + extension + ('.gz' if compressed else ''))
+
+
+def read_first_time(path: str) -> str:
+    '''Return the time of the first event in a log file, or None if it has
+    none.'''
+
+    try:
+
+        with open(path, 'rb') as log_file:
+
+            line = log_file.readline()
+
+    except FileNotFoundError:
+
+        return None
+
+    if line.strip() == b'':
+
+        return None
+
+    return parse_event(line.decode('utf-8', 'replace'))['time'] or None
+
+
+def compress_segment(segment_path: str) -> None:
+    '''Gzip a rotated log file beside itself and remove the original.'''
+
+    with open(segment_path, 'rb') as source:
+
+        with gzip.open(segment_path + '.gz.tmp', 'wb') as destination:
+
+            shutil.copyfileobj(source, destination)
+
+    os.replace(segment_path + '.gz.tmp', segment_path + '.gz')
+    os.remove(segment_path)
+
+
+def read_range(path: str, start: str, end: str, user: str=None,
+               kinds: 'container'=None) -> list:
+    '''Return the events from start up to but not including end, both
+    isoformat times, out of the log file at path and its rotated segments.
+    If given, only events of that user and those kinds.  Only the runs of
+    the log the index says could hold them are read.'''
+
+    try:
+
+        with open(get_index_path(path), encoding='utf-8') as index_file:
+
+            entries = [json.loads(line) for line in index_file
+                       if line.strip()]
+
+    except FileNotFoundError:
+
+        return []
+
+    folder = os.path.dirname(path)
+    live_time = read_first_time(path)
+    live_segment = (os.path.basename(get_segment_path(path, live_time))
+                    if live_time else None)
+    segment_files = {}
+    events = []
+
+    try:
+
+        for position, entry in enumerate(entries):
+
+            segment, offset, entry_time, entry_user, entry_kind = entry
+            following = (entries[(position + 1)]
+                         if (position + 1) < len(entries) else None)
+
+            # Every event of a run is from its entry up to the next one.
+            if entry_time >= end or (following is not None and
+                                     following[2] < start):
+
+                continue
+
+            if ((user is not None and entry_user != user) or
+                    (kinds is not None and entry_kind not in kinds)):
+
+                continue
+
+            if segment not in segment_files:
+
+                segment_files[segment] = _open_segment(
+                    path, os.path.join(folder, segment),
+                    (segment == live_segment))
+
+            segment_file = segment_files[segment]
+
+            if segment_file is None:
+
+                continue
+
+            stop = (following[1] if (following is not None and
+                                     following[0] == segment) else None)
+            segment_file.seek(offset)
+
+            while stop is None or segment_file.tell() < stop:
+
+                line = segment_file.readline()
+
+                if line == b'':
+
+                    break
+
+                event = parse_event(line.decode('utf-8', 'replace'))
+
+                if start <= event['time'] < end:
+
+                    events.append(event)
+
+    finally:
+
+        for segment_file in segment_files.values():
+
+            if segment_file is not None:
+
+                segment_file.close()
+
+    return events
+
+
+def _open_segment(path: str, segment_path: str, live: bool) -> 'file':
+    '''Open a log segment for reading in binary, wherever it is in being
+    rotated.  None if it is gone.'''
+
+    if os.path.exists(segment_path):
+
+        return gzip.open(segment_path, 'rb')
+
+    # Rotated but not compressed yet.
+    if os.path.exists(segment_path[:-len('.gz')]):
+
+        return open(segment_path[:-len('.gz')], 'rb')
+
+    if live:
+
+        return open(path, 'rb')
+
+    return None
+
+
+class EventLog(object):
+    '''Hands each logged event to the subscribers, then queues it for the
+    writer thread.  Subscribers are called on the thread that logged the
+    event, the writer never touches them.
+
+    Events are numbered from 0 in the order logged, as their seq field.  The
+    log file may hold earlier sessions before them, and read_before and
+    read_after reach into those too, back as far as the last rotation.
+
+    While user is set it is added to every event logged.'''
+
+    def __init__(self: 'EventLog',
+                 path: str='resources/dualnback.jsonl',
+                 segment_bytes: int=SEGMENT_BYTES,
+                 segment_age: datetime.timedelta=SEGMENT_AGE) -> None:
+
+        self.path = path
+        self.index_path = get_index_path(path)
+        self.segment_bytes = segment_bytes
+        self.segment_age = segment_age
+        self.user = None
+        self.subscribers = []
+        self.events_logged = 0
+        # Held by the writer while it writes, so events_written always
+        # matches what is in the file for readers holding it.
+        self.file_lock = threading.Lock()
+        self.events_written = 0
+        self.write_queue = queue.Queue()
+        self.writer = threading.Thread(target=self._write_loop, daemon=True)
+        self.writer.start()
+
+    def subscribe(self: 'EventLog', callback: 'callable') -> None:
+        '''Have callback(event) called for every event from now on.'''
+
+        self.subscribers.append(callback)
+
+    def unsubscribe(self: 'EventLog', callback: 'callable') -> None:
+        '''Stop calling callback, if it was subscribed.'''
+
+        if callback in self.subscribers:
+
+            self.subscribers.remove(callback)
+
+    def log(self: 'EventLog', kind: str, **fields) -> dict:
+        '''Log an event of the given kind with any other fields, and return
+        it.  Field values should be plain data, symbol ids rather than
+        image or sound objects, and left alone once logged since they are
+        only encoded later on the writer thread.'''
+
+        event = {'time': datetime.datetime.today().isoformat(),
+                 'kind': kind}
+        event.update(fields)
+
+        if self.user is not None:
+
+            event['user'] = self.user
+
+        event['seq'] = self.events_logged
+        self.events_logged = self.events_logged + 1
+
+        for callback in list(self.subscribers):
+
+            callback(event)
+
+        self.write_queue.put(event)
+
+        return event
+
+    def read_before(self: 'EventLog', seq: int, count: int) -> list:
+        '''Return up to count events from the log file, oldest first, that
+        were logged just before event seq.  Nothing while event seq itself
+        is still waiting to be written.'''
+
+        with self.file_lock:
+
+            return [parse_event(line)
+                    for line in read_lines_from_end(self.path,
+                                                    (self.events_written -
+                                                     seq), count)]
+
+    def read_after(self: 'EventLog', seq: int, count: int) -> list:
+        '''Return up to count events from the log file, oldest first, that
+        were logged just after event seq.  Events still waiting to be
+        written are left out.'''
+
+        with self.file_lock:
+
+            count = min(count, (self.events_written - seq - 1))
+
+            return [parse_event(line)
+                    for line in read_lines_from_end(self.path,
+                                                    (self.events_written -
+                                                     seq - 1 - count),
+                                                    count)]
+
+    def close(self: 'EventLog') -> None:
+        '''Write out everything still queued and stop the writer.  Does
+        nothing once the writer has stopped.'''
+
+        if self.writer.is_alive():
+
+            self.write_queue.put(None)
+            self.writer.join()
+
+    def _write_loop(self: 'EventLog') -> None:
+        '''Writer thread.  Takes whatever has queued up since it last looked,
+        writes it all, then flushes before waiting again.  Rotates the log
+        file between batches once it is full.'''
+
+        # Left over if the application stopped during a rotation.
+        root, extension = os.path.splitext(self.path)
+
+        for segment_path in glob.glob(root + '-*' + extension):
+
+            compress_segment(segment_path)
+
+        log_file = open(self.path, 'ab')
+        index_file = open(self.index_path, 'a', encoding='utf-8')
+        first_time = read_first_time(self.path)
+        offset = log_file.tell()
+        # (user, kind, offset) of the last index entry.
+        last_entry = None
+
+        try:
+
+            while True:
+
+                batch = [self.write_queue.get()]
+
+                while True:
+
+                    try:
+
+                        batch.append(self.write_queue.get_nowait())
+
+                    except queue.Empty:
+
+                        break
+
+                rotated_path = None
+
+                with self.file_lock:
+
+                    for event in batch:
+
+                        if event is None:
+
+                            break
+
+                        if first_time is None:
+
+                            first_time = event['time']
+
+                        user = event.get('user')
+
+                        if (last_entry is None or
+                                last_entry[:2] != (user, event['kind']) or
+                                (offset - last_entry[2]) >= INDEX_STRIDE):
+
+                            segment = os.path.basename(
+                                get_segment_path(self.path, first_time))
+                            index_file.write(json.dumps(
+                                [segment, offset, event['time'], user,
+                                 event['kind']]) + '\n')
+                            last_entry = (user, event['kind'], offset)
+
+                        line = (json.dumps(event, default=_to_json,
+                                           separators=(',', ':')) +
+                                '\n').encode('utf-8')
+                        log_file.write(line)
+                        offset = offset + len(line)
+                        self.events_written = self.events_written + 1
+
+                    log_file.flush()
+                    index_file.flush()
+
+                    if None in batch:
+
+                        return
+
+                    if first_time is not None and (
+                            offset >= self.segment_bytes or
+                            (datetime.datetime.today() -
+                             datetime.datetime.fromisoformat(first_time)) >=
+                            self.segment_age):
+
+                        log_file.close()
+                        rotated_path = get_segment_path(self.path,
+                                                        first_time, False)
+                        os.replace(self.path, rotated_path)
+                        log_file = open(self.path, 'ab')
+                        first_time = None
+                        offset = 0
+                        last_entry = None
+
+                # Outside the lock, readers only need the live file.
+                if rotated_path is not None:
+
+                    compress_segment(rotated_path)
+
+        finally:
+
+            log_file.close()
+            index_file.close()
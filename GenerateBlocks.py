@@ -0,0 +1,174 @@
+'''Headless batch generation of n-back stimulus sequences.
+
+Example, a million sequences over all cores:
+    python GenerateBlocks.py blocks.dnb --count 1000000 --n 3 --length 40
+
+Sequences have exactly the targets asked for and no chance matches, as in
+the application, unless --no-exact is given.
+
+Output is either the compact binary format below or, if the output name ends
+in .npz and numpy is installed, an npz archive with the same three columns.
+
+Binary format, little endian:
+    header: magic b'DNBB', version (H), n (H), trials per sequence (I),
+            sequence count (I)
+    then per sequence: visual symbols (trials x int8), aural symbols
+            (trials x int8), placement flags (trials x uint8)'''
+
+import argparse
+import concurrent.futures
+import os
+import random
+import struct
+import sys
+from array import array
+import MakeStimBuffer
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MAGIC = b'DNBB'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<4sHHII')
+
+
+def _generate_chunk(spec: tuple, how_many: int, seed: int) -> bytes:
+    '''Worker process job.  Generate how_many sequences for spec and return
+    them packed back to back in the binary record layout.'''
+
+    # Each job has its own generator, so a chunk always comes out the same
+    # for the same seed no matter which worker ran it.
+    sequence = MakeStimBuffer.StimSequence(*spec, rng=random.Random(seed))
+    packed = bytearray()
+
+    for i in range(how_many):
+
+        sequence.generate()
+        packed.extend(sequence.buffers['visual'].tobytes())
+        packed.extend(sequence.buffers['aural'].tobytes())
+        packed.extend(sequence.placement.tobytes())
+
+    return bytes(packed)
+
+
+def generate_blocks(spec: tuple, count: int, workers: int=None,
+                    chunk_size: int=1000, seed: int=None) -> 'iterator':
+    '''Generate count sequences for spec (see StimSequence.get_spec) across a
+    pool of worker processes.  Yields packed chunks of sequences in order.
+
+    Chunks get their seeds from seed, so the same seed and chunk_size give
+    the same sequences whatever the number of workers.'''
+
+    seeder = random.Random(seed)
+    chunk_sizes = []
+
+    while count > 0:
+
+        chunk_sizes.append(min(chunk_size, count))
+        count = count - chunk_size
+
+    chunk_seeds = [seeder.randrange(2 ** 63) for size in chunk_sizes]
+
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+
+        for packed in executor.map(_generate_chunk,
+                                   [spec] * len(chunk_sizes),
+                                   chunk_sizes, chunk_seeds):
+
+            yield packed
+
+
+def write_blocks(path: str, spec: tuple, count: int,
+                 chunks: 'iterator') -> None:
+    '''Write packed chunks to path, as npz if path ends in .npz.'''
+
+    trials = spec[0] + spec[1]
+
+    if path.endswith('.npz'):
+
+        if numpy is None:
+
+            raise ImportError('numpy is needed to write npz files.')
+
+        records = numpy.frombuffer(b''.join(chunks), dtype=numpy.int8)
+        records = records.reshape(count, 3, trials)
+        numpy.savez_compressed(path, visual=records[:, 0],
+                               aural=records[:, 1],
+                               placement=records[:, 2].view(numpy.uint8),
+                               n=spec[0])
+        return
+
+    with open(path, 'wb') as out_file:
+
+        out_file.write(HEADER.pack(MAGIC, FORMAT_VERSION, spec[0], trials,
+                                   count))
+
+        for packed in chunks:
+
+            out_file.write(packed)
+
+
+def read_blocks(path: str) -> 'iterator':
+    '''Yield (visual, aural, placement) arrays for every sequence in a
+    binary file written by write_blocks.'''
+
+    with open(path, 'rb') as in_file:
+
+        magic, version, n, trials, count = HEADER.unpack(
+            in_file.read(HEADER.size))
+
+        if ((magic != MAGIC) or (version != FORMAT_VERSION)):
+
+            raise ValueError(path + ' is not a block file this can read.')
+
+        for i in range(count):
+
+            record = in_file.read(trials * 3)
+            yield (array('b', record[:trials]),
+                   array('b', record[trials:(trials * 2)]),
+                   array('B', record[(trials * 2):]))
+
+
+def main(argv: list=None) -> None:
+    '''Command line entry point.  argv defaults to sys.argv[1:].'''
+
+    parser = argparse.ArgumentParser(
+        description='Generate dual n-back stimulus sequences without Qt.')
+    parser.add_argument('output', help='file to write, .npz for numpy')
+    parser.add_argument('--count', type=int, required=True)
+    parser.add_argument('--n', type=int, required=True)
+    parser.add_argument('--length', type=int, required=True,
+                        help='trials before n is added on')
+    parser.add_argument('--visual-targets', type=int, default=4)
+    parser.add_argument('--aural-targets', type=int, default=4)
+    parser.add_argument('--both-targets', type=int, default=2)
+    parser.add_argument('--visual-stims', type=int, default=8)
+    parser.add_argument('--aural-stims', type=int, default=8)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--exact', action=argparse.BooleanOptionalAction,
+                        default=True,
+                        help='no matches other than the targets (default), '
+                        '--no-exact allows chance matches on top')
+    arguments = parser.parse_args(argv)
+
+    spec = (arguments.n, arguments.length,
+            {'aural': arguments.aural_targets,
+             'visual': arguments.visual_targets,
+             'both': arguments.both_targets},
+            {'aural': arguments.aural_stims,
+             'visual': arguments.visual_stims}, arguments.exact)
+
+    write_blocks(arguments.output, spec, arguments.count,
+                 generate_blocks(spec, arguments.count, arguments.workers,
+                                 arguments.chunk_size, arguments.seed))
+
+    print('Wrote ' + str(arguments.count) + ' sequences to ' +
+          arguments.output + '.', file=sys.stderr)
+
+if __name__ == '__main__':
+
+    main()
@@ -1,9 +1,204 @@
-'''Make images for dual n-back task.'''
+'''Make images for dual n-back task.
+
+Either all nine screens are made, or in composited mode only the neutral
+screen, with the target squares painted over it by the task window.
+
+With numpy installed the images are drawn straight into RGB arrays in
+memory and handed to Qt as QImages, no files involved.  Saving them as png
+files is then optional.  Without numpy they are drawn with PIL and always
+saved, as before.'''
+
+import concurrent.futures
+import hashlib
+import math
+import os
+import os.path
+import threading
+import time
+import AssetRegistry
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    from PIL import Image, ImageDraw
+except ImportError:
+    Image = None
+    ImageDraw = None
+
+# Thickness of the fixation cross lines, in pixels.
+FIXATOR_WIDTH = 5
+# Bump whenever render_image would draw anything differently, so frames
+# cached by an older version are never used.
+RENDERER_VERSION = 1
+# Screens smaller than this many pixels are made one after another, below it
+# starting threads costs more than it saves.
+PARALLEL_MIN_PIXELS = 1280 * 720
+
+
+def to_qimage(pixels: 'numpy.ndarray') -> 'QtGui.QImage':
+    '''Wrap a height x width x 3 uint8 RGB array as a QImage without copying
+    the pixels.  The QImage only borrows the array's memory, so the array
+    must be kept for as long as the QImage is used.'''
+
+    # Qt only imported here, so images can be rendered without it.
+    import PySide.QtGui as QtGui
+
+    height, width = pixels.shape[:2]
+
+    return QtGui.QImage(pixels.data, width, height, pixels.strides[0],
+                        QtGui.QImage.Format_RGB888)
+
+
+class RenderCache(object):
+    '''Rendered screens kept on disk as .npy files, named by a hash of
+    everything that goes into drawing them (see ImageSet.get_cache_key) and
+    the target location.  Settings that were rendered before are read back
+    rather than drawn again.
+
+    Files are touched on every read, and once the folder holds more than
+    size_budget bytes the least recently used are deleted.'''
+
+    def __init__(self: 'RenderCache', folder: str='render_cache',
+                 size_budget: int=(512 * 1024 * 1024)) -> None:
+
+        self.folder = folder
+        self.size_budget = size_budget
+        self.hits = 0
+        self.misses = 0
+        # Screens may be rendered from several threads at once.
+        self.lock = threading.Lock()
+
+    def _get_path(self: 'RenderCache', key: str, location: int) -> str:
+
+        return os.path.join(self.folder,
+                            (key + '_' + str(location) + '.npy'))
+
+    def load(self: 'RenderCache', key: str,
+             location: int) -> 'numpy.ndarray':
+        '''Return the cached frame, or None if there is none.'''
+
+        path = self._get_path(key, location)
+
+        with self.lock:
+
+            try:
+
+                pixels = numpy.load(path)
+
+            except (OSError, ValueError):
+
+                self.misses = self.misses + 1
+                return None
+
+            # Marks it as recently used.
+            os.utime(path)
+            self.hits = self.hits + 1
+
+        return pixels
+
+    def store(self: 'RenderCache', key: str, location: int,
+              pixels: 'numpy.ndarray') -> None:
+
+        os.makedirs(self.folder, exist_ok=True)
+        path = self._get_path(key, location)
+
+        # Written aside then moved in, so a half written file is never read.
+        with open((path + '.tmp' + str(threading.get_ident())),
+                  'wb') as cache_file:
+
+            numpy.save(cache_file, pixels)
+
+        with self.lock:
+
+            os.replace(cache_file.name, path)
+            self._trim()
+
+    def _trim(self: 'RenderCache') -> None:
+        '''Delete least recently used frames until under the size budget.
+        The newest frame is always kept.  Caller must hold the lock.'''
+
+        entries = []
+
+        for file_name in os.listdir(self.folder):
+
+            if file_name.endswith('.npy'):
+
+                stat = os.stat(os.path.join(self.folder, file_name))
+                entries.append([stat.st_mtime_ns, stat.st_size, file_name])
+
+        entries.sort()
+        total = sum([entry[1] for entry in entries])
+
+        for modified, size, file_name in entries[:-1]:
+
+            if total <= self.size_budget:
+
+                break
+
+            os.remove(os.path.join(self.folder, file_name))
+            total = total - size
+
+    def get_stats(self: 'RenderCache') -> dict:
+
+        with self.lock:
+
+            return {'hits': self.hits, 'misses': self.misses}
+
+
+def get_grid_size(number_of_targets: int) -> int:
+    '''Return the side of the square grid the targets are laid out on.
+    Odd grids give up their centre cell to the fixation cross, so 8 targets
+    is 3x3 and 24 is 5x5.  Even grids have no centre cell, so 16 targets is
+    4x4.  Raises ValueError for counts that fill no such grid.'''
+
+    grid_size = math.isqrt(number_of_targets + 1)
+
+    if ((grid_size % 2 == 1) and (grid_size > 1) and
+        ((grid_size * grid_size) == (number_of_targets + 1))):
+
+        return grid_size
+
+    grid_size = math.isqrt(number_of_targets)
+
+    if ((grid_size % 2 == 0) and (grid_size > 0) and
+        ((grid_size * grid_size) == number_of_targets)):
+
+        return grid_size
+
+    raise ValueError(str(number_of_targets) + ' targets do not fill a square '
+                     'grid, try 8, 16 or 24.')
+
+
+def get_neutral_location(number_of_targets: int) -> int:
+    '''Return the location of the neutral screen, see ImageSet.'''
+
+    if get_grid_size(number_of_targets) % 2 == 1:
+
+        return number_of_targets // 2
+
+    return number_of_targets
+
+
+def get_target_locations(number_of_targets: int) -> list:
+    '''Return the location of every target, in stimulus order.'''
+
+    neutral_location = get_neutral_location(number_of_targets)
+
+    return [location for location in range(number_of_targets + 1)
+            if location != neutral_location]
 
-from PIL import Image, ImageDraw, ImageFont
 
 class ImageSet(object):
-    '''Base class to produce uniform set of test images.'''
+    '''Base class to produce uniform set of test images.
+
+    Images are numbered by location, 0 to number_of_targets, row by row.
+    One location is the neutral screen, showing only the fixation cross:
+    the centre cell of odd grids, one past the last cell of even ones.  The
+    rest are the targets, in location order, which is also the order the
+    stimulus buffer numbers them in.'''
 
     def __init__(self: 'ImageSet', parent: 'DualNBack') -> None:
         '''Standard setting initialization.'''
@@ -16,17 +211,65 @@ class ImageSet(object):
         self.number_of_targets = self.parent.session_settings.\
             get_number_targets()
         self.image_dimensions = self.parent.screen_dimensions
+        self.grid_size = get_grid_size(self.number_of_targets)
+        self.neutral_location = get_neutral_location(self.number_of_targets)
 
-    def __draw_image(self: 'ImageSet', target_location: int) -> object:
-        '''Produce image.'''
+        # Worked out once, every image is drawn from it.
+        self.layout_table = self.get_layout_table()
+        # Arrays from the last render_set_of_images, by target location.
+        self.rendered = {}
+        # Milliseconds each image took last time, by target location.
+        self.timings = {}
+
+    def _get_layout(self: 'ImageSet') -> dict:
+        '''Return the sizes and positions shared by both ways of drawing.'''
 
-        image_third_vert = (self.image_dimensions[1] // 3)
-        vertical_padding = (image_third_vert // 8)
-        image_third_hor = ((self.image_dimensions[0] // 3) - 1)
+        cell_vert = (self.image_dimensions[1] // self.grid_size)
+        vertical_padding = (cell_vert // 8)
+        cell_hor = ((self.image_dimensions[0] // self.grid_size) - 1)
         horizontal_padding = (
-            vertical_padding + ((image_third_hor - image_third_vert) // 2))
+            vertical_padding + ((cell_hor - cell_vert) // 2))
+
+        # The cross fills a square the size of a target at the very centre
+        # of the grid, for odd grids exactly where the centre cell's target
+        # would be.
+        return {'cell vertical': cell_vert,
+                'vertical padding': vertical_padding,
+                'cell horizontal': cell_hor,
+                'horizontal padding': horizontal_padding,
+                'sprite edge': (cell_vert - (vertical_padding * 2)),
+                'cross left': (((self.grid_size * cell_hor) // 2) -
+                               (cell_hor // 2) + horizontal_padding),
+                'cross top': (((self.grid_size * cell_vert) // 2) -
+                              (cell_vert // 2) + vertical_padding)}
+
+    def get_layout_table(self: 'ImageSet') -> list:
+        '''Return the top left corner (x, y) of the target square at every
+        location, None at the neutral location.'''
 
-        sprite_edge_length = (image_third_vert - (vertical_padding * 2))
+        layout = self._get_layout()
+        table = []
+
+        for location in range(self.number_of_targets + 1):
+
+            if location == self.neutral_location:
+
+                table.append(None)
+                continue
+
+            row, column = divmod(location, self.grid_size)
+            table.append((((column * layout['cell horizontal']) +
+                           layout['horizontal padding']),
+                          ((row * layout['cell vertical']) +
+                           layout['vertical padding'])))
+
+        return table
+
+    def __draw_image(self: 'ImageSet', target_location: int) -> object:
+        '''Produce image with PIL.'''
+
+        layout = self._get_layout()
+        sprite_edge_length = layout['sprite edge']
 
         out_image = Image.new(
             'RGB', self.image_dimensions, self.background_colour)
@@ -36,23 +279,21 @@ class ImageSet(object):
         # Probably one pixel off, double check.
 
         out_image_draw.line(
-            [((image_third_hor + horizontal_padding),
-              (self.image_dimensions[1] // 2)),
-             ((image_third_hor + horizontal_padding + sprite_edge_length),
-              (self.image_dimensions[1] // 2))], self.fixator_colour, 5)
+            [(layout['cross left'], (self.image_dimensions[1] // 2)),
+             ((layout['cross left'] + sprite_edge_length),
+              (self.image_dimensions[1] // 2))], self.fixator_colour,
+            FIXATOR_WIDTH)
         out_image_draw.line(
-            [((self.image_dimensions[0] // 2),
-              (image_third_vert + vertical_padding)),
+            [((self.image_dimensions[0] // 2), layout['cross top']),
              ((self.image_dimensions[0] // 2),
-              (image_third_vert + vertical_padding + sprite_edge_length))],
-            self.fixator_colour, 5)
+              (layout['cross top'] + sprite_edge_length))],
+            self.fixator_colour, FIXATOR_WIDTH)
+
+        corner = self.layout_table[target_location]
 
-        if target_location != (self.number_of_targets // 2):
+        if corner is not None:
 
-            hor_start = (
-                ((target_location % 3) * image_third_hor) + horizontal_padding)
-            vert_start = (
-                ((target_location // 3) * image_third_vert) + vertical_padding)
+            hor_start, vert_start = corner
 
             out_image_draw.rectangle(
                 [(hor_start, vert_start),
@@ -63,14 +304,189 @@ class ImageSet(object):
 
         return out_image
 
-    def create_set_of_images(self: 'ImageSet') -> None:
-        '''Make and save all nine images.'''
+    def render_image(self: 'ImageSet',
+                     target_location: int) -> 'numpy.ndarray':
+        '''Produce image as a height x width x 3 RGB array, pixel for pixel
+        the same drawing as the PIL version.  Only the background fill
+        touches every pixel, so cost does not grow with the grid.'''
+
+        layout = self._get_layout()
+        sprite_edge_length = layout['sprite edge']
+        width, height = self.image_dimensions
+        # Half the cross thickness either side of the centre line, as PIL.
+        half_width = FIXATOR_WIDTH // 2
+
+        pixels = numpy.empty((height, width, 3), dtype=numpy.uint8)
+        pixels[:, :] = self.background_colour[:3]
+
+        # Shapes below include both end pixels, again as PIL draws them.
+        hor_start = layout['cross left']
+        pixels[((height // 2) - half_width):((height // 2) + half_width + 1),
+               hor_start:(hor_start + sprite_edge_length + 1)] = \
+            self.fixator_colour[:3]
+
+        vert_start = layout['cross top']
+        pixels[vert_start:(vert_start + sprite_edge_length + 1),
+               ((width // 2) - half_width):((width // 2) + half_width + 1)] = \
+            self.fixator_colour[:3]
+
+        corner = self.layout_table[target_location]
+
+        if corner is not None:
+
+            hor_start, vert_start = corner
+
+            pixels[vert_start:(vert_start + sprite_edge_length + 1),
+                   hor_start:(hor_start + sprite_edge_length + 1)] = \
+                self.target_colour[:3]
+
+        return pixels
+
+    def get_target_rects(self: 'ImageSet') -> list:
+        '''Return (x, y, width, height) of the square for every target, in
+        stimulus order.'''
+
+        # PIL draws both end pixels, so one more than the edge length.
+        side = self._get_layout()['sprite edge'] + 1
+        return [(self.layout_table[location] + (side, side))
+                for location in get_target_locations(self.number_of_targets)]
+
+    def get_cache_key(self: 'ImageSet', base_only: bool=False) -> str:
+        '''Return a hash of everything the drawing depends on.  If base_only,
+        of everything the neutral screen depends on, which leaves out the
+        target colour.'''
+
+        drawn_from = repr((tuple(self.image_dimensions),
+                           tuple(self.background_colour),
+                           (None if base_only else tuple(self.target_colour)),
+                           tuple(self.fixator_colour), FIXATOR_WIDTH,
+                           self.number_of_targets, RENDERER_VERSION))
+
+        return hashlib.sha1(drawn_from.encode('utf-8')).hexdigest()
+
+    def render_set_of_images(self: 'ImageSet', base_only: bool=False,
+                             cache: RenderCache=None,
+                             workers: int=None) -> dict:
+        '''Render the images in memory, kept in self.rendered by target
+        location.  Only the neutral screen if base_only.  Frames found in
+        cache are read from it, the rest are drawn and added to it.'''
+
+        self._run_jobs(self._get_locations(base_only), False, cache, workers)
+
+        return self.rendered
+
+    def _run_jobs(self: 'ImageSet', locations: list, save_to_disk: bool,
+                  cache: RenderCache, workers: int) -> None:
+        '''Make the image for each location, across a thread pool for big
+        screens.  numpy fills and PIL encoding both let go of the GIL, so
+        the threads really do run side by side.'''
+
+        width, height = self.image_dimensions
+
+        def job(location: int) -> tuple:
+
+            return self._make_image(location, save_to_disk, cache)
+
+        if ((len(locations) > 1) and
+            ((width * height) >= PARALLEL_MIN_PIXELS)):
+
+            with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+
+                results = list(executor.map(job, locations))
+
+        else:
+
+            results = [job(location) for location in locations]
+
+        self.rendered = {}
+        self.timings = {}
+
+        for location, pixels, milliseconds in results:
+
+            if pixels is not None:
+
+                self.rendered[location] = pixels
+
+            self.timings[location] = milliseconds
+
+    def _make_image(self: 'ImageSet', location: int, save_to_disk: bool,
+                    cache: RenderCache) -> tuple:
+        '''Return (location, pixels, milliseconds taken) for one image,
+        saving it as png if asked.  Pixels are None when drawn with PIL.'''
+
+        start = time.perf_counter_ns()
+        pixels = None
+
+        if numpy is None:
+
+            image = self.__draw_image(location)
+
+        else:
+
+            # So the neutral screen is shared by every target colour.
+            key = self.get_cache_key(location == self.neutral_location)
+
+            if cache is not None:
+
+                pixels = cache.load(key, location)
+
+            if pixels is None:
+
+                pixels = self.render_image(location)
+
+                if cache is not None:
+
+                    cache.store(key, location, pixels)
+
+            if save_to_disk:
+
+                image = Image.fromarray(pixels)
+
+        if save_to_disk:
+
+            image.save(os.path.join('images',
+                                    ('screen' + str(location) + '.png')))
+
+        return (location, pixels,
+                ((time.perf_counter_ns() - start) / 1000000))
+
+    def _get_locations(self: 'ImageSet', base_only: bool) -> list:
+
+        if base_only:
+
+            return [self.neutral_location]
+
+        return list(range(self.number_of_targets + 1))
+
+    def get_qimages(self: 'ImageSet') -> dict:
+        '''Return the rendered images as QImages sharing their memory, by
+        target location.  None if nothing was rendered in memory.'''
+
+        if len(self.rendered) == 0:
+
+            return None
+
+        return dict([[location, to_qimage(pixels)]
+                     for location, pixels in self.rendered.items()])
+
+    def create_set_of_images(self: 'ImageSet', save_to_disk: bool=False,
+                             base_only: bool=False, cache: RenderCache=None,
+                             workers: int=None) -> None:
+        '''Make all nine images, or only the neutral screen if base_only,
+        in memory if numpy is around, going through cache if given.  Images
+        are saved to the images folder if asked, or if they could only be
+        drawn with PIL.  See self.timings for how long each took.'''
+
+        if ((numpy is not None) and (not save_to_disk)):
+
+            self.render_set_of_images(base_only, cache, workers)
+            return
 
-        for i in range(self.number_of_targets + 1):
+        self._run_jobs(self._get_locations(base_only), True, cache, workers)
 
-            image = self.__draw_image(i)
-            image.save(('images\screen' + str(i) + '.png'))
+        # Anything decoded from the old images is stale now.
+        AssetRegistry.registry.invalidate('images')
 
 if __name__ == '__main__':
 
-    raise ChildProcessError
\ No newline at end of file
+    raise ChildProcessError
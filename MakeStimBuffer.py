@@ -1,113 +1,249 @@
-from random import randrange
+import random
+from array import array
 import os
 import os.path
-import PySide.QtCore as QtCore
-import PySide.QtGui as QtGui
+import StimPool
+import AssetRegistry
+import MakeImages
 
-class StimList(object):
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
-    def __init__(self: 'StimList', parent: 'DualNBackMainWindow') -> None:
+# Below these sizes the serial filler beats the batched one, since the batched
+# filler pays numpy call overhead once for each stretch of n positions.
+BATCH_FILL_MIN_LENGTH = 512
+BATCH_FILL_MIN_N = 8
 
-        self.parent = parent
+# Placement column flags, a target can be a match in one modality or both.
+VISUAL_TARGET = 1
+AURAL_TARGET = 2
+TARGET_FLAGS = {'visual': VISUAL_TARGET, 'aural': AURAL_TARGET,
+                'both': (VISUAL_TARGET | AURAL_TARGET)}
+
+# Symbols are stored as signed bytes with -1 for not yet placed.
+MOST_STIMS = 127
+
+class TargetCountError(Exception):
+    '''Raise if a sequence does not hold exactly the matches asked for.'''
+    pass
+
+# Only used to pick seeds, never to build a sequence directly.
+_seed_source = random.SystemRandom()
+
+
+class _NumpyRandom(object):
+    '''Gives a numpy Generator the randrange method used in this module.'''
+
+    def __init__(self: '_NumpyRandom', generator: 'numpy.random.Generator'
+                 ) -> None:
+
+        self.generator = generator
+
+    def randrange(self: '_NumpyRandom', start: int, stop: int=None) -> int:
+
+        if stop is None:
+
+            start, stop = 0, start
+
+        return int(self.generator.integers(start, stop))
+
+
+def _as_random(rng: object) -> object:
+    '''Return rng as something with a randrange method.  rng may be a
+    random.Random, a numpy Generator or None for the module level generator
+    in random.'''
+
+    if rng is None:
+
+        return random
+
+    if hasattr(rng, 'randrange'):
+
+        return rng
+
+    if hasattr(rng, 'integers'):
+
+        return _NumpyRandom(rng)
+
+    raise TypeError('rng must be a random.Random or numpy Generator.')
+
+def link_up_chains(list_of_pairs: list) -> list:
+    '''Return the list of [cue, target] pairs melded into chains, where a
+    chain is any run of pairs in which the target of one pair is the cue of
+    the next.  Chains are returned ordered by their first index.
+
+    Precondition: all cues are unique and all targets are unique, which is
+    always true for pairs of the form [i - n, i].'''
+
+    # Every cue maps to exactly one target, so a dictionary lets us walk a
+    # chain one link at a time instead of rescanning the remaining pairs for
+    # each link.  Sorting is the only non-linear step left, and pairs built
+    # by place_stims are already in order so Timsort does this in one pass.
+    target_of_cue = {}
+
+    for pair in list_of_pairs:
+
+        target_of_cue[pair[0]] = pair[1]
+
+    list_of_matching_entries = []
+    used_cues = set()
 
-        self.n = None
-        self.length = None
+    for cue in sorted(target_of_cue):
+
+        if cue in used_cues:
+
+            continue
+
+        # Smallest unused cue starts a new chain, then follow targets that
+        # are themselves cues until the chain ends (or loops back on itself).
+        working_entry = [cue]
+        link = cue
+
+        while (link in target_of_cue) and (link not in used_cues):
+
+            used_cues.add(link)
+            link = target_of_cue[link]
+            working_entry.append(link)
+
+        list_of_matching_entries.append(working_entry)
+
+    return list_of_matching_entries
+
+
+def _draw_allowed_stim(total_stims: int, forbidden: set,
+                       rng: object=random) -> int:
+    '''Return a stim drawn uniformly from range(total_stims) minus the
+    forbidden stims.  Raises ValueError if no stim is left to draw.'''
+
+    excluded = sorted([stim for stim in forbidden
+                       if 0 <= stim < total_stims])
+    choices = total_stims - len(excluded)
+
+    if choices < 1:
+
+        raise ValueError('Not enough stims to avoid a match.')
+
+    # Draw an index into the allowed stims then step over each forbidden stim
+    # at or below it, same distribution as drawing until one is allowed.
+    drawn = rng.randrange(0, choices)
+
+    for stim in excluded:
+
+        if drawn >= stim:
+
+            drawn = drawn + 1
+
+    return drawn
+
+
+def _pixmap_bytes(pixmap: 'QtGui.QPixmap') -> int:
+    '''Estimate memory held by a decoded pixmap.'''
+
+    return ((pixmap.width() * pixmap.height() * pixmap.depth()) // 8)
+
+
+class StimSequence(object):
+    '''Builds the symbol buffers for one block.  Holds no Qt objects, so it
+    is safe to build these away from the GUI thread.
+
+    Every step that draws takes an rng, either a random.Random or a numpy
+    Generator.  Steps given none use the sequence's own rng, and if that is
+    None too the module level generator in random.
+
+    With exact_counts the stims are placed so that there are no matches
+    other than the targets asked for, see _place_stims_exact.'''
+
+    def __init__(self: 'StimSequence', n: int, length: int, targets: dict,
+                 how_many_stims: dict, exact_counts: bool=False,
+                 rng: object=None) -> None:
+        '''n is the block n, length the block length before n, targets the
+        number of 'aural', 'visual' and 'both' targets and how_many_stims the
+        number of different stims available for 'aural' and 'visual'.'''
+
+        self.n = n
+        self.length = length
+        self.targets = targets
+        self.how_many_stims = how_many_stims
+        self.exact_counts = exact_counts
+        self.rng = rng
+        # Seed the last sequence was generated from, None if unknown.
+        self.seed = None
         self.placement = None
         self.valid_index = None
-        self.targets = None
         self.buffers = None
-        self.how_many_stims = None
-        self.lists_to_be_built = None
-        self.all_image_targets = []
-        self.all_sound_targets = []
 
-        # This connection probably redundant since refrech at buffer build.
-        self.parent.session_settings.settings_changed_signal.connect(
-            self._refresh_attributes)
-        self._refresh_attributes()
+        self.reset()
 
-    def _refresh_attributes(self: 'StimList') -> None:
+    def reset(self: 'StimSequence') -> None:
+        '''Empty the working lists so a new sequence can be built.
 
-        self.n = self.parent.session_settings.get_n()
-        self.length = self.parent.session_settings.get_block_before_n()
-        self.placement = []
+        Buffers are one signed byte per trial for each modality, placement is
+        one byte of target flags per trial.'''
+
+        self.placement = array('B')
         self.valid_index = []
-        self.targets = {'aural': self.parent.match_in_aural,
-                        'visual': self.parent.match_in_visual,
-                        'both': self.parent.match_in_both}
-        self.buffers = {'aural': [], 'visual': []}
-        self.how_many_stims = {
-            'aural': self.parent.session_settings.get_number_targets(),
-            'visual': self.parent.session_settings.get_number_targets()}
-        self.lists_to_be_built = [self.buffers['aural'],
-                                  self.buffers['visual'], self.placement]
-        self._make_stimulus_objects()
+        self.buffers = {'aural': array('b'), 'visual': array('b')}
+
+    def get_spec(self: 'StimSequence') -> tuple:
+        '''Return everything a sequence is built from, in the order
+        StimSequence takes it.  Two sequences with equal specs are
+        interchangeable.'''
 
-    def get_n(self: 'StimList') -> int:
+        return (self.n, self.length, dict(self.targets),
+                dict(self.how_many_stims), self.exact_counts)
+
+    def get_n(self: 'StimSequence') -> int:
         '''Return present n.'''
 
         return self.n
 
-    def get_length(self: 'StimList') -> int:
+    def get_length(self: 'StimSequence') -> int:
         '''Return present list length.'''
 
         return self.length
 
-    def get_working_total_stims(self: 'StimList', modality: str) -> int:
+    def get_working_total_stims(self: 'StimSequence', modality: str) -> int:
         '''Return how many different stim are available for the given
         modality.'''
 
         return self.how_many_stims[modality]
 
-    def _make_stimulus_objects(self: 'StimList') -> None:
-
-        #self.all_image_targets = []
-        #self.all_sound_targets = []
-        all_possible_image_targets = os.listdir('images/')
-        all_possible_sound_targets = os.listdir('sounds/')
-        
-        for sound_file_index in range(len(all_possible_sound_targets)):
+    def _get_rng(self: 'StimSequence', rng: object) -> object:
+        '''Return the generator a step should draw from.'''
 
-            # This reappending to a new list is to keep memory addresses 
-            # uniform, this way points to single instance of each sound, if
-            # only one list then each entry is a fresh reference.
-            self.all_sound_targets.append(QtGui.QSound(str('sounds/' + all_possible_sound_targets[sound_file_index])))
+        if rng is None:
 
-        for path in all_possible_image_targets:
-
-            if os.path.isfile(('images/' + path)):
+            rng = self.rng
 
-                if str(
-                    (self.parent.session_settings.get_number_targets() //
-                     2)) not in path:
+        return _as_random(rng)
 
-                    self.all_image_targets.append(
-                        QtGui.QPixmap(('images/' + path)))
+    def make_index_list(self: 'StimSequence') -> None:
+        '''Create and set stim target and available indicies lists.'''
 
-        # All targets are organized, and their index in the list is a unique
-        # identifier for our purposes here.  Invoke the helper function that
-        # returns a list for each modality that has the index for the stim
-        # we want where the position in these lists are the position for the
-        #  occurance of that stim.
+        block_length_total = self.get_length() + self.get_n()
 
-    def make_index_list(self: 'StimList') -> None:
-        '''Create and set stim target and available indicies lists.'''
+        for modality in self.buffers:
 
-        for i in range((self.get_length() + self.get_n())):
+            if self.get_working_total_stims(modality) > MOST_STIMS:
 
-            for list_to_appended_to in self.lists_to_be_built:
+                raise ValueError('At most ' + str(MOST_STIMS) +
+                                 ' stims fit a buffer.')
 
-                list_to_appended_to.append(-1)
+            self.buffers[modality] = array('b', [-1]) * block_length_total
 
-            self.valid_index.append(i)
+        self.placement = array('B', [0]) * block_length_total
 
         # But the first n indexes are not valid for placement, so:
 
-        self.valid_index = self.valid_index[self.get_n():]
+        self.valid_index = list(range(self.get_n(), block_length_total))
 
-    def place_targets(self: 'StimList') -> None:
+    def place_targets(self: 'StimSequence', rng: object=None) -> None:
         '''Place stim targets in valid positions.'''
 
+        rng = self._get_rng(rng)
+
         # For each modality type
         for mod in self.targets:
 
@@ -115,14 +251,24 @@ class StimList(object):
 
                 # pick an index out of the list of available ones at random
                 place_here = self.valid_index.pop(
-                    randrange(0, len(self.valid_index)))
-                # the string representing the modality is in the placement list
-                # at the drawn index now.
-                self.placement[place_here] = mod
+                    rng.randrange(0, len(self.valid_index)))
+                # the flags for the modality are in the placement list at the
+                # drawn index now.
+                self.placement[place_here] = TARGET_FLAGS[mod]
 
-    def place_stims(self: 'StimList', all_placed: bool=False) -> None:
+    def place_stims(self: 'StimSequence', all_placed: bool=False,
+                    rng: object=None) -> None:
         '''Place cue and target along with non match stims.'''
 
+        rng = self._get_rng(rng)
+
+        # With n of 0 every trial matches itself, nothing to be exact about.
+        if self.exact_counts and (self.get_n() > 0):
+
+            self._place_stims_exact(rng)
+            self.validate_counts()
+            return
+
         n_value = self.get_n()
         block_length_total = n_value + self.get_length()
         visual_pairs = []
@@ -132,39 +278,108 @@ class StimList(object):
 
             index_value = self.placement[i]
 
-            if type(index_value) == str:
+            if index_value & AURAL_TARGET:
 
-                if ((index_value == 'aural') or (index_value == 'both')):
+                aural_pairs.append([(i - n_value), i])
 
-                    aural_pairs.append([(i - n_value), i])
+            if index_value & VISUAL_TARGET:
 
-                if ((index_value == 'visual') or (index_value == 'both')):
-
-                    visual_pairs.append([(i - n_value), i])
+                visual_pairs.append([(i - n_value), i])
 
         aural_chains = self.link_up_chains(aural_pairs)
         visual_chains = self.link_up_chains(visual_pairs)
 
         for chain in [[aural_chains, 'aural'], [visual_chains, 'visual']]:
 
-            self.pair_cue_targets(chain[0], chain[1])
+            self.pair_cue_targets(chain[0], chain[1], rng)
+
+        self._fill_non_matches(rng)
+
+    def _place_stims_exact(self: 'StimSequence', rng: object) -> None:
+        '''Place every stim so the only n-back matches are the targets.
+
+        A trial can only match the trial n before it, so each of the n runs
+        of every nth trial is walked in order.  A target repeats the stim n
+        before it and anything else is drawn from the stims that differ from
+        it.  No chains to link up and no accidental matches, so the counts
+        are exact by construction, and any two stims are enough.'''
+
+        n_value = self.get_n()
+        block_length_total = n_value + self.get_length()
+
+        for modality in self.buffers:
+
+            modality_flag = TARGET_FLAGS[modality]
+            working_buffer = self.buffers[modality]
+            total_stims = self.get_working_total_stims(modality)
+
+            for run_start in range(min(n_value, block_length_total)):
+
+                working_buffer[run_start] = rng.randrange(0, total_stims)
+
+                for i in range((run_start + n_value), block_length_total,
+                               n_value):
+
+                    if self.placement[i] & modality_flag:
 
-        self._fill_non_matches()
+                        working_buffer[i] = working_buffer[(i - n_value)]
 
-    def pair_cue_targets(self: 'StimList', chain_list: list,
-                         targets_modality: str) -> list:
+                    else:
+
+                        working_buffer[i] = _draw_allowed_stim(
+                            total_stims, {working_buffer[(i - n_value)]},
+                            rng)
+
+    def count_matches(self: 'StimSequence') -> dict:
+        '''Return how many trials match the trial n before them, for each
+        modality and for both at once.'''
+
+        n_value = self.get_n()
+        visual = self.buffers['visual']
+        aural = self.buffers['aural']
+        counts = {'visual': 0, 'aural': 0, 'both': 0}
+
+        for i in range(n_value, len(visual)):
+
+            visual_match = visual[i] == visual[(i - n_value)]
+            aural_match = aural[i] == aural[(i - n_value)]
+            counts['visual'] = counts['visual'] + visual_match
+            counts['aural'] = counts['aural'] + aural_match
+            counts['both'] = counts['both'] + (visual_match and aural_match)
+
+        return counts
+
+    def validate_counts(self: 'StimSequence') -> None:
+        '''Raise TargetCountError unless the matches are exactly the targets
+        asked for.  A 'both' target counts as a match in each modality.'''
+
+        expected = {
+            'visual': (self.targets['visual'] + self.targets['both']),
+            'aural': (self.targets['aural'] + self.targets['both']),
+            'both': self.targets['both']}
+        counts = self.count_matches()
+
+        if counts != expected:
+
+            raise TargetCountError('Made ' + str(counts) + ' but ' +
+                                   str(expected) + ' expected.')
+
+    def pair_cue_targets(self: 'StimSequence', chain_list: list,
+                         targets_modality: str, rng: object=None) -> list:
         '''Updates object's list of matched targets and cues along with
         unmatched intermediate stimulus.'''
 
+        rng = self._get_rng(rng)
+
+        total_stims = self.get_working_total_stims(targets_modality)
         last_stim_used = -1
-        stim_number = -1
 
         for chain in chain_list:
 
-            while stim_number == last_stim_used:
-
-                stim_number = randrange(
-                    0, self.get_working_total_stims(targets_modality))
+            # Each chain differs from the one before, so one stim is too few
+            # for more than one chain.
+            stim_number = _draw_allowed_stim(total_stims, {last_stim_used},
+                                             rng)
 
             for index in chain:
 
@@ -172,132 +387,387 @@ class StimList(object):
 
             last_stim_used = stim_number
 
-    def _fill_non_matches(self: 'StimList') -> None:
+    def _fill_non_matches(self: 'StimSequence', rng: object=None) -> None:
         '''Fills in all positions that are not cues nor targets.'''
 
+        rng = self._get_rng(rng)
+
         block_n = self.get_n()
         stim_list_length = len(self.buffers['visual'])
 
-
         for modality in self.buffers:
 
-            for i in range(stim_list_length):
+            if ((numpy is not None) and
+                (stim_list_length >= BATCH_FILL_MIN_LENGTH) and
+                (block_n >= BATCH_FILL_MIN_N)):
 
-                if self.buffers[modality][i] == -1:
+                self._fill_non_matches_batched(modality, rng)
 
-                    write_value = False
-                    candidate_value = randrange(
-                        0, self.get_working_total_stims(modality))
+            else:
 
-                    while not write_value:
+                self._fill_non_matches_serial(modality, rng)
 
-                        # Do 3 cases, nothing before to compare, nothing after
-                        # to compare, midlist.  Check mislist first
-                        if (((((i - block_n) >= 0) and
-                              (self.buffers[modality][(i - block_n)] !=
-                               candidate_value)) and
-                             (((i + block_n) < stim_list_length) and
-                              (self.buffers[modality][(i + block_n)] !=
-                               candidate_value))) or
-                            ((((i - block_n) >= 0) and
-                              (self.buffers[modality][(i - block_n)] !=
-                               candidate_value)) and
-                             ((i + block_n) >= stim_list_length)) or
-                            ((((i + block_n) < stim_list_length) and
-                              (self.buffers[modality][(i + block_n)] !=
-                               candidate_value)) and ((i - block_n) < 0))):
+    def _fill_non_matches_serial(self: 'StimSequence', modality: str,
+                                 rng: object) -> None:
+        '''Fill the unset positions of one modality buffer in order, drawing
+        each directly from the stims that match neither neighbour n away.'''
 
-                            write_value = True
+        block_n = self.get_n()
+        working_buffer = self.buffers[modality]
+        stim_list_length = len(working_buffer)
+        total_stims = self.get_working_total_stims(modality)
 
-                        else:
+        for i in range(stim_list_length):
 
-                            candidate_value = randrange(
-                                0, self.get_working_total_stims(modality))
+            if working_buffer[i] != -1:
 
-                    self.buffers[modality][i] = candidate_value
+                continue
 
-    def link_up_chains(self: 'StimList', list_of_pairs: list) -> list:
-        '''Attempt to make nice cue target fun times.'''
+            # Unset neighbours hold -1, which is never a stim so does no harm.
+            forbidden = set()
 
-        list_of_matching_entries = []
+            if (i - block_n) >= 0:
 
-        # first sort list, this sorts by first entry of each sublist.
-        list_of_pairs.sort()
+                forbidden.add(working_buffer[(i - block_n)])
 
-        # Next note all targets unique, all cues unique.  So, only one instance
-        # of an index as a cue can exist, same for target.  However, a target
-        # can be a cue.  Apply this fact.
+            if (i + block_n) < stim_list_length:
 
-        while len(list_of_pairs) > 0:
+                forbidden.add(working_buffer[(i + block_n)])
 
-            working_entry = list_of_pairs.pop(0)
+            working_buffer[i] = _draw_allowed_stim(total_stims, forbidden,
+                                                   rng)
 
-            # Have smallest [cue, target] pair isolated now.  See if target is also
-            # a cue.  If so, meld together and check next, if not, pop out next
-            # smallest and test that until no more to check.
+    def _fill_non_matches_batched(self: 'StimSequence', modality: str,
+                                  rng: object) -> None:
+        '''Numpy version of _fill_non_matches_serial for long blocks.
 
-            check_again = True
+        Positions inside any run of n consecutive positions never constrain
+        each other (their neighbours are n away), so each run is filled with
+        one vectorized draw once the run before it is done.'''
 
-            while check_again:
+        block_n = self.get_n()
+        working_buffer = numpy.array(self.buffers[modality], dtype=numpy.int64)
+        stim_list_length = len(working_buffer)
+        total_stims = self.get_working_total_stims(modality)
+        if isinstance(rng, _NumpyRandom):
 
-                check_again = False
+            numpy_rng = rng.generator
 
-                entries_to_pop = []
+        else:
 
-                for entry in list_of_pairs:
-                
-                    if entry[0] == working_entry[-1]:
+            # Seeded from rng so a seeded sequence still comes out the same.
+            numpy_rng = numpy.random.default_rng(rng.randrange(2 ** 63))
 
-                        working_entry.append(entry[1])
-                        entries_to_pop.append(entry)
+        # Sentinel larger than any stim, so comparisons against it never hit.
+        no_stim = numpy.int64(total_stims + 2)
 
-                        # Well, before we move on, see if now some other pair
-                        # links in to this chain.
-                        check_again = True
+        for run_start in range(0, stim_list_length, block_n):
 
-                if len(entries_to_pop) > 0:
-                
-                    # Only pop out a pair if we bound it to a chain.
-                    for pair in entries_to_pop:
-                    
-                        list_of_pairs.pop(list_of_pairs.index(pair))
-                    
-            list_of_matching_entries.append(working_entry)
-            # Chain or pair, this is now to be outputted
+            run = numpy.arange(run_start,
+                               min((run_start + block_n), stim_list_length))
+            run = run[working_buffer[run] == -1]
 
-        return list_of_matching_entries
+            if len(run) == 0:
 
-    def _place_stimulus_objects(self: 'StimList') ->  None:
-        '''Place image and sound objects into the respective buffers as a list
-        whose elements are a list with the image object at index 0 and the
-        sound object at index 1.'''
+                continue
 
-        buffer_object_keys = list(self.buffers.keys())
-        final_buffer = []
+            before = numpy.full(len(run), -1, dtype=numpy.int64)
+            has_before = (run - block_n) >= 0
+            before[has_before] = working_buffer[(run[has_before] - block_n)]
+            after = numpy.full(len(run), -1, dtype=numpy.int64)
+            has_after = (run + block_n) < stim_list_length
+            after[has_after] = working_buffer[(run[has_after] + block_n)]
 
-        for i in range(self.parent.session_settings.get_total_block_length()):
+            # Up to two distinct forbidden stims per position, sorted low/high.
+            before_ok = before >= 0
+            after_ok = (after >= 0) & (after != before)
+            low = numpy.where(before_ok & after_ok,
+                              numpy.minimum(before, after),
+                              numpy.where(before_ok, before,
+                                          numpy.where(after_ok, after,
+                                                      no_stim)))
+            high = numpy.where(before_ok & after_ok,
+                               numpy.maximum(before, after), no_stim)
+            choices = total_stims - before_ok - after_ok
 
-            stims_at_point = [self.all_image_targets[
-                self.buffers[buffer_object_keys[
-                    buffer_object_keys.index('visual')]][i]],
-                              self.all_sound_targets[
-                                  self.buffers[buffer_object_keys[
-                                      buffer_object_keys.index('aural')]][i]]]
+            if (choices < 1).any():
 
-            final_buffer.append(stims_at_point)
+                raise ValueError('Not enough stims to avoid a match.')
 
-        return final_buffer
+            # Draw an index into the allowed stims, then step over the
+            # forbidden ones to turn it into the stim itself.
+            drawn = numpy_rng.integers(0, choices)
+            drawn = drawn + (drawn >= low)
+            drawn = drawn + (drawn >= high)
+            working_buffer[run] = drawn
 
-    def get_buffers(self: 'StimList') -> list:
-        '''Return a list of sound and image objects blah blah blah.'''
+        self.buffers[modality][:] = array(
+            'b', working_buffer.astype(numpy.int8).tobytes())
 
-        return self._place_stimulus_objects()
-        #return list(zip(self.buffers['visual'], self.buffers['aural']))
+    def link_up_chains(self: 'StimSequence', list_of_pairs: list) -> list:
+        '''Attempt to make nice cue target fun times.  See module level
+        link_up_chains for details.'''
 
-    def make_buffer(self: 'StimList') -> None:
-        '''Main procedural engine.'''
+        return link_up_chains(list_of_pairs)
 
-        self._refresh_attributes()
+    def generate(self: 'StimSequence', rng: object=None,
+                 seed: int=None) -> None:
+        '''Build a fresh sequence from the present attributes.
+
+        Draws from rng, or the sequence's own rng, if given.  Otherwise a
+        random.Random seeded with seed is used, a new seed being picked if
+        none given.  The seed is kept in self.seed so the same sequence can be
+        built again, it is None when an outside rng was used.'''
+
+        if ((rng is None) and ((self.rng is None) or (seed is not None))):
+
+            if seed is None:
+
+                seed = _seed_source.randrange(2 ** 63)
+
+            rng = random.Random(seed)
+
+        else:
+
+            seed = None
+
+        self.seed = seed
+        self.reset()
         self.make_index_list()
-        self.place_targets()
-        self.place_stims()
\ No newline at end of file
+        self.place_targets(rng)
+        self.place_stims(rng=rng)
+
+
+def build_sequence(spec: tuple) -> StimSequence:
+    '''Return a newly generated sequence for spec, as from get_spec.'''
+
+    sequence = StimSequence(*spec)
+    sequence.generate()
+
+    return sequence
+
+
+# Session settings the sequences are built from, and those the image and
+# sound objects are made from.
+SEQUENCE_SETTINGS = frozenset(['current_n', 'session_length_before_n',
+                               'number_of_targets'])
+STIMULUS_SETTINGS = frozenset(['number_of_targets', 'background_colour',
+                               'target_colour', 'fixator_colour'])
+
+
+class StimList(StimSequence):
+    '''Stimulus buffer for the application, kept in step with the session
+    settings and holding the image and sound objects for the stims.'''
+
+    def __init__(self: 'StimList', parent: 'DualNBackMainWindow') -> None:
+
+        self.parent = parent
+
+        self.all_image_targets = []
+        self.all_sound_targets = []
+        # Targets the image and sound objects were made for.
+        self.number_of_targets = \
+            self.parent.session_settings.get_number_targets()
+        # Next few buffers are built on a worker thread ahead of time.
+        self.pool = StimPool.StimBufferPool(build_sequence)
+
+        # The application always wants exactly the targets it asks for.
+        super(StimList, self).__init__(None, None, {}, {}, exact_counts=True)
+
+        self.parent.session_settings.settings_keys_changed.connect(
+            self._settings_changed)
+        self._refresh_attributes()
+        self._make_stimulus_objects()
+        self.prefetch()
+
+    def _settings_changed(self: 'StimList', changed_keys: frozenset) -> None:
+        '''Redo only what the changed settings touch.  New sequence settings
+        drop pooled buffers built under the old ones and start on new ones,
+        new image settings rebuild the image and sound objects.  A number of
+        targets no grid can be made for is ignored, as the screens stay as
+        they were (see DualNBackMainWindow.set_images).'''
+
+        if 'number_of_targets' in changed_keys:
+
+            number_of_targets = \
+                self.parent.session_settings.get_number_targets()
+
+            try:
+
+                MakeImages.get_grid_size(number_of_targets)
+
+            except ValueError:
+
+                changed_keys = changed_keys - frozenset(['number_of_targets'])
+
+            else:
+
+                self.number_of_targets = number_of_targets
+
+        if changed_keys & SEQUENCE_SETTINGS:
+
+            self.pool.clear()
+            self._refresh_attributes()
+            self.prefetch()
+
+        if changed_keys & STIMULUS_SETTINGS:
+
+            self._make_stimulus_objects()
+
+    def _refresh_attributes(self: 'StimList') -> None:
+
+        self.n = self.parent.session_settings.get_n()
+        self.length = self.parent.session_settings.get_block_before_n()
+        self.targets = {'aural': self.parent.match_in_aural,
+                        'visual': self.parent.match_in_visual,
+                        'both': self.parent.match_in_both}
+        # Bigger grids have more locations than there are sounds.
+        self.how_many_stims = {
+            'aural': min(self.number_of_targets, len(os.listdir('sounds/'))),
+            'visual': self.number_of_targets}
+        self.reset()
+
+    def _make_stimulus_objects(self: 'StimList') -> None:
+
+        # Qt is only imported here, everything else in this module builds
+        # sequences without it (see GenerateBlocks).
+        import PySide.QtGui as QtGui
+
+        # Lists rebuilt from scratch each time, the registry makes this cheap
+        # since each file is only decoded the first time it is asked for.
+        self.all_image_targets = []
+        self.all_sound_targets = []
+        all_possible_image_targets = sorted(os.listdir('images/'))
+        all_possible_sound_targets = sorted(os.listdir('sounds/'))
+
+        for sound_file in all_possible_sound_targets:
+
+            # Registry hands out a single shared instance of each sound.
+            self.all_sound_targets.append(AssetRegistry.registry.get(
+                ('sounds/' + sound_file), QtGui.QSound))
+
+        screen_images = getattr(self.parent, 'screen_images', None)
+        # Images are looked up by integer location, in this order.
+        target_locations = MakeImages.get_target_locations(
+            self.number_of_targets)
+
+        if getattr(self.parent, 'composite_screens', False):
+
+            # No images at all, the task window paints these rectangles over
+            # the neutral screen instead.
+            self.all_image_targets = self.parent.image_set.get_target_rects()
+            return
+
+        if screen_images is not None:
+
+            # Rendered in memory, by target location, so no files to read.
+            for location in target_locations:
+
+                self.all_image_targets.append(
+                    QtGui.QPixmap.fromImage(screen_images[location]))
+
+            return
+
+        # Files are named screen<location>.png.
+        image_paths = {}
+
+        for path in all_possible_image_targets:
+
+            location = path[len('screen'):-len('.png')]
+
+            if (path.startswith('screen') and path.endswith('.png') and
+                location.isdigit() and os.path.isfile(('images/' + path))):
+
+                image_paths[int(location)] = 'images/' + path
+
+        for location in target_locations:
+
+            self.all_image_targets.append(AssetRegistry.registry.get(
+                image_paths[location], QtGui.QPixmap, _pixmap_bytes))
+
+        # All targets are organized, and their index in the list is a unique
+        # identifier for our purposes here.  Invoke the helper function that
+        # returns a list for each modality that has the index for the stim
+        # we want where the position in these lists are the position for the
+        #  occurance of that stim.
+
+    def get_buffers(self: 'StimList') -> 'StimBufferView':
+        '''Return a view of the present buffers that gives the image and
+        sound object for each trial.  No per trial lists are built.'''
+
+        return StimBufferView(self.buffers['visual'], self.buffers['aural'],
+                              self.all_image_targets, self.all_sound_targets)
+
+    def load_sequence(self: 'StimList', sequence: StimSequence) -> None:
+        '''Take on the buffers of an already built sequence.'''
+
+        self.placement = sequence.placement
+        self.valid_index = sequence.valid_index
+        self.buffers = sequence.buffers
+        self.seed = sequence.seed
+
+    def prefetch(self: 'StimList') -> None:
+        '''Have the pool build buffers for the present settings in the
+        background.  Best called when the user is idle.'''
+
+        self.pool.prefetch(self.get_spec())
+
+    def make_buffer(self: 'StimList', rng: object=None,
+                    seed: int=None) -> None:
+        '''Main procedural engine.  Takes a prebuilt sequence from the pool
+        when one is ready, otherwise builds one now.  Giving an rng or seed
+        (say the seed from a block log, to replay that block) always builds
+        now from it.'''
+
+        self._refresh_attributes()
+
+        if ((rng is None) and (seed is None)):
+
+            self.load_sequence(self.pool.pop(self.get_spec()))
+
+        else:
+
+            self.generate(rng, seed)
+
+        # Top the pool back up while the countdown runs.
+        self.prefetch()
+
+
+class StimBufferView(object):
+    '''Read only, zero copy view over the symbol buffers of one block.
+    Indexing gives the (image, sound) pair for a trial, image and sound give
+    just one of the two.'''
+
+    def __init__(self: 'StimBufferView', visual_symbols: array,
+                 aural_symbols: array, images: list, sounds: list) -> None:
+
+        # memoryviews share the arrays' memory rather than copying them.
+        self.visual_symbols = memoryview(visual_symbols)
+        self.aural_symbols = memoryview(aural_symbols)
+        self.images = images
+        self.sounds = sounds
+
+    def __len__(self: 'StimBufferView') -> int:
+
+        return len(self.visual_symbols)
+
+    def __getitem__(self: 'StimBufferView', index: int) -> tuple:
+
+        return (self.images[self.visual_symbols[index]],
+                self.sounds[self.aural_symbols[index]])
+
+    def image(self: 'StimBufferView', index: int) -> 'QtGui.QPixmap':
+        '''Return the image object for the trial at index.  With composited
+        screens this is the (x, y, width, height) of its target square.'''
+
+        return self.images[self.visual_symbols[index]]
+
+    def sound(self: 'StimBufferView', index: int) -> 'QtGui.QSound':
+        '''Return the sound object for the trial at index.'''
+
+        return self.sounds[self.aural_symbols[index]]
+
+    def __repr__(self: 'StimBufferView') -> str:
+
+        return ('visual: ' + str(self.visual_symbols.tolist()) +
+                '\naural: ' + str(self.aural_symbols.tolist()))
@@ -1,58 +1,497 @@
-'''Database object for Dual-n Back.'''
+'''Database object for Dual-n Back.
 
+Users, their sessions, the blocks of each session and the trials of each
+block each have a table, so saving a block only adds its own rows and a
+user's history is read by indexed ranges rather than as one big blob.
+
+Several kiosks may share the one database file, see ConnectionManager.'''
+
+import contextlib
 import datetime
-import pickle
 import os
+import sqlite3
+import time
+from array import array
+import BlockScoring
 
 class NoSuchUserError(Exception):
     pass
 
-#dbcon = sqlite3.connect('resources/nbackusers.db')
-#cur = dbcon.cursor()
-#cur.execute('select name from sqlite_master where type=\'table\'')
-#<sqlite3.Cursor object at 0x000000000313DAB0>
-#for t in cur:
-  #print(t[0])
+# Kept in the database as PRAGMA user_version.
+SCHEMA_VERSION = 1
+
+# Connection settings, see ConnectionManager.
+BUSY_TIMEOUT_MS = 5000
+CACHE_KIB = 16384
+STATEMENT_CACHE = 64
+# Queued writes are committed once this many rows or seconds have built up.
+BATCH_ROWS = 2000
+BATCH_SECONDS = 5
+
+SCORE_COLUMNS = [modality + '_' + score_name.replace(' ', '_')
+                 for modality in BlockScoring.MODALITIES
+                 for score_name in BlockScoring.SCORE_NAMES]
+BLOCK_COLUMNS = (['session_id', 'block_number', 'n', 'trial_count',
+                  'stim_exposure_ms', 'interstim_ms', 'finished'] +
+                 SCORE_COLUMNS +
+                 ['visual_mean_reaction_ms', 'aural_mean_reaction_ms',
+                  'mean_onset_error_ms'])
+TRIAL_COLUMNS = ['block_id', 'trial_index', 'visual_symbol', 'aural_symbol',
+                 'visual_pressed', 'aural_pressed', 'visual_score',
+                 'aural_score', 'onset_error_ns', 'visual_latency_ns',
+                 'aural_latency_ns']
+
+SCHEMA = ['''create table users (
+             user_id integer primary key,
+             user_name text not null unique,
+             hashed_password blob,
+             pw_salt blob,
+             active_account integer not null default 1,
+             account_created text not null)''',
+          '''create table sessions (
+             session_id integer primary key,
+             user_id integer not null references users (user_id),
+             started text not null,
+             ended text)''',
+          '''create index sessions_by_user on sessions (user_id, started)''',
+          '''create table blocks (
+             block_id integer primary key,
+             session_id integer not null references sessions (session_id),
+             block_number integer not null,
+             n integer not null,
+             trial_count integer not null,
+             stim_exposure_ms integer,
+             interstim_ms integer,
+             finished text not null, ''' +
+          ''.join([column + ' integer not null, '
+                   for column in SCORE_COLUMNS]) +
+          '''visual_mean_reaction_ms real,
+             aural_mean_reaction_ms real,
+             mean_onset_error_ms real)''',
+          '''create index blocks_by_session on blocks (session_id,
+                                                       block_number)''',
+          # Latencies are null for trials without a press.
+          '''create table trials (
+             block_id integer not null references blocks (block_id),
+             trial_index integer not null,
+             visual_symbol integer not null,
+             aural_symbol integer not null,
+             visual_pressed integer not null,
+             aural_pressed integer not null,
+             visual_score integer not null,
+             aural_score integer not null,
+             onset_error_ns integer,
+             visual_latency_ns integer,
+             aural_latency_ns integer,
+             primary key (block_id, trial_index)) without rowid''']
+
+# Statements are kept to the same text so the connection's statement cache
+# prepares each only once.
+SELECT_USER = 'select * from users where user_name = ?'
+INSERT_USER = ('insert into users (user_name, pw_salt, active_account, '
+               'account_created) values (?, ?, 1, ?)')
+INSERT_SESSION = 'insert into sessions (user_id, started) values (?, ?)'
+END_SESSION = 'update sessions set ended = ? where session_id = ?'
+INSERT_BLOCK = ('insert into blocks (' + ', '.join(BLOCK_COLUMNS) +
+                ') values (' + ', '.join(['?'] * len(BLOCK_COLUMNS)) + ')')
+INSERT_TRIALS = ('insert into trials (' + ', '.join(TRIAL_COLUMNS) +
+                 ') values (' + ', '.join(['?'] * len(TRIAL_COLUMNS)) + ')')
+SELECT_BLOCK_HISTORY = ('select blocks.*, sessions.started from sessions '
+                        'join blocks on blocks.session_id = '
+                        'sessions.session_id '
+                        'where sessions.user_id = ? and sessions.started >= ? '
+                        'and sessions.started < ? '
+                        'order by sessions.started, blocks.block_number')
+SELECT_TRIALS = 'select * from trials where block_id = ? order by trial_index'
+
+
+def get_block_record(results: dict, block_number: int, n: int,
+                     stim_exposure_ms: int, interstim_ms: int) -> dict:
+    '''Return the blocks row, less session_id, for the results of a
+    TaskWindow block.'''
+
+    summary = results['score summary']
+    record = {'block_number': block_number, 'n': n,
+              'trial_count': len(results['presented'].visual_symbols),
+              'stim_exposure_ms': stim_exposure_ms,
+              'interstim_ms': interstim_ms,
+              'finished': datetime.datetime.today().isoformat(),
+              'mean_onset_error_ms':
+              results['timing']['mean onset error ms']}
+
+    for modality in BlockScoring.MODALITIES:
+
+        for score_name in BlockScoring.SCORE_NAMES:
+
+            record[modality + '_' + score_name.replace(' ', '_')] = \
+                summary[modality][score_name]
+
+        record[modality + '_mean_reaction_ms'] = \
+            results['reaction times'][modality].get('mean ms')
+
+    return record
+
+
+def get_trial_rows(results: dict, keypress_log: 'KeypressLog') -> list:
+    '''Return the trials rows, less block_id, for the results of a
+    TaskWindow block and its keypress log.'''
+
+    presented = results['presented']
+    latencies = dict([[modality, keypress_log.get_trial_latencies(modality)]
+                      for modality in BlockScoring.MODALITIES])
+
+    return [(index, presented.visual_symbols[index],
+             presented.aural_symbols[index],
+             results['recorded']['visual'][index],
+             results['recorded']['aural'][index],
+             int(results['scoring']['visual'][index]),
+             int(results['scoring']['aural'][index]),
+             results['onset errors'][index],
+             latencies['visual'][index], latencies['aural'][index])
+            for index in range(len(presented.visual_symbols))]
+
+
+class LatencyHistogram(object):
+    '''Counts of latencies in buckets doubling in width, bucket k holding
+    those under 2 ** k microseconds and the last everything longer.'''
+
+    def __init__(self: 'LatencyHistogram', bucket_count: int=24) -> None:
+
+        self.counts = array('q', [0]) * bucket_count
+        self.count = 0
+        self.total_ns = 0
+        self.max_ns = 0
+
+    def record(self: 'LatencyHistogram', latency_ns: int) -> None:
+
+        bucket = min((len(self.counts) - 1),
+                     (max(0, latency_ns) // 1000).bit_length())
+        self.counts[bucket] = self.counts[bucket] + 1
+        self.count = self.count + 1
+        self.total_ns = self.total_ns + latency_ns
+        self.max_ns = max(self.max_ns, latency_ns)
+
+    def get_stats(self: 'LatencyHistogram') -> dict:
+        '''Return the count, mean and worst latency in milliseconds and the
+        nonempty buckets, keyed by their upper bound.'''
+
+        if self.count == 0:
+
+            return {'count': 0}
+
+        buckets = {}
+
+        for bucket, bucket_count in enumerate(self.counts):
+
+            if bucket_count == 0:
+
+                continue
+
+            if bucket == (len(self.counts) - 1):
+
+                buckets['longer'] = bucket_count
+
+            else:
+
+                buckets['under ' + str(2 ** bucket) + ' us'] = bucket_count
+
+        return {'count': self.count,
+                'mean ms': ((self.total_ns / self.count) / 1000000),
+                'max ms': (self.max_ns / 1000000),
+                'buckets': buckets}
+
+
+class ConnectionManager(object):
+    '''The connection to a database file shared by several kiosks.
+
+    The database is put in write ahead log mode so readers carry on while
+    another kiosk writes, and writers wait up to BUSY_TIMEOUT_MS for each
+    other rather than failing at once.
+
+    Writes that can wait are queued, as a function of the connection and a
+    row count, and committed together once batch_rows rows or batch_seconds
+    have built up, or when commit is called.  Each queued write is its own
+    savepoint, so one that fails is undone alone and its error raised once
+    the rest are committed.  How long every transaction took, from asking
+    for the write lock to commit, goes into commit_latencies.'''
+
+    def __init__(self: 'ConnectionManager', path: str,
+                 batch_rows: int=BATCH_ROWS,
+                 batch_seconds: float=BATCH_SECONDS) -> None:
+
+        # Transactions are begun and committed here, not by the module.
+        self.connection = sqlite3.connect(path,
+                                          timeout=(BUSY_TIMEOUT_MS / 1000),
+                                          isolation_level=None,
+                                          cached_statements=STATEMENT_CACHE)
+        self.connection.row_factory = sqlite3.Row
+
+        for pragma in ['journal_mode = wal',
+                       # Safe with write ahead logging, only a power cut can
+                       # lose the last commits.
+                       'synchronous = normal',
+                       'busy_timeout = ' + str(BUSY_TIMEOUT_MS),
+                       'cache_size = ' + str(-CACHE_KIB),
+                       'foreign_keys = on']:
+
+            self.connection.execute('pragma ' + pragma).fetchall()
+
+        self.batch_rows = batch_rows
+        self.batch_ns = int(batch_seconds * 1000000000)
+        self.pending = []
+        self.pending_rows = 0
+        self.first_pending_ns = None
+        self.commit_latencies = LatencyHistogram()
+
+    @contextlib.contextmanager
+    def transaction(self: 'ConnectionManager') -> sqlite3.Connection:
+        '''Context manager for a transaction committed straight away.'''
+
+        start_ns = time.perf_counter_ns()
+        self.connection.execute('begin immediate')
+
+        try:
+
+            yield self.connection
+
+            self.connection.execute('commit')
+
+        except BaseException:
+
+            if self.connection.in_transaction:
+
+                self.connection.execute('rollback')
+
+            raise
+
+        self.commit_latencies.record(time.perf_counter_ns() - start_ns)
+
+    def read(self: 'ConnectionManager', statement: str,
+             parameters: tuple=()) -> list:
+        '''Return the rows of a query, committing queued writes first so
+        they are seen.'''
+
+        self.commit()
+
+        return self.connection.execute(statement, parameters).fetchall()
+
+    def queue(self: 'ConnectionManager', write: 'callable',
+              rows: int=1) -> None:
+        '''Queue write(connection), which writes about rows rows, for the
+        next commit.'''
+
+        self.pending.append(write)
+        self.pending_rows = self.pending_rows + rows
+
+        if self.first_pending_ns is None:
+
+            self.first_pending_ns = time.perf_counter_ns()
+
+        self.commit_if_due()
+
+    def commit_if_due(self: 'ConnectionManager') -> None:
+        '''Commit queued writes if enough rows or time have built up.'''
+
+        if self.first_pending_ns is None:
+
+            return
+
+        if (self.pending_rows >= self.batch_rows or
+                (time.perf_counter_ns() - self.first_pending_ns) >=
+                self.batch_ns):
+
+            self.commit()
+
+    def commit(self: 'ConnectionManager') -> None:
+        '''Commit every queued write in one transaction.  If the transaction
+        fails as a whole, say with the database still locked by another
+        kiosk after the busy timeout, the writes stay queued for the next
+        try.'''
+
+        if len(self.pending) == 0:
+
+            return
+
+        writes = list(self.pending)
+        errors = []
+
+        with self.transaction():
+
+            for write in writes:
+
+                self.connection.execute('savepoint queued_write')
+
+                try:
+
+                    write(self.connection)
+
+                except sqlite3.Error as error:
+
+                    self.connection.execute('rollback to queued_write')
+                    errors.append(error)
+
+                self.connection.execute('release queued_write')
+
+        # Only dropped once committed.  Nothing can be queued meanwhile,
+        # writes are all queued on the one thread.
+        self.pending = []
+        self.pending_rows = 0
+        self.first_pending_ns = None
+
+        if len(errors) > 0:
+
+            raise errors[0]
+
+    def close(self: 'ConnectionManager') -> None:
+
+        try:
+
+            self.commit()
+
+        finally:
+
+            self.connection.close()
 
-import sqlite3
 
 class NBackUserDatabase(object):
-    '''Object that does our standard SQLite operations.'''
+    '''Object that does our standard SQLite operations.  Users and sessions
+    are written straight away, blocks and session ends are queued, see
+    ConnectionManager.'''
 
-    def __init__(self: 'NBackUserDatabase') -> None:
+    def __init__(self: 'NBackUserDatabase',
+                 path: str='resources/nbackusers.db',
+                 batch_rows: int=BATCH_ROWS,
+                 batch_seconds: float=BATCH_SECONDS) -> None:
         '''Object initialization.'''
 
-        self.db_connection = sqlite3.connect('resources/nbackusers.db')
-        # DB contains table "users (user_number integer primary key 
-        # autoincrement, user_name text, hashed_password text, pw_salt text,
-        # user_trivia blob, last_session_stats blob, full_history blob)"
-        # since user_number is auto incremented, do not assign directly,
-        # and must always use colum names.
+        self.connections = ConnectionManager(path, batch_rows, batch_seconds)
+        self.db_connection = self.connections.connection
         self.user_accnt = {}
 
-    def get_user(self: 'NBackUserDatabase', user_name: int) -> dict:
-        '''Return dictionary pickle of user.  If no such user exists, raises a
-        NoSuchUserError exception.'''
-        
-        cur = self.db_connection.cursor()
-        if user_name in cur:
-            user_data
-            #return it
-        raise NoSuchUserError
-    
-    def add_user(self: 'NBackUserDatabase', new_name: str) -> None:
-        
-        #cur.execute('''insert into users (user_display_name, session_details) values ('hitler', 12)''')
-        
-        #DB OBJECT not cursor commits
+        self._create_schema()
+
+    def _create_schema(self: 'NBackUserDatabase') -> None:
+        '''Create the tables if the database is new or from before them.'''
+
+        with self.connections.transaction():
+
+            version = self.db_connection.execute(
+                'pragma user_version').fetchone()[0]
+
+            if version >= SCHEMA_VERSION:
+
+                return
+
+            tables = [row[0] for row in self.db_connection.execute(
+                'select name from sqlite_master where type = \'table\'')]
+
+            # The old single table with pickled histories, kept as it was.
+            if 'users' in tables:
+
+                self.db_connection.execute(
+                    'alter table users rename to legacy_users')
+
+            for statement in SCHEMA:
+
+                self.db_connection.execute(statement)
+
+            self.db_connection.execute('pragma user_version = ' +
+                                       str(SCHEMA_VERSION))
+
+    def get_user(self: 'NBackUserDatabase', user_name: str) -> dict:
+        '''Return the users row of a user as a dictionary.  If no such user
+        exists, raises a NoSuchUserError exception.'''
+
+        rows = self.connections.read(SELECT_USER, (user_name,))
+
+        if len(rows) == 0:
+
+            raise NoSuchUserError(user_name)
+
+        self.user_accnt = dict(rows[0])
+
+        return self.user_accnt
+
+    def add_user(self: 'NBackUserDatabase', new_name: str) -> int:
+        '''Add a user and return their user_id.'''
+
+        # If active_account is False, no new sessions or other updating
+        # allowed.
+        with self.connections.transaction():
+
+            cursor = self.db_connection.execute(
+                INSERT_USER, (new_name, os.urandom(64),
+                              datetime.datetime.today().isoformat()))
+
+        return cursor.lastrowid
+
+    def start_session(self: 'NBackUserDatabase', user_id: int) -> int:
+        '''Start a session for a user now and return its session_id.'''
+
+        with self.connections.transaction():
+
+            cursor = self.db_connection.execute(
+                INSERT_SESSION,
+                (user_id, datetime.datetime.today().isoformat()))
+
+        return cursor.lastrowid
+
+    def end_session(self: 'NBackUserDatabase', session_id: int) -> None:
+
+        ended = datetime.datetime.today().isoformat()
+        self.connections.queue(lambda connection: connection.execute(
+            END_SESSION, (ended, session_id)))
+
+    def add_block(self: 'NBackUserDatabase', session_id: int, block: dict,
+                  trials: list) -> None:
+        '''Queue a block, given as from get_block_record, and its trials, as
+        from get_trial_rows.  They are written together or not at all.'''
+
+        block_row = [dict(block, session_id=session_id)[column]
+                     for column in BLOCK_COLUMNS]
+        trials = [tuple(trial) for trial in trials]
+
+        def write(connection: sqlite3.Connection) -> None:
+
+            block_id = connection.execute(INSERT_BLOCK, block_row).lastrowid
+            connection.executemany(INSERT_TRIALS,
+                                   [((block_id,) + trial)
+                                    for trial in trials])
+
+        self.connections.queue(write, (1 + len(trials)))
+
+    def get_block_history(self: 'NBackUserDatabase', user_id: int,
+                          since: str='', until: str=None) -> list:
+        '''Return the blocks of a user's sessions started from since up to
+        until, isoformat times, oldest first, as dictionaries.'''
+
+        if until is None:
+
+            until = datetime.datetime.max.isoformat()
+
+        return [dict(row) for row in self.connections.read(
+            SELECT_BLOCK_HISTORY, (user_id, since, until))]
+
+    def get_trials(self: 'NBackUserDatabase', block_id: int) -> list:
+        '''Return the trials of a block in order, as dictionaries.'''
+
+        return [dict(row) for row in self.connections.read(SELECT_TRIALS,
+                                                           (block_id,))]
+
+    def commit(self: 'NBackUserDatabase') -> None:
+        '''Commit queued writes now.'''
+
+        self.connections.commit()
+
+    def commit_if_due(self: 'NBackUserDatabase') -> None:
 
-        user_details ={}
-        # If active_account is False, no new sessions or other updating allowed
-        user_details['active_account'] = True
-        user_details['account_created'] = str(datetime.datetime.today())
+        self.connections.commit_if_due()
 
-        user_salt = os.urandom(64)
-        pass
+    def get_commit_stats(self: 'NBackUserDatabase') -> dict:
+        '''Return the commit latency figures, for monitoring.'''
 
+        return self.connections.commit_latencies.get_stats()
 
+    def close(self: 'NBackUserDatabase') -> None:
 
+        self.connections.close()
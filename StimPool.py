@@ -0,0 +1,139 @@
+'''Background pre-generation of stimulus buffers.'''
+
+import threading
+
+
+class StimBufferPool(object):
+    '''Holds up to depth ready built stimulus sequences for one spec.  The
+    sequences are built on a worker thread so that starting a block is only
+    a pop from the pool.
+
+    builder is called with a spec and must return a fully built sequence.  It
+    is run off the GUI thread, so it must not touch any Qt objects.  If it
+    raises, the worker stops and keeps the exception as error, and the
+    spec is not tried again in the background until the pool is cleared or
+    the spec changes.  pop still builds for it, so the caller sees the
+    error.'''
+
+    def __init__(self: 'StimBufferPool', builder: 'callable',
+                 depth: int=3) -> None:
+
+        self.builder = builder
+        self.depth = depth
+        self.spec = None
+        self.ready = []
+        # Bumped by every clear, so a sequence that was mid build when the
+        # pool was cleared is thrown away rather than pooled.
+        self.generation = 0
+        self.worker = None
+        self.error = None
+        self.failed_spec = None
+        self.hits = 0
+        self.misses = 0
+        self.condition = threading.Condition()
+
+    def prefetch(self: 'StimBufferPool', spec: tuple) -> None:
+        '''Start filling the pool for spec.  Anything pooled for a different
+        spec is dropped.'''
+
+        with self.condition:
+
+            if spec != self.spec:
+
+                self._drop_ready()
+                self.spec = spec
+
+            if ((self.worker is None) and (len(self.ready) < self.depth) and
+                    (spec != self.failed_spec)):
+
+                self.worker = threading.Thread(target=self._fill,
+                                               name='stim buffer pool')
+                # Never hold up application close for a buffer.
+                self.worker.daemon = True
+                self.worker.start()
+
+    def pop(self: 'StimBufferPool', spec: tuple) -> object:
+        '''Return a sequence built for spec, from the pool if one is ready,
+        otherwise built right now.'''
+
+        with self.condition:
+
+            if ((spec == self.spec) and (len(self.ready) > 0)):
+
+                self.hits = self.hits + 1
+                return self.ready.pop(0)
+
+            self.misses = self.misses + 1
+
+        return self.builder(spec)
+
+    def clear(self: 'StimBufferPool') -> None:
+        '''Drop every pooled sequence.  Called when settings change.'''
+
+        with self.condition:
+
+            self._drop_ready()
+            self.spec = None
+            self.error = None
+            self.failed_spec = None
+
+    def __len__(self: 'StimBufferPool') -> int:
+
+        with self.condition:
+
+            return len(self.ready)
+
+    def _drop_ready(self: 'StimBufferPool') -> None:
+        '''Empty the pool, caller must hold the condition.'''
+
+        self.ready = []
+        self.generation = self.generation + 1
+
+    def _fill(self: 'StimBufferPool') -> None:
+        '''Worker thread loop, builds until the pool is full.'''
+
+        try:
+
+            while True:
+
+                with self.condition:
+
+                    if ((self.spec is None) or
+                            (len(self.ready) >= self.depth)):
+
+                        self.worker = None
+                        return
+
+                    spec = self.spec
+                    generation = self.generation
+
+                # Building is the slow part, so do it without the lock held.
+                try:
+
+                    sequence = self.builder(spec)
+
+                except Exception as error:
+
+                    with self.condition:
+
+                        self.error = error
+                        self.failed_spec = spec
+                        self.worker = None
+
+                    return
+
+                with self.condition:
+
+                    if generation == self.generation:
+
+                        self.ready.append(sequence)
+
+        finally:
+
+            # Whatever happened, never leave prefetch thinking this thread is
+            # still at work.  A newer worker may already have taken over.
+            with self.condition:
+
+                if self.worker is threading.current_thread():
+
+                    self.worker = None
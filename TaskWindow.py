@@ -1,7 +1,11 @@
 '''Task Window and friends.'''
 
+import time
+from array import array
 import PySide.QtCore as QtCore
 import PySide.QtGui as QtGui
+import BlockScoring
+import TrialTiming
 #from time import sleep
 
 class CountDown(QtGui.QWidget):
@@ -81,12 +85,10 @@ class TaskWindow(QtGui.QLabel):
 
 
 
-    # TODO: First sound stim always late.
-
-
-
     task_done = QtCore.Signal()
     log_worthy = QtCore.Signal()
+    # Emitted each time a trial is scored, see self.scorer for the figures.
+    trial_scored = QtCore.Signal()
 
     def __init__(self: 'TaskWindow', parent: 'DualNBackMainWindow') -> None:
 
@@ -99,32 +101,61 @@ class TaskWindow(QtGui.QLabel):
 
         self.results = {}
 
-        self.parent.stimulus_buffer._refresh_attributes()
+        # Buffer usually comes ready made from the stimulus buffer pool.
         self.parent.stimulus_buffer.make_buffer()
         # Now can fetch.
         self.stim_buffer_local = self.parent.stimulus_buffer.get_buffers()
-        # Local copy costs memory but saves io
+        # Only a view over the stimulus buffer's symbol arrays, so cheap.
+        # Logged so the block can be rebuilt with make_buffer(seed=...).
+        self.block_seed = self.parent.stimulus_buffer.seed
 
         self.block_length = self.parent.session_settings.\
             get_total_block_length()
         self.block_n = self.parent.session_settings.get_n()
         self.stim_resp_index = -1  # To guarantee we actually start on index 0.
-        self.keypresses = []
+        # One byte per trial for each modality, each starts as no keypress.
+        self.keypresses = {'visual': bytearray(self.block_length),
+                           'aural': bytearray(self.block_length)}
+        # Every press with its time, for reaction times.
+        self.keypress_log = TrialTiming.KeypressLog(self.block_length)
         self.block_finished = False
+        # Each trial is scored as soon as its response window closes.
+        self.scorer = BlockScoring.IncrementalScorer(
+            {'visual': self.stim_buffer_local.visual_symbols,
+             'aural': self.stim_buffer_local.aural_symbols}, self.block_n)
 
-        self.show_stim_timer = QtCore.QTimer(self)
-        self.show_blank_timer = QtCore.QTimer(self)
         self.stim_expose_time = self.parent.session_settings.\
             get_stim_exposure_time()
         self.interstim_time = self.parent.session_settings.get_interstim_time()
+        # Every onset and offset is timed from block start, so no drift.
+        # Sounds run ahead of or behind images by the learned compensation.
+        self.scheduler = TrialTiming.TrialScheduler(
+            self.block_length, self.stim_expose_time, self.interstim_time,
+            self, self.parent.av_compensation_ns)
+        # When each trial's image and sound actually went out.
+        self.av_sync = TrialTiming.AVSyncLog(self.block_length)
+        # Trial whose image is waiting to be painted, -1 for none.
+        self.paint_pending = -1
+        # Preloaded sounds mixed into one open stream, None to use QSound.
+        self.audio_engine = self.parent.audio_engine
+        # Expected time from each trigger until the sound is heard, in
+        # nanoseconds, as reported by the audio engine.
+        self.audio_latencies = array('q', [0]) * self.block_length
         self.neutral_screen = self.parent.neutral_screen
+        # With composited screens the neutral screen stays up and each
+        # target square is painted over it, in the colour set right now.
+        self.composite_screens = self.parent.composite_screens
+        self.target_colour = QtGui.QColor(
+            *self.parent.session_settings.get_tg_colour()[:3])
+        # (x, y, width, height) of the square showing, None for none.
+        self.target_rect = None
         self.visual_key = self.parent.visual_key
         self.aural_key = self.parent.aural_key
         self.block_number = self.parent.blocks_run_so_far + 1
         self.total_blocks_to_be_run = self.parent.session_settings.\
             get_total_session_blocks()
 
-        self.log_report = ''
+        self.log_report = {}
 
         self.__init_ui()
 
@@ -135,18 +166,12 @@ class TaskWindow(QtGui.QLabel):
         # WindowFullScreen removes all borders and the like for us, so, done
         # configuring the window, it's already all a label anyway.
 
-        for i in range(self.block_length):
-
-            # Makes list such that each entry assumes no keypresses have taken
-            # place.
-            self.keypresses.append([False, False])
-
         self.setPixmap(self.neutral_screen)
 
-        self.show_stim_timer.timeout.connect(self.stim_presentation_end)
-        self.show_blank_timer.timeout.connect(self.present_all_stims)
-        self.show_stim_timer.setInterval(self.stim_expose_time)
-        self.show_blank_timer.setInterval(self.interstim_time)
+        self.scheduler.stim_sound.connect(self.present_sound)
+        self.scheduler.stim_onset.connect(self.present_all_stims)
+        self.scheduler.stim_offset.connect(self.stim_presentation_end)
+        self.scheduler.block_finished.connect(self.task_end)
 
         self.grabKeyboard()
         self.setCursor(QtCore.Qt.BlankCursor)  # While task runs no cursor is
@@ -154,18 +179,23 @@ class TaskWindow(QtGui.QLabel):
 
         self._creation_string()   
 
-    def _log_it(self: 'TaskWindow') -> None:
-        '''Have parent application log and reset log string.'''
+    def _log_it(self: 'TaskWindow', kind: str, **fields) -> None:
+        '''Have parent application log an event of this kind with these
+        fields, see EventLog, and reset the log report.'''
 
+        self.log_report = dict(fields)
+        self.log_report['kind'] = kind
         self.log_worthy.emit()
 
         # Clear for next entry.
-        self.log_report = ''
+        self.log_report = {}
 
     def keyPressEvent(self: 'TaskWindow', event: QtGui.QKeyEvent) -> None:
         '''Reimplementation to catch and record key presses relevant to
         testing only.'''
 
+        # Timestamp before anything else so handler run time doesn't count.
+        now_ns = time.perf_counter_ns()
         key = event.key()
 
         # Note: No way to abort test as it stands, need to consider how to
@@ -175,46 +205,49 @@ class TaskWindow(QtGui.QLabel):
         # We assign True to say only a keypress existed for this stimulus, we
         # make no judgement yet on if a keypress was appropriate.
 
+        # Before the first stimulus or after the last there is no trial to
+        # respond to.
+        if not (0 <= self.stim_resp_index < self.block_length):
+
+            return
+
         if ((key == self.visual_key) or (key == self.aural_key)):
 
+            onset_ns = self.scheduler.schedule.actual_onsets[
+                self.stim_resp_index]
+
             if key == self.visual_key:
 
-                # Assumption, entry 0 is visual.
                 # Note: already knows how to index this by stim_resp_index
                 # refernce.
-                self.keypresses[self.stim_resp_index][0] = True
+                self.keypresses['visual'][self.stim_resp_index] = 1
+                self.keypress_log.record(self.stim_resp_index, 0, now_ns,
+                                         onset_ns)
                 return
 
-            self.keypresses[self.stim_resp_index][1] = True
+            self.keypresses['aural'][self.stim_resp_index] = 1
+            self.keypress_log.record(self.stim_resp_index, 1, now_ns,
+                                     onset_ns)
 
-    def _creation_string(self: 'TaskWindow') -> str:
+    def _creation_string(self: 'TaskWindow') -> None:
         '''Log the creation time and settings for task window.'''
 
         # Logging function itself inserts time of entry, so assumed included.
 
-        # Modular so if wish to change what is logged, much easier.
-        block_length_string = ('\nThis block length: ' +
-                               str(self.block_length) +
-                               '.\n')
-        block_n_string = ('\nThis block n: ' + str(self.block_n) + '.\n')
-        block_stim_present = ('\nThis block stimulus presentation time '
-                               '(Note: for visual stimulus only): ' +
-                               str(self.stim_expose_time) + ' milliseconds.\n')
-        block_interstim = ('\nThis block interstimulus screen: ' +
-                           str(self.interstim_time) + ' milliseconds.\n')
-        block_visual_key = ('\nThis block key to indicate visual match: ' +
-                            chr(int(self.visual_key)) + '.\n')
-        block_aural_key = ('\nThis block key to indicate aural match: ' +
-                            chr(int(self.aural_key)) + '.\n')
-        block_stim_set = ('\nThis block stimulus set:\n' +
-                          str(self.stim_buffer_local) + '\n')
-
-        self.log_report = ('\nTask window opened.\n' + block_length_string +
-                           block_n_string + block_stim_present +
-                           block_interstim + block_visual_key +
-                           block_aural_key + block_stim_set)
-
-        self._log_it()
+        # Stims logged as their symbol ids, stim_exposure_ms is for the
+        # visual stimulus only.
+        visual_symbols = self.stim_buffer_local.visual_symbols.tolist()
+        aural_symbols = self.stim_buffer_local.aural_symbols.tolist()
+
+        self._log_it('task window opened', block_number=self.block_number,
+                     block_length=self.block_length, n=self.block_n,
+                     stim_exposure_ms=self.stim_expose_time,
+                     interstim_ms=self.interstim_time,
+                     visual_key=chr(int(self.visual_key)),
+                     aural_key=chr(int(self.aural_key)),
+                     seed=self.block_seed,
+                     visual_symbols=visual_symbols,
+                     aural_symbols=aural_symbols)
 
     def _start_block(self: 'TaskWindow') -> None:
         '''Provided for a last interupt point before we get going.'''
@@ -224,143 +257,129 @@ class TaskWindow(QtGui.QLabel):
                 'all blocks': self.total_blocks_to_be_run}
 
         self.show()
+
+        # Stream opened now and kept open, so the first sound is not late.
+        if self.audio_engine is not None:
+
+            self.audio_engine.start()
+
         # Showing self early since sleep wasn't giving the right effect.
         self.countdown_msg = CountDown(info)
-        self.countdown_msg.count_done.connect(self.present_all_stims)
+        self.countdown_msg.count_done.connect(self.scheduler.start)
         
         self.countdown_msg.start_countdown()
 
-    def present_all_stims(self: 'TaskWindow') -> None:
-        '''Engine for presentation of testing block.'''
+    def paintEvent(self: 'TaskWindow', event: QtGui.QPaintEvent) -> None:
+        '''Reimplementation to paint the target square with composited
+        screens, and to time when a new stimulus is actually painted.'''
 
-        self.show_blank_timer.stop()
+        super(TaskWindow, self).paintEvent(event)
 
-        self.stim_resp_index = self.stim_resp_index + 1
+        if self.target_rect is not None:
 
-        # Just check to see if we are done.
-        if self.stim_resp_index >= self.block_length:
+            x, y, width, height = self.target_rect
+            painter = QtGui.QPainter(self)
+            painter.fillRect(x, y, width, height, self.target_colour)
+            painter.end()
 
-            self.task_end()
-            return
+        if self.paint_pending >= 0:
 
-        stim_to_present = self.stim_buffer_local[self.stim_resp_index]
-        self.stim_buffer_local[self.stim_resp_index][1].play()
-        self.setPixmap(self.stim_buffer_local[self.stim_resp_index][0])
-        self.update()  # Keeping up visually so sound/sight approx in sync.
-        
-        self.show_stim_timer.start()
+            self.av_sync.record_visual(self.paint_pending,
+                                       time.perf_counter_ns())
+            self.paint_pending = -1
 
-    def stim_presentation_end(self: 'TaskWindow') -> None:
-        '''Display a neutral screen and finish waiting between stimulus.
-        Continue to monitor for response whole time.'''
+    def present_sound(self: 'TaskWindow', trial_index: int) -> None:
+        '''Play the sound of a trial.  Called by the scheduler, just ahead of
+        or behind the image as set by the audio visual compensation.'''
 
-        self.show_stim_timer.stop()
+        if self.audio_engine is not None:
 
-        self.setPixmap(self.neutral_screen)
-        self.update()
-
-        self.show_blank_timer.start()
-
-    def _score_block(self: 'TaskWindow', reference_dict: dict) -> list:
-        '''Score results for block according to these rules:
-        -If match detected (true positive) recorded as 0.
-        -If mismatch ignored (true negative) recorded as 1.
-        -If match ignored (false negative) recorded as 2.
-        -If mismatch responded to (false positive) recorded as 3.
-        and return as list of lists, with each sublist having stimulus scores
-        for visual at 0 and aural at 1.'''
-
-        # WARNING!: test this.  Lots.
+            latency = self.audio_engine.trigger(
+                self.stim_buffer_local.aural_symbols[trial_index])
+            self.av_sync.record_audio(trial_index, time.perf_counter_ns(),
+                                      latency)
+            self.audio_latencies[trial_index] = latency
+            return
 
-        scoring_list = []
+        # QSound gives no latency figure, so only the call is timed.
+        self.stim_buffer_local.sound(trial_index).play()
+        self.av_sync.record_audio(trial_index, time.perf_counter_ns())
 
-        for count in range(self.block_length):
+    def present_all_stims(self: 'TaskWindow', trial_index: int) -> None:
+        '''Engine for presentation of testing block.  Called by the
+        scheduler at the onset of each trial, shows the image.'''
 
-            scoring_list.append([0, 0])
+        # Response window for the last trial closes as this one starts.
+        if self.stim_resp_index >= 0:
 
-            # NOTE: since 0's added, can just adapt to that.
+            self.scorer.score_next(self.keypresses)
+            self.trial_scored.emit()
 
-        for index in range(self.block_length):
+        self.stim_resp_index = trial_index
 
-            # So each modality also tested:
+        if self.composite_screens:
 
-            for visual_or_aural in range(2):
+            # Only the square needs painting, see paintEvent.
+            self.target_rect = self.stim_buffer_local.image(
+                self.stim_resp_index)
+            self.paint_pending = self.stim_resp_index
+            self.update(*self.target_rect)
+            return
 
-                # Mismatch of false positive type detected first.  If respond
-                # before n presentations, must also be included as a false
-                # positive.
+        self.setPixmap(self.stim_buffer_local.image(self.stim_resp_index))
+        self.paint_pending = self.stim_resp_index
+        self.update()
 
-                if ((((index - self.block_n) < 0)
-                    and (True ==
-                         reference_dict['recorded'][index][visual_or_aural]))
-                    or ((True ==
-                         reference_dict['recorded'][index][visual_or_aural])
-                        and
-                        (reference_dict['presented'][index][visual_or_aural]
-                         != reference_dict['presented'][(
-                             index - self.block_n)][visual_or_aural]))):
+    def stim_presentation_end(self: 'TaskWindow', trial_index: int) -> None:
+        '''Display a neutral screen and finish waiting between stimulus.
+        Continue to monitor for response whole time.'''
 
-                    scoring_list[index][visual_or_aural] = 3
+        if self.composite_screens:
 
-                # False negative next.
+            # Repainting where the square was leaves the neutral screen.
+            if self.target_rect is not None:
 
-                elif ((False ==
-                       reference_dict['recorded'][index][visual_or_aural]) and
-                      (reference_dict['presented'][index][visual_or_aural]
-                       == reference_dict['presented'][(
-                           index - self.block_n)][visual_or_aural])):
+                old_rect = self.target_rect
+                self.target_rect = None
+                self.update(*old_rect)
 
-                    scoring_list[index][visual_or_aural] = 2
+            return
 
-                # True negative next.
+        self.setPixmap(self.neutral_screen)
+        self.update()
 
-                elif ((False ==
-                       reference_dict['recorded'][index][visual_or_aural]) and
-                      (reference_dict['presented'][index][visual_or_aural]
-                       != reference_dict['presented'][(
-                           index - self.block_n)][visual_or_aural])):
+    def _score_block(self: 'TaskWindow', reference_dict: dict) -> dict:
+        '''Score results for block according to these rules:
+        -If match detected (true positive) recorded as 0.
+        -If mismatch ignored (true negative) recorded as 1.
+        -If match ignored (false negative) recorded as 2.
+        -If mismatch responded to (false positive) recorded as 3.
+        and return as a dictionary with an array of scores for each of
+        'visual' and 'aural'.  Responding within the first n trials is
+        always a false positive.  See BlockScoring for the details.
 
-                    scoring_list[index][visual_or_aural] = 1
+        Blocks are scored trial by trial while running (self.scorer), this
+        scores a whole block at once, say to rescore recorded results.'''
 
-                # All that remains must be true positives.
+        # Scored from the symbol ids, not the image and sound objects.
+        presented = {'visual': reference_dict['presented'].visual_symbols,
+                     'aural': reference_dict['presented'].aural_symbols}
 
-        return scoring_list
+        return BlockScoring.score_block(presented, reference_dict['recorded'],
+                                        self.block_n)
 
-    def _score_summary(self: 'TaskWindow') -> None:
+    def _score_summary(self: 'TaskWindow') -> dict:
         '''Return a quick reference summary of user score on task block.'''
 
-        # Visual at index 0, aural at index 1 in scoring to be analysed.
-
-        score_sum_dict = {}
-        sub_dict_names = ['visual', 'aural']  # names at logical index location
-        key_code_list = ['true positive', 'true negative',
-                         'false negative', 'false positive']
-        # I admit I'm being a little too cleaver in positioning here, so if
-        # you change the scoring method you really have to make sure indices 
-        # align again in all functions.
-
-        for sub_dict in sub_dict_names:
+        # Keys in each modality are 'true positive', 'true negative',
+        # 'false negative' and 'false positive', counted as the block ran,
+        # plus 'reaction time'.
+        score_sum_dict = self.scorer.get_summary()
 
-            score_sum_dict[sub_dict] = {}
+        for modality in score_sum_dict:
 
-        # Looping twice is a little clunky, but if revised later will be easier
-        # to change.
-
-        for sub_dict in sub_dict_names:
-
-            for score_type in key_code_list:
-
-                score_sum_dict[sub_dict][score_type] = 0
-
-        for entry in self.results['scoring']:
-
-            for visual_or_aural in range(2):
-
-                key_index = key_code_list[entry[visual_or_aural]]
-
-                score_sum_dict[sub_dict_names[visual_or_aural]][key_index] = (
-                    score_sum_dict[sub_dict_names[visual_or_aural]][key_index]
-                    + 1)
+            score_sum_dict[modality]['reaction time'] = self.results[
+                'reaction times'][modality]
 
         return score_sum_dict
 
@@ -368,8 +387,7 @@ class TaskWindow(QtGui.QLabel):
         '''Initial organization and logging at head of task.'''
         # This is really the best place to add any other interupts.
 
-        self.log_report = '\nBlock started.\n'
-        self._log_it()
+        self._log_it('block started', block_number=self.block_number)
 
         if not (self.parent.session_settings.get_total_block_length() >=
             self.parent.blocks_run_so_far):
@@ -377,24 +395,53 @@ class TaskWindow(QtGui.QLabel):
             #ummmmmm, fix this by moving to main app.
             self.parent.status_bar.showMessage('This round complete.')
 
-        self.present_all_stims()
+        self.scheduler.start()
 
     def task_end(self: 'TaskWindow') -> None:
         '''End of task block clean up and organization.'''
 
-        self.show_blank_timer.stop()
-        
-        self.log_report = str('\nBlock ' +
-                              str(self.parent.blocks_run_so_far + 1) +
-                              ' completed.\n')
-        self._log_it()
+        self.scheduler.stop()
+
+        if self.audio_engine is not None:
+
+            self.audio_engine.stop()
+
+        self._log_it('block completed', block_number=self.block_number)
+
+        # Trials were scored as the block ran, only finalizing left to do.
+        self.scorer.finish(self.keypresses)
 
         self.results['recorded'] = self.keypresses
         self.results['presented'] = self.stim_buffer_local
-        self.results['scoring'] = self._score_block(self.results)
+        self.results['scoring'] = self.scorer.codes
+        self.results['reaction times'] = dict(
+            [[modality, BlockScoring.reaction_time_stats(
+                self.keypress_log.get_latencies(modality))]
+             for modality in BlockScoring.MODALITIES])
         self.results['score summary'] = self._score_summary()
-
-        self.log_report = ('\nResult dictionary:\n' + str(self.results))
-        self._log_it()
+        # Actual less intended onset of every trial, in nanoseconds.
+        self.results['onset errors'] = self.scheduler.schedule.onset_errors
+        self.results['timing'] = self.scheduler.schedule.get_error_stats()
+
+        if self.audio_engine is not None:
+
+            self.results['audio latencies'] = self.audio_latencies
+            self.results['audio latency'] = {
+                'mean ms': ((sum(self.audio_latencies) / self.block_length) /
+                            1000000),
+                'max ms': (max(self.audio_latencies) / 1000000)}
+
+        # Sound less image time of each trial, nanoseconds.
+        self.results['av offsets'] = self.av_sync.get_offsets()
+        self.results['av sync'] = self.av_sync.get_stats()
+
+        # Everything but the stims themselves is plain data already.  Those
+        # views share the stimulus buffer's memory, so copied out as lists.
+        loggable_results = dict(self.results)
+        loggable_results['presented'] = {
+            'visual': self.stim_buffer_local.visual_symbols.tolist(),
+            'aural': self.stim_buffer_local.aural_symbols.tolist()}
+        self._log_it('block results', block_number=self.block_number,
+                     results=loggable_results)
 
         self.task_done.emit()
\ No newline at end of file
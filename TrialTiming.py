@@ -0,0 +1,375 @@
+'''Drift free trial timing for the task window.'''
+
+import time
+from array import array
+import PySide.QtCore as QtCore
+
+# Timers are armed to wake this long before a deadline, the rest is spun off
+# so the event fires on the deadline rather than whenever the timer wakes.
+SPIN_NS = 2000000
+
+
+class DeadlineSchedule(object):
+    '''Absolute deadlines for every event of a block, worked out from the
+    block start on the time.perf_counter_ns clock.  Each trial has a sound,
+    an onset (the image shown) and an offset, in order of their deadlines,
+    then after the last trial comes the end of the block.
+
+    Since every deadline comes from the start time, a late event does not
+    push back the ones after it, so lateness never adds up over a block.
+
+    av_compensation_ns is how long after the image a sound triggered with it
+    is heard (see AVSyncLog).  If positive the sound is triggered that much
+    ahead of the image, if negative that much after it, so both arrive
+    together.  It is cut down if need be so every event stays inside its
+    trial, the offset included.'''
+
+    SOUND = 'sound'
+    ONSET = 'onset'
+    OFFSET = 'offset'
+    END = 'end'
+
+    def __init__(self: 'DeadlineSchedule', block_length: int,
+                 stim_time: int, interstim_time: int,
+                 av_compensation_ns: int=0) -> None:
+        '''Times in milliseconds, as in the session settings.'''
+
+        self.block_length = block_length
+        self.stim_ns = stim_time * 1000000
+        self.slot_ns = (stim_time + interstim_time) * 1000000
+
+        # Any longer and events would spill into the next trial.  A positive
+        # compensation holds back the offset too, a negative one only the
+        # sound.
+        av_compensation_ns = max((1 - self.slot_ns),
+                                 min(max(0, (self.slot_ns - self.stim_ns - 1)),
+                                     av_compensation_ns))
+        self.av_compensation_ns = av_compensation_ns
+        # Whichever of sound and image goes second is held back, from the
+        # start of each trial's slot.
+        self.delays = {self.SOUND: max(0, -av_compensation_ns),
+                       self.ONSET: max(0, av_compensation_ns)}
+        self.delays[self.OFFSET] = self.delays[self.ONSET] + self.stim_ns
+        # Order of events within a trial, the same for every trial.
+        self.trial_events = sorted(self.delays, key=self.delays.get)
+        self.start_ns = None
+        self.next_event = 0
+        self.onsets_taken = 0
+        # Nanoseconds on the perf_counter_ns clock, filled in as trials run.
+        self.actual_onsets = array('q', [0]) * block_length
+        self.onset_errors = array('q', [0]) * block_length
+
+    def start(self: 'DeadlineSchedule', now_ns: int) -> None:
+        '''Fix every deadline from now_ns, the start of the block.'''
+
+        self.start_ns = now_ns
+        self.next_event = 0
+        self.onsets_taken = 0
+
+    def get_intended_onset(self: 'DeadlineSchedule', index: int) -> int:
+        '''Return when trial index should be shown.'''
+
+        return (self.start_ns + (index * self.slot_ns) +
+                self.delays[self.ONSET])
+
+    def peek(self: 'DeadlineSchedule') -> tuple:
+        '''Return (kind, trial index, deadline) of the next event, or None
+        once the end of the block has been taken.'''
+
+        events_per_trial = len(self.trial_events)
+
+        if self.next_event > (self.block_length * events_per_trial):
+
+            return None
+
+        index = self.next_event // events_per_trial
+
+        if index >= self.block_length:
+
+            return (self.END, index,
+                    (self.start_ns + (index * self.slot_ns)))
+
+        kind = self.trial_events[(self.next_event % events_per_trial)]
+
+        return (kind, index,
+                (self.start_ns + (index * self.slot_ns) + self.delays[kind]))
+
+    def take(self: 'DeadlineSchedule', now_ns: int) -> tuple:
+        '''Move past the next event, noting its onset error if it is an
+        onset, and return it as peek would.'''
+
+        event = self.peek()
+        self.next_event = self.next_event + 1
+
+        if event[0] == self.ONSET:
+
+            self.actual_onsets[event[1]] = now_ns
+            self.onset_errors[event[1]] = now_ns - event[2]
+            self.onsets_taken = self.onsets_taken + 1
+
+        return event
+
+    def get_error_stats(self: 'DeadlineSchedule') -> dict:
+        '''Return mean and worst onset error in milliseconds over the trials
+        shown so far.'''
+
+        shown = self.onsets_taken
+
+        if shown == 0:
+
+            return {'trials': 0, 'mean onset error ms': None,
+                    'max onset error ms': None}
+
+        errors = self.onset_errors[:shown]
+
+        return {'trials': shown,
+                'mean onset error ms': ((sum(errors) / shown) / 1000000),
+                'max onset error ms': (max(errors) / 1000000)}
+
+
+class TrialScheduler(QtCore.QObject):
+    '''Fires stimulus sounds, onsets and offsets on a DeadlineSchedule.
+    Each timer is armed for the time left to the next absolute deadline,
+    then the last couple of milliseconds are spun off.  Events that are
+    already late fire straight away, one after another, until the schedule
+    is caught up.'''
+
+    stim_sound = QtCore.Signal(int)
+    stim_onset = QtCore.Signal(int)
+    stim_offset = QtCore.Signal(int)
+    block_finished = QtCore.Signal()
+
+    def __init__(self: 'TrialScheduler', block_length: int, stim_time: int,
+                 interstim_time: int, parent: QtCore.QObject=None,
+                 av_compensation_ns: int=0) -> None:
+
+        super(TrialScheduler, self).__init__(parent)
+
+        self.schedule = DeadlineSchedule(block_length, stim_time,
+                                         interstim_time, av_compensation_ns)
+        self.timer = QtCore.QTimer(self)
+        self.timer.setSingleShot(True)
+
+        # Qt 5 and up only, Qt 4 timers are already as precise as they get.
+        if hasattr(self.timer, 'setTimerType'):
+
+            self.timer.setTimerType(QtCore.Qt.PreciseTimer)
+
+        self.timer.timeout.connect(self._timeout)
+
+    def start(self: 'TrialScheduler') -> None:
+        '''Start the block now.'''
+
+        self.schedule.start(time.perf_counter_ns())
+        self._timeout()
+
+    def stop(self: 'TrialScheduler') -> None:
+
+        self.timer.stop()
+
+    def _arm(self: 'TrialScheduler') -> None:
+        '''Set the timer for the next deadline, less the spin margin.'''
+
+        event = self.schedule.peek()
+
+        if event is None:
+
+            return
+
+        remaining_ns = event[2] - time.perf_counter_ns()
+
+        if remaining_ns > SPIN_NS:
+
+            self.timer.start((remaining_ns - SPIN_NS) // 1000000)
+
+        else:
+
+            self.timer.start(0)
+
+    def _timeout(self: 'TrialScheduler') -> None:
+        '''Fire the next event once its deadline is reached.'''
+
+        event = self.schedule.peek()
+
+        if event is None:
+
+            return
+
+        if (event[2] - time.perf_counter_ns()) > SPIN_NS:
+
+            # Woke too early, go back to sleep.
+            self._arm()
+            return
+
+        while time.perf_counter_ns() < event[2]:
+
+            pass
+
+        event = self.schedule.take(time.perf_counter_ns())
+
+        # Arm first so slot run time does not count against the next event.
+        self._arm()
+
+        if event[0] == DeadlineSchedule.SOUND:
+
+            self.stim_sound.emit(event[1])
+
+        elif event[0] == DeadlineSchedule.ONSET:
+
+            self.stim_onset.emit(event[1])
+
+        elif event[0] == DeadlineSchedule.OFFSET:
+
+            self.stim_offset.emit(event[1])
+
+        else:
+
+            self.block_finished.emit()
+
+
+class KeypressLog(object):
+    '''Every response keypress of a block, in preallocated arrays so that
+    recording one needs no new lists or objects.  Holds the trial index,
+    modality (0 visual, 1 aural), perf_counter_ns timestamp and latency from
+    the trial onset for each press, duplicates included.  Presses past
+    capacity are only counted.'''
+
+    MODALITIES = ['visual', 'aural']
+
+    def __init__(self: 'KeypressLog', block_length: int,
+                 presses_per_trial: int=8) -> None:
+
+        self.presses_per_trial = presses_per_trial
+        self.capacity = block_length * presses_per_trial
+        self.count = 0
+        self.dropped = 0
+        self.trials = array('l', [0]) * self.capacity
+        self.modalities = array('b', [0]) * self.capacity
+        self.timestamps = array('q', [0]) * self.capacity
+        self.latencies = array('q', [0]) * self.capacity
+
+    def record(self: 'KeypressLog', trial_index: int, modality: int,
+               now_ns: int, onset_ns: int) -> None:
+        '''Store one press, modality being an index into MODALITIES.'''
+
+        if self.count >= self.capacity:
+
+            self.dropped = self.dropped + 1
+            return
+
+        self.trials[self.count] = trial_index
+        self.modalities[self.count] = modality
+        self.timestamps[self.count] = now_ns
+        self.latencies[self.count] = now_ns - onset_ns
+        self.count = self.count + 1
+
+    def get_latencies(self: 'KeypressLog', modality: str,
+                      first_only: bool=True) -> list:
+        '''Return press latencies in nanoseconds for one modality, by
+        default only the first press of each trial.'''
+
+        modality_code = self.MODALITIES.index(modality)
+        latencies = []
+        trials_seen = set()
+
+        for press in range(self.count):
+
+            if self.modalities[press] != modality_code:
+
+                continue
+
+            if first_only:
+
+                if self.trials[press] in trials_seen:
+
+                    continue
+
+                trials_seen.add(self.trials[press])
+
+            latencies.append(self.latencies[press])
+
+        return latencies
+
+    def get_trial_latencies(self: 'KeypressLog', modality: str) -> list:
+        '''Return the latency of the first press in one modality for every
+        trial, None for trials without one.'''
+
+        modality_code = self.MODALITIES.index(modality)
+        latencies = [None] * (self.capacity // self.presses_per_trial)
+
+        for press in range(self.count):
+
+            if (self.modalities[press] == modality_code and
+                    latencies[self.trials[press]] is None):
+
+                latencies[self.trials[press]] = self.latencies[press]
+
+        return latencies
+
+
+class AVSyncLog(object):
+    '''When the sound and the image of each trial actually went out, on the
+    perf_counter_ns clock, and so how far apart they were.
+
+    The image time is taken when the task window has painted the new
+    stimulus.  The sound time is when its buffer was handed to the output,
+    plus the output latency the audio engine reports for it.  Trials missing
+    either time are left out of the figures.'''
+
+    def __init__(self: 'AVSyncLog', block_length: int) -> None:
+
+        self.block_length = block_length
+        # 0 for not yet seen.
+        self.visual_times = array('q', [0]) * block_length
+        self.audio_times = array('q', [0]) * block_length
+
+    def record_visual(self: 'AVSyncLog', trial_index: int,
+                      now_ns: int) -> None:
+
+        # Only the first paint after the swap counts.
+        if self.visual_times[trial_index] == 0:
+
+            self.visual_times[trial_index] = now_ns
+
+    def record_audio(self: 'AVSyncLog', trial_index: int, now_ns: int,
+                     latency_ns: int=0) -> None:
+
+        self.audio_times[trial_index] = now_ns + latency_ns
+
+    def get_offsets(self: 'AVSyncLog') -> array:
+        '''Return sound less image time in nanoseconds for every trial that
+        has both, positive when the sound came after the image.'''
+
+        return array('q', [(self.audio_times[index] -
+                            self.visual_times[index])
+                           for index in range(self.block_length)
+                           if (self.audio_times[index] and
+                               self.visual_times[index])])
+
+    def get_stats(self: 'AVSyncLog') -> dict:
+        '''Return the spread of offsets in milliseconds.'''
+
+        offsets = sorted(self.get_offsets())
+
+        if len(offsets) == 0:
+
+            return {'trials': 0}
+
+        return {'trials': len(offsets),
+                'mean offset ms': ((sum(offsets) / len(offsets)) / 1000000),
+                'median offset ms': (offsets[(len(offsets) // 2)] / 1000000),
+                'min offset ms': (offsets[0] / 1000000),
+                'max offset ms': (offsets[-1] / 1000000)}
+
+    def learn_compensation(self: 'AVSyncLog', compensation_ns: int) -> int:
+        '''Return a new compensation for DeadlineSchedule, given the one
+        this block ran with.  What is left of the offset, taken as the
+        median so a stray slow frame does not throw it off, is added on.'''
+
+        offsets = sorted(self.get_offsets())
+
+        if len(offsets) == 0:
+
+            return compensation_ns
+
+        return compensation_ns + offsets[(len(offsets) // 2)]